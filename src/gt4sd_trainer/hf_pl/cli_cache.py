@@ -0,0 +1,100 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""List and prune the entries of the tokenized cache."""
+
+import logging
+import sys
+import time
+from typing import List, cast
+
+from .argument_parser import ArgumentParser, DataClassType
+from .core import TokenizedCacheArguments
+from .datasets.cache import CacheEntry, CacheManager, format_size, parse_size
+
+logger = logging.getLogger(__name__)
+
+
+def manage_cache(arguments: TokenizedCacheArguments) -> List[CacheEntry]:
+    """List or prune the entries of the tokenized cache.
+    Args:
+        arguments: a TokenizedCacheArguments instance defining the cache and the action.
+    Returns:
+        the entries of the cache when listing, the removed entries when pruning.
+    Raises:
+        ValueError: in case the action is not supported.
+    """
+    manager = CacheManager(
+        arguments.tokenized_cache_dir,
+        max_size=(
+            parse_size(arguments.tokenized_cache_max_size)
+            if arguments.tokenized_cache_max_size is not None
+            else None
+        ),
+    )
+    if arguments.action == "list":
+        entries = manager.entries()
+        for entry in entries:
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used))
+            logger.info(f"{format_size(entry.size):>8}  {last_used}  {entry.name}")
+        logger.info(
+            f"{len(entries)} entries - {format_size(manager.total_size())} in "
+            f"{arguments.tokenized_cache_dir}"
+        )
+        return entries
+    elif arguments.action == "prune":
+        removed = manager.prune(
+            older_than=(
+                arguments.older_than_days * 24 * 3600
+                if arguments.older_than_days is not None
+                else None
+            )
+        )
+        logger.info(
+            f"Removed {len(removed)} entries - "
+            f"{format_size(sum(entry.size for entry in removed))} freed, "
+            f"{format_size(manager.total_size())} left in {arguments.tokenized_cache_dir}"
+        )
+        return removed
+    else:
+        raise ValueError(f"Cache action {arguments.action} not supported")
+
+
+def main() -> None:
+    """List or prune the tokenized cache.
+    Parsing from the command line the following parameters:
+        - directory of the tokenized cache.
+        - action, list or prune.
+        - disk budget of the cache.
+        - number of days after which unused entries are pruned.
+    """
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    arguments = ArgumentParser(
+        cast(DataClassType, TokenizedCacheArguments)
+    ).parse_args_into_dataclasses(return_remaining_strings=True)[0]
+
+    manage_cache(arguments)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""Tokenize datasets once into the tokenized cache used for training."""
+
+import logging
+import sys
+from typing import Any, Dict, Iterable, cast
+
+from .argument_parser import ArgumentParser, DataClassType
+from .core import LanguageModelingDataArguments, LanguageModelingModelArguments
+from .datasets.core import CGMDataModule, CLMDataModule, MLMDataModule, PLMDataModule
+from .models.core import LM_MODULE_FACTORY
+
+logger = logging.getLogger(__name__)
+
+# options whose datasets are not read from a tokenized cache built ahead of training
+UNSUPPORTED_OPTIONS = {
+    "streaming": "streamed datasets are tokenized on the fly",
+    "shard_by_rank": "rank shards are tokenized by each process once DDP is initialized",
+}
+
+
+def preprocess(model_args: Dict[str, Any], dataset_args: Dict[str, Any]) -> None:
+    """Tokenize training and validation files into the tokenized cache.
+    Args:
+        model_args: model arguments, defining training type and tokenizer.
+        dataset_args: dataset arguments, including the tokenized cache directory.
+    Raises:
+        ValueError: in case the cache directory is missing, the training type is not supported
+            or options whose datasets do not use a prebuilt tokenized cache are set.
+    """
+    for option, reason in UNSUPPORTED_OPTIONS.items():
+        if dataset_args.get(option, False):
+            raise ValueError(f"{option} is not supported for preprocessing: {reason}.")
+
+    if dataset_args["tokenized_cache_dir"] is None and not dataset_args.get(
+        "node_shared_cache", False
+    ):
+        raise ValueError(
+            "tokenized_cache_dir or node_shared_cache is required for preprocessing."
+        )
+
+    training_type = model_args["type"]
+    if training_type not in {"mlm", "clm", "plm", "cgm"}:
+        raise ValueError(f"LM training type {training_type} not supported")
+
+    if model_args["tokenizer"] is None:
+        model_args["tokenizer"] = (
+            model_args["model_name_or_path"]
+            if model_args["model_name_or_path"] is not None
+            else model_args["model_config_name"]
+        )
+    tokenizer = LM_MODULE_FACTORY[training_type].load_tokenizer(model_args)
+
+    # building the data module loads the datasets, filling the cache
+    if training_type == "mlm":
+        data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    elif training_type == "clm":
+        data_module = CLMDataModule(dataset_args, tokenizer=tokenizer)  # type: ignore
+    elif training_type == "plm":
+        data_module = PLMDataModule(dataset_args, tokenizer=tokenizer)  # type: ignore
+    else:
+        data_module = CGMDataModule(dataset_args, model=None, tokenizer=tokenizer)  # type: ignore
+
+    logger.info(
+        f"Tokenized cache ready in {data_module.tokenized_cache_dir()} - "
+        f"Training set size: {len(data_module.datasets['train'])} - "  # type: ignore
+        f"Validation set size: {len(data_module.datasets['validation'])}"  # type: ignore
+    )
+
+
+def main() -> None:
+    """Tokenize datasets once, e.g., on a large machine using a process pool.
+    Parsing from the command line the dataset and model arguments used for training,
+    the tokenized cache directory and the number of preprocessing workers.
+    """
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    dataset_arguments, model_arguments = ArgumentParser(
+        cast(
+            Iterable[DataClassType],
+            tuple([LanguageModelingDataArguments, LanguageModelingModelArguments]),
+        )
+    ).parse_args_into_dataclasses(return_remaining_strings=True)[:2]
+
+    preprocess(model_arguments.__dict__, dataset_arguments.__dict__)
+
+
+if __name__ == "__main__":
+    main()
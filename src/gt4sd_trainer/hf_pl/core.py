@@ -25,13 +25,20 @@
 
 import logging
 from dataclasses import dataclass, field
-from typing import Dict, Optional, Tuple, Union
+from typing import Any, Dict, Optional, Tuple, Union
 
 import sentencepiece as _sentencepiece
 from pytorch_lightning import LightningDataModule, LightningModule
 
 from .datasets.core import CGMDataModule, CLMDataModule, MLMDataModule, PLMDataModule
-from .models.core import LM_MODULE_FACTORY, CGMModule, CLMModule, MLMModule, PLMModule
+from .models.core import (
+    LM_MODULE_FACTORY,
+    CGMModule,
+    CLMModule,
+    MLMModule,
+    PLMModule,
+    check_tokenizers_consistency,
+)
 from .pytorch_lightning_trainer import PyTorchLightningTrainingPipeline
 
 # sentencepiece has to be loaded before lightning to avoid segfaults
@@ -44,6 +51,23 @@ logger.addHandler(logging.NullHandler())
 class LanguageModelingTrainingPipeline(PyTorchLightningTrainingPipeline):
     """Language modeling training pipelines."""
 
+    def train(  # type: ignore
+        self,
+        pl_trainer_args: Dict[str, Any],
+        model_args: Dict[str, Union[float, str, int]],
+        dataset_args: Dict[str, Union[float, str, int]],
+    ) -> None:
+        """Language modeling training function.
+        Args:
+            pl_trainer_args: pytorch lightning trainer arguments passed to the configuration.
+            model_args: model arguments passed to the configuration.
+            dataset_args: dataset arguments passed to the configuration.
+        """
+        if dataset_args.get("shard_by_rank", False):
+            # processes read their own shard, no distributed sampler is needed
+            pl_trainer_args["replace_sampler_ddp"] = False
+        super().train(pl_trainer_args, model_args, dataset_args)
+
     def get_data_and_model_modules(
         self,
         model_args: Dict[str, Union[float, str, int]],
@@ -99,10 +123,44 @@ class LanguageModelingTrainingPipeline(PyTorchLightningTrainingPipeline):
         else:
             raise ValueError(f"LM training type {model_args['type']} not supported")
 
+        if model_args.get("use_fast_tokenizer", False):
+            self.check_fast_tokenizer(model_args, data_module)
+
         model_module.model.resize_token_embeddings(len(data_module.tokenizer))  # type: ignore
 
         return data_module, model_module
 
+    def check_fast_tokenizer(
+        self,
+        model_args: Dict[str, Union[float, str, int]],
+        data_module: LightningDataModule,
+    ) -> None:
+        """Check that the fast tokenizer produces the same ids as the slow one on a sample of the corpus.
+        Args:
+            model_args: model arguments passed to the configuration.
+            data_module: data module using the fast tokenizer.
+        Raises:
+            ValueError: in case fast and slow tokenizers produce different ids.
+        """
+        tokenizer = data_module.tokenizer  # type: ignore
+        if not tokenizer.is_fast:
+            logger.warning(
+                f"No fast tokenizer available for {model_args['tokenizer']}, using the slow one"
+            )
+            return
+
+        slow_tokenizer = LM_MODULE_FACTORY[str(model_args["type"])].load_tokenizer(
+            {**model_args, "use_fast_tokenizer": False}
+        )
+        check_tokenizers_consistency(
+            tokenizer,
+            slow_tokenizer,
+            data_module.sample_texts(  # type: ignore
+                int(model_args.get("tokenizer_check_size", 100))
+            ),
+        )
+        logger.info("Fast and slow tokenizers produce the same ids")
+
     def get_mlm_modules(
         self,
         model_args: Dict[str, Union[float, str, int]],
@@ -221,6 +279,19 @@ class LanguageModelingModelArguments:
         default=None,
         metadata={"help": "Cache directory for HF models."},
     )
+    use_fast_tokenizer: bool = field(
+        default=False,
+        metadata={
+            "help": "Use a fast (Rust) tokenizer, checking at startup that it produces the "
+            "same ids as the slow one on a sample of the training set."
+        },
+    )
+    tokenizer_check_size: int = field(
+        default=100,
+        metadata={
+            "help": "Number of training examples used to compare fast and slow tokenizers."
+        },
+    )
 
 
 @dataclass
@@ -233,7 +304,10 @@ class LanguageModelingDataArguments:
 
     train_file: str = field(
         metadata={
-            "help": "The input training data file (a text file), for example path/to/file."
+            "help": "The input training data file (a text file), for example path/to/file. "
+            "It can be a directory or a glob pattern, recursive with **, for example path/**/*.jsonl, "
+            "or a mixture of sources sampled by weight, for example corpus/:1,chemistry.jsonl:4. "
+            "Arrow or Parquet files and folders saved with datasets' save_to_disk are memory-mapped."
         }
     )
     validation_file: str = field(
@@ -241,6 +315,14 @@ class LanguageModelingDataArguments:
             "help": "The input evaluation data file to evaluate the perplexity on (a text file), for example path/to/file."
         },
     )
+    mixture_temperature: float = field(
+        default=1.0,
+        metadata={
+            "help": "Temperature of the mixture of training sources: sources are sampled with "
+            "probabilities proportional to their weights, or sizes if no weight is given, raised "
+            "to 1 / temperature, higher temperatures flattening the mixture."
+        },
+    )
     max_length: int = field(
         default=512,
         metadata={
@@ -248,6 +330,21 @@ class LanguageModelingDataArguments:
             "than this will be truncated."
         },
     )
+    max_source_length: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "The maximum source sequence length for conditional generation (cgm), "
+            "max_length if not set."
+        },
+    )
+    max_target_length: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "The maximum target sequence length for conditional generation (cgm), "
+            "max_length if not set. Sources and targets are padded to the longest sequence "
+            "of each batch."
+        },
+    )
     mlm_probability: float = field(
         default=0.15,
         metadata={"help": "Ratio of tokens to mask for masked language modeling loss"},
@@ -269,6 +366,225 @@ class LanguageModelingDataArguments:
         default=8,
         metadata={"help": "Ratio of tokens to mask for masked language modeling loss."},
     )
+    eval_batch_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Batch size for validation, larger than the training one since no "
+            "gradients are kept. Defaults to batch_size."
+        },
+    )
+    cache_validation_batches: bool = field(
+        default=False,
+        metadata={
+            "help": "Tokenize the validation examples once and keep them in memory for all "
+            "the validation rounds, sorted by length so that batches have minimal padding. "
+            "Only the examples of the batches validated (see limit_val_batches) are read, "
+            "batches being collated by the dataloader workers."
+        },
+    )
+    use_offset_index: bool = field(
+        default=False,
+        metadata={
+            "help": "Read examples through a memory-mapped byte-offset index stored next to "
+            "each file (.idx) instead of loading whole files in memory in every worker."
+        },
+    )
+    echo_factor: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Data echoing: number of training steps each batch is used for, or auto to "
+            "adapt it to the time spent waiting for data compared to the step time. Masks are "
+            "drawn anew for each echo with mlm. Defaults to no echoing."
+        },
+    )
+    max_echo_factor: int = field(
+        default=4,
+        metadata={
+            "help": "Maximum number of steps each batch is used for with auto echoing."
+        },
+    )
+    example_cache_size: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Memory budget per node of the tokenized examples of .jsonl files kept in "
+            "memory, for example 4GB, split among the processes of the node and their "
+            "dataloader workers. Examples are routed to the worker caching them. Examples not "
+            "cached are read through the offset index. The hit rate is logged as "
+            "example_cache/hit_rate."
+        },
+    )
+    tokenized_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Directory where datasets are tokenized once and stored as memory-mapped "
+            "shards, reused across epochs and runs with the same files, tokenizer and settings."
+        },
+    )
+    tokenized_cache_max_size: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Disk budget of the tokenized cache directory, for example 50GB. The least "
+            "recently used caches not used by the run are evicted beyond it."
+        },
+    )
+    node_shared_cache: bool = field(
+        default=False,
+        metadata={
+            "help": "Share the tokenized caches across the processes of a node: the first "
+            "process of each node tokenizes the files, the others wait for it and memory-map "
+            "the same cache. Stored in /dev/shm unless tokenized_cache_dir is set, where it "
+            "stays in memory until removed."
+        },
+    )
+    tokenized_cache_timeout: float = field(
+        default=3600.0,
+        metadata={
+            "help": "Maximum time in seconds processes wait for the tokenized caches built by "
+            "the first process of their node with node_shared_cache, e.g., several hours "
+            "for large corpora."
+        },
+    )
+    preprocessing_num_workers: int = field(
+        default=1,
+        metadata={"help": "Number of processes used to build the tokenized cache."},
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": "Stream examples sequentially from the files, sharded across processes and "
+            "workers, instead of indexing them for random access. DDP processes stop each "
+            "epoch with the first one running out of examples."
+        },
+    )
+    shuffle_buffer_size: int = field(
+        default=0,
+        metadata={
+            "help": "Number of examples in the buffer used to shuffle streamed training examples, "
+            "no shuffling if 0."
+        },
+    )
+    json_backend: str = field(
+        default="auto",
+        metadata={
+            "help": "Backend parsing JSON lines: auto, orjson, simdjson or json. auto picks the "
+            "fastest installed one, falling back to the standard library."
+        },
+    )
+    json_fields: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Comma-separated fields of the examples decoded and kept, by default the ones "
+            "used by the training type, for example text, or source,target for cgm."
+        },
+    )
+    dynamic_padding: bool = field(
+        default=False,
+        metadata={
+            "help": "Pad each batch to its longest sequence instead of padding every "
+            "example to max_length."
+        },
+    )
+    pad_to_multiple_of: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Round dynamically padded lengths up to a multiple, for example 8 or 64."
+        },
+    )
+    packing: bool = field(
+        default=False,
+        metadata={
+            "help": "Pack consecutive examples, separated by EOS/SEP tokens, in rows of "
+            "max_length tokens. Supported by clm and mlm."
+        },
+    )
+    packing_position_ids: bool = field(
+        default=False,
+        metadata={
+            "help": "When packing, emit position ids restarting at each packed example."
+        },
+    )
+    packing_block_attention: bool = field(
+        default=False,
+        metadata={
+            "help": "When packing, use block-diagonal attention masks so that packed examples "
+            "do not attend to each other. It requires models supporting 3D attention masks."
+        },
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Maximum number of padded tokens per batch. If set, batches have a variable "
+            "number of examples and batch_size is ignored for training and validation."
+        },
+    )
+    group_by_length: bool = field(
+        default=False,
+        metadata={
+            "help": "Group examples of similar token length in the same batches to minimize padding."
+        },
+    )
+    bucket_size_multiplier: int = field(
+        default=100,
+        metadata={
+            "help": "Number of batches per bucket of examples sorted by length when grouping by length."
+        },
+    )
+    shard_by_rank: bool = field(
+        default=False,
+        metadata={
+            "help": "Under DDP, assign the files of the datasets to the processes, balancing their "
+            "sizes, so that each process only counts and reads its own files."
+        },
+    )
+    shuffle_block_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Shuffle the training examples by blocks of this many contiguous examples, "
+            "keeping reads mostly sequential, when they are not grouped by length. No shuffling "
+            "without DDP if not set."
+        },
+    )
+    shuffle_window_blocks: int = field(
+        default=16,
+        metadata={
+            "help": "Number of consecutive shuffled blocks whose examples are shuffled together."
+        },
+    )
+    num_dataloader_workers: str = field(
+        default="auto",
+        metadata={
+            "help": "Number of dataloader workers tokenizing and collating examples, or auto to "
+            "use the cores of each training process but one, up to 8."
+        },
+    )
+    persistent_workers: bool = field(
+        default=True,
+        metadata={
+            "help": "Keep the dataloader workers alive across epochs instead of restarting them."
+        },
+    )
+    prefetch_factor: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of batches prefetched by each dataloader worker, by default 2 or "
+            "probed if dataloader_probe_batches is set."
+        },
+    )
+    pin_memory: Optional[bool] = field(
+        default=None,
+        metadata={
+            "help": "Copy batches in pinned memory for faster transfers to the GPU, by default "
+            "if CUDA is available."
+        },
+    )
+    dataloader_probe_batches: int = field(
+        default=0,
+        metadata={
+            "help": "Number of training batches timed for each candidate number of workers and "
+            "prefetch factor left to auto before training, picking the lowest data wait. "
+            "No probing if 0."
+        },
+    )
 
 
 @dataclass
@@ -300,3 +616,35 @@ class LanguageModelingSavingArguments:
             "help": "Tokenizer name or path. If not provided defaults to model_name_or_path."
         },
     )
+
+
+@dataclass
+class TokenizedCacheArguments:
+    """Arguments related to the management of the tokenized cache."""
+
+    __name__ = "cache_args"
+
+    tokenized_cache_dir: str = field(
+        metadata={"help": "Directory where datasets are tokenized."},
+    )
+    action: str = field(
+        default="list",
+        metadata={
+            "help": "Action on the cache: list its entries, least recently used first, or "
+            "prune them.",
+            "choices": ["list", "prune"],
+        },
+    )
+    tokenized_cache_max_size: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Disk budget of the cache when pruning, for example 50GB. The least "
+            "recently used entries are removed beyond it."
+        },
+    )
+    older_than_days: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "When pruning, remove the entries not used for this number of days."
+        },
+    )
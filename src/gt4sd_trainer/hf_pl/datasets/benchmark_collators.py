@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Benchmark of the vectorized collators against the HF ones.
+
+Example:
+    python -m gt4sd_trainer.hf_pl.datasets.benchmark_collators --tokenizer xlnet-base-cased
+"""
+
+import argparse
+import logging
+import sys
+import timeit
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from torch.utils.data import DataLoader
+from transformers import (
+    AutoTokenizer,
+    DataCollatorForLanguageModeling,
+    DataCollatorForPermutationLanguageModeling,
+    DataCollatorWithPadding,
+)
+
+from .collators import (
+    MaskedLanguageModelingCollator,
+    PermutationLanguageModelingCollator,
+    TensorCollator,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def random_examples(
+    tokenizer: AutoTokenizer,
+    batch_size: int,
+    length: int,
+    seed: int = 0,
+    padding: bool = True,
+) -> List[Dict[str, List[int]]]:
+    """Generate examples of random tokens, framed by special tokens and padded.
+    Args:
+        tokenizer: tokenizer providing token ids.
+        batch_size: number of examples.
+        length: length of the examples.
+        seed: random seed. Defaults to 0.
+        padding: whether to pad the examples to length. Defaults to True.
+    Returns:
+        examples with input ids and attention mask.
+    """
+    generator = np.random.default_rng(seed)
+    special_ids = set(tokenizer.all_special_ids)  # type: ignore
+    vocabulary = np.array(
+        [index for index in range(len(tokenizer)) if index not in special_ids]  # type: ignore
+    )
+    examples = []
+    for _ in range(batch_size):
+        number_of_tokens = int(generator.integers(length // 2, length - 1))
+        tokens = generator.choice(vocabulary, number_of_tokens - 2).tolist()
+        input_ids = tokenizer.build_inputs_with_special_tokens(tokens)[:length]  # type: ignore
+        padding_length = length - len(input_ids) if padding else 0
+        examples.append(
+            {
+                "input_ids": input_ids + [tokenizer.pad_token_id] * padding_length,  # type: ignore
+                "attention_mask": [1] * len(input_ids) + [0] * padding_length,
+            }
+        )
+    return examples
+
+
+def benchmark(
+    collators: Dict[str, Callable], examples: List[Dict[str, Any]], iterations: int
+) -> Dict[str, float]:
+    """Time collators on the same examples.
+    Args:
+        collators: collators by name.
+        examples: examples collated at each iteration.
+        iterations: number of iterations.
+    Returns:
+        average milliseconds per batch by collator name.
+    """
+    return {
+        name: 1000
+        * timeit.timeit(lambda: collator(examples), number=iterations)
+        / iterations
+        for name, collator in collators.items()
+    }
+
+
+def benchmark_dataloader(
+    collators: Dict[str, Callable],
+    examples: List[Dict[str, Any]],
+    iterations: int,
+    num_workers: int,
+) -> Dict[str, float]:
+    """Time batches received from dataloader workers, including the transfer to the main process.
+    Args:
+        collators: collators by name.
+        examples: examples of a batch, repeated for each iteration.
+        iterations: number of batches.
+        num_workers: number of dataloader workers.
+    Returns:
+        average milliseconds per batch by collator name.
+    """
+    timings = {}
+    for name, collator in collators.items():
+        dataloader = DataLoader(
+            examples * iterations,  # type: ignore
+            batch_size=len(examples),
+            num_workers=num_workers,
+            collate_fn=collator,
+        )
+        start = timeit.default_timer()
+        for _ in dataloader:
+            pass
+        timings[name] = 1000 * (timeit.default_timer() - start) / iterations
+    return timings
+
+
+def main() -> None:
+    """Benchmark the collators, reporting milliseconds per batch."""
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokenizer", type=str, default="xlnet-base-cased")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--max_length", type=int, default=512)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--mlm_probability", type=float, default=0.15)
+    parser.add_argument("--plm_probability", type=float, default=1 / 6)
+    parser.add_argument("--max_span_length", type=int, default=5)
+    parser.add_argument("--num_workers", type=int, default=2)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    examples = random_examples(tokenizer, args.batch_size, args.max_length)
+
+    timings = benchmark(
+        {
+            "mlm/hf": DataCollatorForLanguageModeling(
+                tokenizer, mlm_probability=args.mlm_probability
+            ),
+            "mlm/vectorized": MaskedLanguageModelingCollator(
+                tokenizer, mlm_probability=args.mlm_probability
+            ),
+            "plm/hf": DataCollatorForPermutationLanguageModeling(
+                tokenizer,
+                plm_probability=args.plm_probability,
+                max_span_length=args.max_span_length,
+            ),
+            "plm/vectorized": PermutationLanguageModelingCollator(
+                tokenizer,
+                plm_probability=args.plm_probability,
+                max_span_length=args.max_span_length,
+            ),
+        },
+        examples,
+        args.iterations,
+    )
+
+    # dynamic padding of examples of different lengths
+    padding_collators: Dict[str, Callable] = {
+        "padding/hf": DataCollatorWithPadding(tokenizer),
+        "padding/stacked": TensorCollator().with_padding(tokenizer),
+    }
+    unpadded_examples = random_examples(
+        tokenizer, args.batch_size, args.max_length, padding=False
+    )
+    timings.update(benchmark(padding_collators, unpadded_examples, args.iterations))
+    timings.update(
+        {
+            f"{name}/dataloader": milliseconds
+            for name, milliseconds in benchmark_dataloader(
+                padding_collators, unpadded_examples, args.iterations, args.num_workers
+            ).items()
+        }
+    )
+
+    for name, milliseconds in timings.items():
+        logger.info(f"{name}: {milliseconds:.2f} ms/batch")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Management of the tokenized cache directory, within a disk budget."""
+
+import contextlib
+import fcntl
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from typing import IO, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+# files written by datasets' map with several processes, one per process
+PROCESS_FILE_PATTERN = re.compile(r"^(?P<name>.+?)(_\d{5}_of_\d{5})?\.arrow$")
+# files written by datasets' map before being renamed, see tempfile.NamedTemporaryFile
+DATASETS_TEMPORARY_PATTERN = re.compile(r"^tmp[a-z0-9_]{8}$")
+# temporaries left by interrupted builds are removed after a day
+STALE_TEMPORARY_AGE = 24 * 3600.0
+# directory of the lease files of the entries, locked by the runs using them
+LEASES_DIRECTORY = ".leases"
+
+
+def parse_size(size: str) -> int:
+    """Parse a size in bytes, with an optional binary unit.
+    Args:
+        size: size, e.g., 500M, 50GB or 1.5TiB.
+    Returns:
+        number of bytes.
+    Raises:
+        ValueError: in case the size can not be parsed.
+    """
+    match = re.fullmatch(
+        r"\s*(?P<value>\d+(\.\d*)?)\s*(?P<unit>[KMGT]?)(i?B)?\s*", size, re.IGNORECASE
+    )
+    if match is None:
+        raise ValueError(f"Invalid size {size}, expected for example 500M or 50GB.")
+    return int(float(match.group("value")) * SIZE_UNITS[match.group("unit").upper()])
+
+
+def format_size(size: int) -> str:
+    """Format a size in bytes with a binary unit.
+    Args:
+        size: number of bytes.
+    Returns:
+        the formatted size, e.g., 1.5G.
+    """
+    value = float(size)
+    for unit in ["", "K", "M", "G"]:
+        if value < 1024:
+            return f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}T"
+
+
+def path_size(path: str) -> int:
+    """Disk size of a file or a directory.
+    Args:
+        path: path of the file or directory.
+    Returns:
+        total size in bytes of the files, 0 if the path was removed meanwhile.
+    """
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        return sum(
+            os.path.getsize(os.path.join(root, filename))
+            for root, _, filenames in os.walk(path)
+            for filename in filenames
+        )
+    except FileNotFoundError:
+        return 0
+
+
+def is_temporary(name: str) -> bool:
+    """Whether an item of the cache directory is a temporary or a lock.
+    Args:
+        name: name of the item.
+    Returns:
+        whether the item is being written or removed, e.g., .tmp- and .removed-
+        directories or datasets' temporary files, or is a lock file.
+    """
+    return (
+        name.startswith(".")
+        or name.endswith(".lock")
+        or DATASETS_TEMPORARY_PATTERN.match(name) is not None
+    )
+
+
+def entry_name(directory: str, path: str) -> Optional[str]:
+    """Name of the cache entry containing a path.
+    Args:
+        directory: directory of the cache.
+        path: path of a file or directory.
+    Returns:
+        the name of the entry, None if the path is not in the cache.
+    """
+    relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(directory))
+    if relative_path == os.curdir or relative_path.startswith(os.pardir):
+        return None
+    name = relative_path.split(os.sep)[0]
+    match = PROCESS_FILE_PATTERN.match(name)
+    return match.group("name") if match else name
+
+
+@dataclass
+class CacheEntry:
+    """Cache entry, e.g., the tokenized shards of a file."""
+
+    name: str
+    paths: List[str]
+    size: int
+    last_used: float
+
+
+class CacheManager:
+    """Manager of the tokenized cache directory, evicting least recently used entries.
+
+    Entries are the top-level items of the directory, e.g., the tokenized shards of
+    a file named after its fingerprint, or the Arrow files of a tokenized columnar
+    dataset. Their modification time records their last use. Entries are removed by
+    renaming them first, so that processes never see partially removed entries, and
+    processes that already memory-mapped their files keep reading them. Runs lease the
+    entries they use, see lease, and leased entries are never removed.
+    """
+
+    def __init__(self, directory: str, max_size: Optional[int] = None) -> None:
+        """Initialize the cache manager.
+        Args:
+            directory: directory of the cache.
+            max_size: disk budget in bytes. Defaults to None, a.k.a., unbounded.
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    def entry_paths(self) -> Dict[str, List[str]]:
+        """List the paths of the entries of the cache.
+        Returns:
+            the paths of each entry, by name.
+        """
+        if not os.path.isdir(self.directory):
+            return {}
+        paths: Dict[str, List[str]] = {}
+        for name in sorted(os.listdir(self.directory)):
+            if is_temporary(name):
+                continue
+            path = os.path.join(self.directory, name)
+            paths.setdefault(entry_name(self.directory, path), []).append(path)  # type: ignore
+        return paths
+
+    def entries(self) -> List[CacheEntry]:
+        """List the entries of the cache.
+        Returns:
+            the entries, least recently used first.
+        """
+        entries = []
+        for name, entry_paths in self.entry_paths().items():
+            try:
+                last_used = max(os.path.getmtime(path) for path in entry_paths)
+            except FileNotFoundError:
+                # removed by another process meanwhile
+                continue
+            entries.append(
+                CacheEntry(
+                    name=name,
+                    paths=entry_paths,
+                    size=sum(path_size(path) for path in entry_paths),
+                    last_used=last_used,
+                )
+            )
+        return sorted(entries, key=lambda entry: (entry.last_used, entry.name))
+
+    def total_size(self) -> int:
+        """Disk size of the cache.
+        Returns:
+            total size in bytes of the entries.
+        """
+        return sum(entry.size for entry in self.entries())
+
+    def touch(self, names: Iterable[str]) -> None:
+        """Record the use of entries.
+        Args:
+            names: names of the entries.
+        """
+        paths = self.entry_paths()
+        for name in names:
+            for path in paths.get(name, []):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+    def lease_path(self, name: str) -> str:
+        """Path of the lease file of an entry.
+        Args:
+            name: name of the entry.
+        Returns:
+            the path of the lease file, in the leases directory created if needed.
+        """
+        directory = os.path.join(self.directory, LEASES_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    def lease(self, name: str) -> IO:
+        """Lease an entry, so that no process removes it while in use.
+
+        A lease is a shared lock on the lease file of the entry, released when the
+        returned file is closed or the process exits. Leasing an entry before reading
+        or building it waits for any process removing it.
+        Args:
+            name: name of the entry.
+        Returns:
+            the open lease file, to be kept open as long as the entry is used.
+        """
+        lease = open(self.lease_path(name), "a")
+        fcntl.flock(lease, fcntl.LOCK_SH)
+        return lease
+
+    @contextlib.contextmanager
+    def exclusive_lease(self, name: str) -> Iterator[bool]:
+        """Lease an entry exclusively, e.g., to remove it, if no process leases it.
+        Args:
+            name: name of the entry.
+        Returns:
+            a context manager yielding whether the entry is leased exclusively.
+        """
+        with open(self.lease_path(name), "a") as lease:
+            try:
+                fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+            else:
+                yield True
+
+    def remove(self, entry: CacheEntry) -> bool:
+        """Remove an entry not leased by any process, safe for concurrent processes.
+        Args:
+            entry: entry to remove.
+        Returns:
+            whether the entry was removed by the current process.
+        """
+        # temporaries are never leased, unless an entry has the same name
+        has_lease = os.path.exists(
+            os.path.join(self.directory, LEASES_DIRECTORY, entry.name)
+        )
+        if is_temporary(entry.name) and not has_lease:
+            return self.remove_paths(entry)
+        with self.exclusive_lease(entry.name) as unused:
+            if not unused:
+                logger.info(f"Keeping cache entry {entry.name}, in use by another run")
+                return False
+            return self.remove_paths(entry)
+
+    def remove_paths(self, entry: CacheEntry) -> bool:
+        """Remove the paths of an entry, safe for concurrent processes.
+        Args:
+            entry: entry to remove.
+        Returns:
+            whether the entry was removed by the current process.
+        """
+        removed = False
+        for path in entry.paths:
+            # hidden, hence ignored by other processes, before being deleted
+            removed_path = os.path.join(
+                self.directory, f".removed-{uuid.uuid4().hex}-{os.path.basename(path)}"
+            )
+            try:
+                os.rename(path, removed_path)
+            except FileNotFoundError:
+                continue
+            removed = True
+            if os.path.isdir(removed_path):
+                shutil.rmtree(removed_path, ignore_errors=True)
+            else:
+                os.remove(removed_path)
+        if removed:
+            logger.info(
+                f"Removed cache entry {entry.name} ({format_size(entry.size)}) "
+                f"from {self.directory}"
+            )
+        return removed
+
+    def evict(self, keep: Iterable[str] = ()) -> List[CacheEntry]:
+        """Evict the least recently used entries until the cache fits its budget.
+        Args:
+            keep: names of the entries in use, never evicted. Defaults to none.
+        Returns:
+            the evicted entries.
+        """
+        if self.max_size is None:
+            return []
+        keep = set(keep)
+        entries = self.entries()
+        total_size = sum(entry.size for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total_size <= self.max_size:
+                break
+            if entry.name in keep:
+                continue
+            with self.exclusive_lease(entry.name) as unused:
+                if not unused:
+                    # in use by another run, still taking space
+                    continue
+                if self.remove_paths(entry):
+                    evicted.append(entry)
+            total_size -= entry.size
+        if total_size > self.max_size:
+            logger.warning(
+                f"Cache {self.directory} uses {format_size(total_size)}, more than its "
+                f"budget of {format_size(self.max_size)}, with the entries in use only"
+            )
+        return evicted
+
+    def prune(
+        self, older_than: Optional[float] = None, keep: Iterable[str] = ()
+    ) -> List[CacheEntry]:
+        """Remove stale temporaries, unused entries and entries beyond the budget.
+        Args:
+            older_than: remove the entries not used for this number of seconds.
+                Defaults to None, a.k.a., only entries beyond the budget are removed.
+            keep: names of the entries in use, never removed. Defaults to none.
+        Returns:
+            the removed entries.
+        """
+        now = time.time()
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    is_stale = now - os.path.getmtime(path) > STALE_TEMPORARY_AGE
+                except FileNotFoundError:
+                    continue
+                if (
+                    is_temporary(name)
+                    and not name.endswith(".lock")
+                    and name != LEASES_DIRECTORY
+                    and is_stale
+                ):
+                    self.remove(CacheEntry(name, [path], path_size(path), now))
+
+        keep = set(keep)
+        removed = []
+        if older_than is not None:
+            for entry in self.entries():
+                if (
+                    entry.name not in keep
+                    and now - entry.last_used > older_than
+                    and self.remove(entry)
+                ):
+                    removed.append(entry)
+        return removed + self.evict(keep=keep)
@@ -0,0 +1,611 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Collation routines for batches of tokenized examples."""
+
+import copy
+import itertools
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from transformers import AutoTokenizer, default_data_collator
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def round_to_multiple(length: int, pad_to_multiple_of: Optional[int]) -> int:
+    """Round a sequence length up to a multiple.
+    Args:
+        length: sequence length.
+        pad_to_multiple_of: multiple, if None the length is returned unchanged.
+    Returns:
+        the rounded length.
+    """
+    if not pad_to_multiple_of:
+        return length
+    return -(-length // pad_to_multiple_of) * pad_to_multiple_of
+
+
+def padding_values(tokenizer: AutoTokenizer) -> Dict[str, int]:
+    """Values used to pad each key of tokenized examples.
+    Args:
+        tokenizer: tokenizer providing padding token ids.
+    Returns:
+        padding value by key.
+    """
+    return {
+        "input_ids": tokenizer.pad_token_id,  # type: ignore
+        "token_type_ids": tokenizer.pad_token_type_id,  # type: ignore
+        "attention_mask": 0,
+        "special_tokens_mask": 1,
+        "labels": -100,
+    }
+
+
+class DecoderInputsFromLabels:
+    """Prepare decoder input ids from labels as seq2seq models do, without the model.
+
+    Held by seq2seq collators, so that dataloader workers receive two token ids rather
+    than a copy of the model.
+    """
+
+    def __init__(self, decoder_start_token_id: int, pad_token_id: int) -> None:
+        """Initialize the preparation of decoder input ids.
+        Args:
+            decoder_start_token_id: token starting the decoder inputs.
+            pad_token_id: token replacing ignored labels.
+        """
+        self.decoder_start_token_id = decoder_start_token_id
+        self.pad_token_id = pad_token_id
+
+    @staticmethod
+    def from_model(model: Any) -> Any:
+        """Get what decoder input ids are prepared with for a model.
+        Args:
+            model: a seq2seq model, or a DecoderInputsFromLabels returned as is.
+        Returns:
+            the preparation of decoder input ids from the token ids of the model
+            configuration, the model itself if they are not defined or if the model does
+            not prepare decoder input ids.
+        """
+        if isinstance(model, DecoderInputsFromLabels) or not hasattr(
+            model, "prepare_decoder_input_ids_from_labels"
+        ):
+            return model
+        config = model.config
+        if config.decoder_start_token_id is None or config.pad_token_id is None:
+            logger.warning(
+                "Decoder start or padding token not configured, the model is shipped "
+                "to dataloader workers to prepare decoder input ids"
+            )
+            return model
+        return DecoderInputsFromLabels(
+            config.decoder_start_token_id, config.pad_token_id
+        )
+
+    def prepare_decoder_input_ids_from_labels(
+        self, labels: torch.Tensor
+    ) -> torch.Tensor:
+        """Shift labels one token to the right, starting with the decoder start token.
+        Args:
+            labels: labels, -100 for ignored tokens.
+        Returns:
+            the decoder input ids.
+        """
+        decoder_input_ids = labels.new_zeros(labels.shape)
+        decoder_input_ids[:, 1:] = labels[:, :-1]
+        decoder_input_ids[:, 0] = self.decoder_start_token_id
+        decoder_input_ids.masked_fill_(decoder_input_ids == -100, self.pad_token_id)
+        return decoder_input_ids
+
+
+class BlockDiagonalAttentionCollator:
+    """Collator turning document ids of packed examples in block-diagonal attention masks."""
+
+    def __init__(self, collator: Callable = default_data_collator) -> None:
+        """Initialize the collator.
+        Args:
+            collator: collator applied to the examples without document ids.
+                Defaults to default_data_collator.
+        """
+        self.collator = collator
+
+    def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Collate examples, replacing the attention mask with a block-diagonal one.
+        Args:
+            examples: packed examples including document ids, zero for padding.
+        Returns:
+            the batch, with an attention mask of shape (batch_size, length, length).
+        """
+        document_ids = torch.tensor(
+            [example["document_ids"] for example in examples], dtype=torch.long
+        )
+        batch = self.collator(
+            [
+                {key: value for key, value in example.items() if key != "document_ids"}
+                for example in examples
+            ]
+        )
+        batch_size, length = document_ids.shape
+        batch["attention_mask"] = torch.logical_and(
+            document_ids[:, :, None] == document_ids[:, None, :],
+            document_ids[:, None, :] > 0,
+            out=allocate((batch_size, length, length), torch.long),
+        )
+        return batch
+
+
+def strip_padding(
+    example: Dict[str, Any], pad_token_id: int, padding_side: str = "right"
+) -> Dict[str, Any]:
+    """Remove the padding added to an example at tokenization time.
+    Args:
+        example: tokenized example.
+        pad_token_id: id of the padding token, used without an attention mask.
+        padding_side: side where the example is padded, right or left. Defaults to right.
+    Returns:
+        the example, keys as long as its input ids cut to its tokens.
+    """
+    input_ids = example["input_ids"]
+    if "attention_mask" in example:
+        length = int(np.sum(example["attention_mask"]))
+    else:
+        length = int(np.sum(np.asarray(input_ids) != pad_token_id))
+    if length == len(input_ids):
+        return example
+    tokens = (
+        slice(0, length)
+        if padding_side == "right"
+        else slice(len(input_ids) - length, len(input_ids))
+    )
+    return {
+        key: (
+            value[tokens]
+            if hasattr(value, "__len__") and len(value) == len(input_ids)
+            else value
+        )
+        for key, value in example.items()
+    }
+
+
+def allocate(shape: Tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+    """Allocate an uninitialized tensor, in shared memory inside dataloader workers.
+    Tensors in shared memory are handed to the main process without copying them,
+    while other tensors are copied to shared memory when sent by the worker.
+    Args:
+        shape: shape of the tensor.
+        dtype: data type of the tensor.
+    Returns:
+        the tensor.
+    """
+    if get_worker_info() is None:
+        return torch.empty(shape, dtype=dtype)
+    # same allocation as torch's default_collate in workers, typed storages are
+    # accessed through _typed_storage from torch 2.0, through storage before
+    empty = torch.empty(0, dtype=dtype)
+    typed_storage = getattr(empty, "_typed_storage", empty.storage)
+    storage = typed_storage()._new_shared(int(np.prod(shape)))
+    return empty.new(storage).view(shape)
+
+
+def stack_examples(
+    examples: List[Dict[str, Any]],
+    pad_values: Optional[Dict[str, int]] = None,
+    padding_side: str = "right",
+    pad_to_multiple_of: Optional[int] = None,
+) -> Dict[str, torch.Tensor]:
+    """Stack examples in tensors, one per key, padding sequences if requested.
+    Each key is copied once, from the lists of the examples to a tensor allocated with
+    `allocate`, without intermediate padded lists.
+    Args:
+        examples: tokenized examples.
+        pad_values: padding value by key, keys not included have to be of equal length.
+            Defaults to None, a.k.a., no padding.
+        padding_side: side where sequences are padded, right or left. Defaults to right.
+        pad_to_multiple_of: round padded lengths up to this multiple. Defaults to None.
+    Returns:
+        the stacked tensors, of shape (batch_size, length) for sequences.
+    Raises:
+        ValueError: in case the sequences of a key not padded have different lengths.
+    """
+    pad_values = pad_values or {}
+    batch = {}
+    for key, first_value in examples[0].items():
+        values = [example[key] for example in examples]
+        if not hasattr(first_value, "__len__"):
+            batch[key] = torch.as_tensor(np.asarray(values))
+            continue
+
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+        max_length = int(lengths.max())
+        if key in pad_values:
+            max_length = round_to_multiple(max_length, pad_to_multiple_of)
+        elif (lengths != max_length).any():
+            raise ValueError(
+                f"Examples have {key} of different lengths, pad them to max_length "
+                "or enable dynamic_padding."
+            )
+
+        is_float = len(first_value) > 0 and isinstance(
+            first_value[0], (float, np.floating)
+        )
+        tensor = allocate(
+            (len(values), max_length), torch.float32 if is_float else torch.long
+        )
+        array = tensor.numpy()
+        flat_values = np.fromiter(
+            itertools.chain.from_iterable(values),
+            dtype=array.dtype,
+            count=int(lengths.sum()),
+        )
+        if (lengths == max_length).all():
+            array.reshape(-1)[:] = flat_values
+        else:
+            positions = np.arange(max_length)[None, :]
+            if padding_side == "right":
+                is_token = positions < lengths[:, None]
+            else:
+                is_token = positions >= (max_length - lengths)[:, None]
+            array.fill(pad_values[key])
+            array[is_token] = flat_values
+        batch[key] = tensor
+    return batch
+
+
+class TensorCollator:
+    """Collator stacking examples in tensors, optionally padding them dynamically.
+
+    Only padding values are kept from the tokenizer, so that the collator is cheap to
+    ship to dataloader workers, where batches are allocated in shared memory.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the collator, without padding."""
+        self.pad_values: Optional[Dict[str, int]] = None
+        self.padding_side = "right"
+        self.pad_to_multiple_of: Optional[int] = None
+
+    def with_padding(
+        self,
+        tokenizer: AutoTokenizer,
+        pad_to_multiple_of: Optional[int] = None,
+    ) -> "TensorCollator":
+        """Get a copy of the collator padding each batch to its longest sequence.
+        Args:
+            tokenizer: tokenizer providing padding token ids and padding side.
+            pad_to_multiple_of: round padded lengths up to this multiple, e.g., 8 or 64
+                for tensor cores. Defaults to None, a.k.a., no rounding.
+        Returns:
+            the padding collator.
+        Raises:
+            ValueError: in case the tokenizer has no padding token.
+        """
+        if tokenizer.pad_token_id is None:  # type: ignore
+            raise ValueError(
+                "Dynamic padding requires a tokenizer with a padding token."
+            )
+        collator = copy.copy(self)
+        collator.pad_values = padding_values(tokenizer)
+        collator.padding_side = tokenizer.padding_side  # type: ignore
+        collator.pad_to_multiple_of = pad_to_multiple_of
+        return collator
+
+    def stack(self, examples: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        """Stack examples in tensors, padding them if configured.
+        Args:
+            examples: tokenized examples.
+        Returns:
+            the stacked tensors.
+        """
+        return stack_examples(
+            examples, self.pad_values, self.padding_side, self.pad_to_multiple_of
+        )
+
+    def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        """Stack examples in tensors.
+        Args:
+            examples: tokenized examples.
+        Returns:
+            the batch.
+        """
+        return self.stack(examples)
+
+
+class Seq2SeqCollator(TensorCollator):
+    """Collator stacking seq2seq examples, preparing decoder input ids from labels.
+
+    Sources and labels are padded independently, each to its longest sequence when
+    padding dynamically, and decoder input ids are prepared in the workers from the
+    stacked labels, with the token ids of the model rather than the model itself.
+    """
+
+    def __init__(self, decoder_inputs: Optional[Any] = None) -> None:
+        """Initialize the collator.
+        Args:
+            decoder_inputs: object preparing decoder input ids from labels, e.g.,
+                a DecoderInputsFromLabels. Defaults to None, a.k.a., decoder input ids
+                are not prepared.
+        """
+        super().__init__()
+        self.decoder_inputs = decoder_inputs
+
+    def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        """Stack examples in tensors, adding decoder input ids.
+        Args:
+            examples: tokenized examples, labels padded with -100.
+        Returns:
+            the batch.
+        """
+        batch = self.stack(examples)
+        if (
+            self.decoder_inputs is not None
+            and "labels" in batch
+            and "decoder_input_ids" not in batch
+        ):
+            batch["decoder_input_ids"] = (
+                self.decoder_inputs.prepare_decoder_input_ids_from_labels(
+                    labels=batch["labels"]
+                )
+            )
+        return batch
+
+
+class MaskingCollator(TensorCollator):
+    """Base class for collators masking stacked examples with vectorized operations.
+
+    Only token ids are kept from the tokenizer, so that the collator is cheap to
+    ship to dataloader workers, where batches are masked.
+    """
+
+    def __init__(self, tokenizer: AutoTokenizer) -> None:
+        """Initialize the collator.
+        Args:
+            tokenizer: tokenizer providing mask, padding and special token ids.
+        Raises:
+            ValueError: in case the tokenizer has no mask token.
+        """
+        super().__init__()
+        if tokenizer.mask_token_id is None:  # type: ignore
+            raise ValueError("Masking requires a tokenizer with a mask token.")
+
+        self.mask_token_id = tokenizer.mask_token_id  # type: ignore
+        self.pad_token_id = tokenizer.pad_token_id  # type: ignore
+        self.vocabulary_size = len(tokenizer)  # type: ignore
+        self.special_token_ids = torch.tensor(
+            sorted(set(tokenizer.all_special_ids)), dtype=torch.long  # type: ignore
+        )
+
+    def special_tokens_mask(
+        self,
+        input_ids: torch.Tensor,
+        special_tokens_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Mask of special tokens, padding included.
+        Args:
+            input_ids: token ids of shape (batch_size, length).
+            special_tokens_mask: special tokens mask returned by the tokenizer, if any.
+        Returns:
+            a boolean tensor, True for special tokens.
+        """
+        mask = torch.isin(input_ids, self.special_token_ids)
+        if special_tokens_mask is not None:
+            mask |= special_tokens_mask.bool()
+        return mask
+
+
+class MaskedLanguageModelingCollator(MaskingCollator):
+    """Vectorized equivalent of DataCollatorForLanguageModeling."""
+
+    def __init__(self, tokenizer: AutoTokenizer, mlm_probability: float = 0.15) -> None:
+        """Initialize the collator.
+        Args:
+            tokenizer: tokenizer providing mask, padding and special token ids.
+            mlm_probability: probability of masking a token. Defaults to 0.15.
+        """
+        super().__init__(tokenizer)
+        self.mlm_probability = mlm_probability
+        self.masks = True
+
+    def without_masking(self) -> "MaskedLanguageModelingCollator":
+        """Get a copy of the collator stacking examples without masking them.
+        Returns:
+            the collator, batches being masked later on with `mask`, e.g., once per echo.
+        """
+        collator = copy.copy(self)
+        collator.masks = False
+        return collator
+
+    def mask_tokens(
+        self, input_ids: torch.Tensor, special_tokens_mask: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Mask tokens: 80% replaced by the mask token, 10% by a random token, 10% unchanged.
+        Args:
+            input_ids: token ids of shape (batch_size, length), masked in place.
+            special_tokens_mask: boolean mask of tokens that can not be masked.
+        Returns:
+            the masked token ids and the labels, -100 for tokens not masked.
+        """
+        labels = allocate(tuple(input_ids.shape), input_ids.dtype).copy_(input_ids)
+
+        probabilities = torch.rand(input_ids.shape)
+        masked = (probabilities < self.mlm_probability) & ~special_tokens_mask
+        labels[~masked] = -100
+
+        # a single draw decides the replacement, with the same 80/10/10 split as HF
+        replacement = torch.rand(input_ids.shape)
+        input_ids[masked & (replacement < 0.8)] = self.mask_token_id
+        randomized = masked & (replacement >= 0.8) & (replacement < 0.9)
+        input_ids[randomized] = torch.randint(
+            self.vocabulary_size, (int(randomized.sum()),), dtype=torch.long
+        )
+        return input_ids, labels
+
+    def mask(
+        self, batch: Dict[str, torch.Tensor], in_place: bool = True
+    ) -> Dict[str, torch.Tensor]:
+        """Mask a stacked batch, drawing new masks at each call.
+        Args:
+            batch: stacked examples.
+            in_place: whether the input ids of the batch are masked in place, otherwise
+                the batch is left unchanged. Defaults to True.
+        Returns:
+            the batch, including masked input ids and labels.
+        """
+        batch = dict(batch)
+        special_tokens_mask = self.special_tokens_mask(
+            batch["input_ids"], batch.pop("special_tokens_mask", None)
+        )
+        batch["input_ids"], batch["labels"] = self.mask_tokens(
+            batch["input_ids"] if in_place else batch["input_ids"].clone(),
+            special_tokens_mask,
+        )
+        return batch
+
+    def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        """Stack and mask examples.
+        Args:
+            examples: tokenized examples.
+        Returns:
+            the batch, including masked input ids and labels, unless masking is disabled.
+        """
+        batch = self.stack(examples)
+        if not self.masks:
+            return batch
+        return self.mask(batch)
+
+
+class PermutationLanguageModelingCollator(MaskingCollator):
+    """Vectorized equivalent of DataCollatorForPermutationLanguageModeling."""
+
+    def __init__(
+        self,
+        tokenizer: AutoTokenizer,
+        plm_probability: float = 1 / 6,
+        max_span_length: int = 5,
+    ) -> None:
+        """Initialize the collator.
+        Args:
+            tokenizer: tokenizer providing mask, padding and special token ids.
+            plm_probability: ratio of the length of a masked span to its surrounding context.
+                Defaults to 1/6.
+            max_span_length: maximum length of a masked span. Defaults to 5.
+        """
+        super().__init__(tokenizer)
+        self.plm_probability = plm_probability
+        self.max_span_length = max_span_length
+
+    def span_mask(self, batch_size: int, length: int) -> torch.Tensor:
+        """Sample masked spans, each one in a context of span_length / plm_probability tokens.
+        Args:
+            batch_size: number of sequences.
+            length: length of the sequences.
+        Returns:
+            a boolean tensor of shape (batch_size, length), True for masked tokens.
+        """
+        minimum_context_length = max(1, int(1 / self.plm_probability))
+        number_of_spans = -(-length // minimum_context_length)
+
+        span_lengths = torch.randint(
+            1, self.max_span_length + 1, (batch_size, number_of_spans)
+        )
+        context_lengths = (span_lengths.double() / self.plm_probability).long()
+        context_starts = torch.cumsum(context_lengths, dim=1) - context_lengths
+        starts = (
+            context_starts
+            + (
+                torch.rand(span_lengths.shape) * (context_lengths - span_lengths + 1)
+            ).long()
+        )
+        ends = starts + span_lengths
+
+        # spans never overlap, their boundaries are accumulated to mark the tokens in between
+        in_sequence = (context_starts < length).long()
+        boundaries = torch.zeros((batch_size, length + 1), dtype=torch.long)
+        boundaries.scatter_add_(1, starts.clamp(max=length), in_sequence)
+        boundaries.scatter_add_(1, ends.clamp(max=length), -in_sequence)
+        return torch.cumsum(boundaries, dim=1)[:, :length] > 0
+
+    def permutation_mask(
+        self, masked: torch.Tensor, non_functional: torch.Tensor
+    ) -> torch.Tensor:
+        """Sample factorisation orders permuting the two halves of each sequence in the same way.
+        Args:
+            masked: boolean mask of the masked tokens of shape (batch_size, length).
+            non_functional: boolean mask of tokens that are neither special nor padding.
+        Returns:
+            the permutation mask of shape (batch_size, length, length), 1 when the i-th
+            token can not attend to the j-th one.
+        """
+        batch_size, length = masked.shape
+        half_permutations = torch.argsort(torch.rand((batch_size, length // 2)), dim=1)
+        permutation_index = torch.cat(
+            [half_permutations, half_permutations + length // 2], dim=1
+        )
+        # tokens neither masked nor functional can be seen by all other positions
+        permutation_index.masked_fill_(~masked & non_functional, -1)
+        return torch.logical_and(
+            permutation_index[:, :, None] <= permutation_index[:, None, :],
+            masked[:, None, :],
+            out=allocate((batch_size, length, length), torch.float32),
+        )
+
+    def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        """Stack and mask examples.
+        Args:
+            examples: tokenized examples, of even length once stacked.
+        Returns:
+            the batch, with masked input ids, permutation mask, target mapping and labels.
+        Raises:
+            ValueError: in case the sequence length is odd.
+        """
+        batch = self.stack(examples)
+        input_ids = batch["input_ids"]
+        batch_size, length = input_ids.shape
+        if length % 2 != 0:
+            raise ValueError(
+                "Permutation language modeling requires sequences of even length to "
+                "create a leakage-free permutation mask."
+            )
+
+        special_tokens_mask = self.special_tokens_mask(
+            input_ids, batch.get("special_tokens_mask", None)
+        )
+        masked = self.span_mask(batch_size, length) & ~special_tokens_mask
+
+        labels = allocate((batch_size, length), input_ids.dtype).copy_(input_ids)
+        labels[~masked] = -100
+        input_ids[masked] = self.mask_token_id
+
+        target_mapping = allocate((batch_size, length, length), torch.float32).zero_()
+        target_mapping.diagonal(dim1=1, dim2=2).fill_(1.0)
+
+        return {
+            "input_ids": input_ids,
+            "perm_mask": self.permutation_mask(masked, ~special_tokens_mask),
+            "target_mapping": target_mapping,
+            "labels": labels,
+        }
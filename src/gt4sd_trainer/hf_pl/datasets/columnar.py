@@ -0,0 +1,209 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Columnar datasets stored in Arrow or Parquet files, memory-mapped."""
+
+import glob
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import datasets
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from torch.utils.data import Dataset
+from transformers.tokenization_utils_base import BatchEncoding
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+COLUMNAR_SUFFIXES = (".arrow", ".parquet")
+# written by datasets.Dataset.save_to_disk
+SAVED_DATASET_STATE = "state.json"
+
+
+def is_saved_dataset(path: str) -> bool:
+    """Check whether a path is a dataset saved with datasets.Dataset.save_to_disk.
+    Args:
+        path: path to check.
+    Returns:
+        whether the path is a saved dataset folder.
+    """
+    return os.path.isfile(os.path.join(path, SAVED_DATASET_STATE))
+
+
+def columnar_filepaths(path: str) -> List[str]:
+    """List the Arrow or Parquet files of a dataset.
+    Args:
+        path: a file, a directory or a glob pattern, recursive if it contains "**".
+    Returns:
+        the sorted paths of the Arrow or Parquet files, empty if there are none.
+    """
+    if os.path.isfile(path):
+        filepaths = [path]
+    elif os.path.isdir(path):
+        filepaths = [os.path.join(path, filename) for filename in os.listdir(path)]
+    else:
+        filepaths = glob.glob(path, recursive=True)
+    # hidden files, e.g., temporary files, are not part of the dataset
+    return sorted(
+        filepath
+        for filepath in filepaths
+        if filepath.endswith(COLUMNAR_SUFFIXES)
+        and not os.path.basename(filepath).startswith(".")
+        and os.path.isfile(filepath)
+    )
+
+
+def is_columnar_dataset(path: str) -> bool:
+    """Check whether a path is a columnar dataset.
+    Args:
+        path: a file, a directory or a glob pattern.
+    Returns:
+        whether the path is a saved dataset folder or contains Arrow or Parquet files.
+    """
+    return is_saved_dataset(path) or len(columnar_filepaths(path)) > 0
+
+
+def load_columnar_dataset(
+    path: str, columns: Sequence[str], cache_dir: Optional[str] = None
+) -> datasets.Dataset:
+    """Load a columnar dataset, memory-mapped and restricted to some columns.
+
+    Saved datasets and Arrow streaming files are memory-mapped in place, Parquet files
+    and Arrow IPC files are converted once to Arrow files in the cache directory,
+    reading the requested columns only for Parquet files.
+
+    Args:
+        path: a saved dataset folder, or an Arrow or Parquet file, directory or glob
+            pattern.
+        columns: columns to read.
+        cache_dir: directory where converted files are cached. Defaults to None,
+            a.k.a., the datasets cache.
+    Returns:
+        the dataset.
+    Raises:
+        ValueError: in case Arrow and Parquet files are mixed.
+    """
+    columns = list(columns)
+    if is_saved_dataset(path):
+        return datasets.load_from_disk(path).select_columns(columns)
+
+    filepaths = columnar_filepaths(path)
+    if all(filepath.endswith(".parquet") for filepath in filepaths):
+        return datasets.Dataset.from_parquet(
+            filepaths, columns=columns, cache_dir=cache_dir
+        )
+    if not all(filepath.endswith(".arrow") for filepath in filepaths):
+        raise ValueError(f"{path} mixes Arrow and Parquet files.")
+    try:
+        return datasets.concatenate_datasets(
+            [datasets.Dataset.from_file(filepath) for filepath in filepaths]
+        ).select_columns(columns)
+    except pa.ArrowInvalid:
+        # IPC files, rather than streams, can not be memory-mapped by datasets
+        return datasets.load_dataset(
+            "arrow", data_files=filepaths, split="train", cache_dir=cache_dir
+        ).select_columns(columns)
+
+
+def tokenize_columnar_dataset(
+    dataset: datasets.Dataset,
+    tokenize_function: Callable[[Dict[str, Any]], BatchEncoding],
+    num_proc: int = 1,
+    cache_file_name: Optional[str] = None,
+) -> datasets.Dataset:
+    """Tokenize a columnar dataset in batches, caching the results on disk.
+    Args:
+        dataset: dataset of examples.
+        tokenize_function: function mapping the columns of examples to a BatchEncoding.
+        num_proc: number of processes used for tokenization. Defaults to 1.
+        cache_file_name: file where the tokenized dataset is cached. Defaults to None,
+            a.k.a., next to the files of the dataset.
+    Returns:
+        the tokenized dataset.
+    """
+    if cache_file_name is not None:
+        os.makedirs(os.path.dirname(cache_file_name), exist_ok=True)
+    return dataset.map(
+        lambda examples: dict(tokenize_function(examples)),
+        batched=True,
+        num_proc=num_proc if num_proc > 1 else None,
+        remove_columns=dataset.column_names,
+        cache_file_name=cache_file_name,
+        desc="Tokenizing",
+    )
+
+
+class ColumnarDataset(Dataset):
+    """Dataset of tokenized examples stored in a memory-mapped columnar dataset."""
+
+    def __init__(self, dataset: datasets.Dataset) -> None:
+        """Initialize the columnar dataset.
+        Args:
+            dataset: dataset of tokenized examples.
+        """
+        self.dataset = dataset
+
+    def lengths(self) -> np.ndarray:
+        """Token length of each example, read from the Arrow list offsets.
+        Returns:
+            the number of input tokens of each example.
+        """
+        return (
+            pc.list_value_length(self.dataset.with_format("arrow")["input_ids"])
+            .to_numpy()
+            .astype(np.int64)
+        )
+
+    def __len__(self) -> int:
+        """Number of instances of the dataset.
+        Returns:
+           number of instances
+        """
+        return len(self.dataset)
+
+    def __getitem__(self, index) -> BatchEncoding:
+        """Get an item of the dataset.
+        Args:
+            index: index of the item.
+        Returns:
+            tokenized item.
+        """
+        return BatchEncoding(data=self.dataset[int(index)])
+
+    def __getitems__(self, indices: List[int]) -> List[BatchEncoding]:
+        """Get several items of the dataset, read at once.
+        Args:
+            indices: indices of the items.
+        Returns:
+            tokenized items.
+        """
+        if not indices:
+            return []
+        batch = self.dataset[[int(index) for index in indices]]
+        return [
+            BatchEncoding(data={key: values[position] for key, values in batch.items()})
+            for position in range(len(indices))
+        ]
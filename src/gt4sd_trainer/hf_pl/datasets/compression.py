@@ -0,0 +1,372 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Compressed dataset files, with block indices for random access.
+
+Compressed files are read as a sequence of blocks: gzip members or zstd frames ending
+at a line boundary. Files written with `write_block_compressed` can be accessed by
+decompressing only the block containing an example. Files compressed in a single member
+or frame are a single block, which can only be read sequentially, e.g., when streaming,
+unless small.
+"""
+
+import gzip
+import io
+import itertools
+import logging
+import os
+import zlib
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from .indexing import OFFSET_INDEX_DTYPE, atomic_write, load_offset_index
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+DATASET_SUFFIXES = (".jsonl", ".json")
+BLOCK_INDEX_SUFFIX = ".bidx"
+# compressed size of the largest blocks decompressed in memory for random access
+MAX_BLOCK_SIZE = 2**22
+
+
+def compression_type(filepath: str) -> Optional[str]:
+    """Get the compression type of a file from its suffix.
+    Args:
+        filepath: path of the file.
+    Returns:
+        gzip or zstd, None for uncompressed files.
+    """
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(filepath)[1], None)
+
+
+def is_dataset_file(filepath: str) -> bool:
+    """Check whether a file is a dataset file, a .jsonl or .json, optionally compressed.
+    Args:
+        filepath: path of the file.
+    Returns:
+        whether the file is a dataset file.
+    """
+    if compression_type(filepath) is not None:
+        filepath = os.path.splitext(filepath)[0]
+    return filepath.endswith(DATASET_SUFFIXES)
+
+
+def _zstandard() -> Any:
+    """Get the zstandard module.
+    Returns:
+        the zstandard module.
+    Raises:
+        ImportError: in case zstandard is not installed.
+    """
+    if zstandard is None:
+        raise ImportError(
+            "Reading .zst files requires zstandard, install it with pip install zstandard."
+        )
+    return zstandard
+
+
+def new_decompressor(kind: str) -> Any:
+    """Create an incremental decompressor for a single gzip member or zstd frame.
+    Args:
+        kind: compression type.
+    Returns:
+        a decompressor exposing decompress, eof and unused_data.
+    """
+    if kind == "gzip":
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    return _zstandard().ZstdDecompressor().decompressobj()
+
+
+def decompress(kind: str, data: bytes) -> bytes:
+    """Decompress data made of one or more gzip members or zstd frames.
+    Args:
+        kind: compression type.
+        data: compressed data.
+    Returns:
+        the decompressed data.
+    """
+    if kind == "gzip":
+        return gzip.decompress(data)
+    with _zstandard().ZstdDecompressor().stream_reader(
+        io.BytesIO(data), read_across_frames=True
+    ) as reader:
+        return reader.read()
+
+
+def open_compressed(filepath: str, offset: int = 0) -> IO[bytes]:
+    """Open a compressed file for reading decompressed lines.
+    Args:
+        filepath: path of the file.
+        offset: compressed offset to start from, the start of a block. Defaults to 0.
+    Returns:
+        a binary file object of the decompressed data.
+    """
+    kind = compression_type(filepath)
+    fp = open(filepath, "rb")
+    fp.seek(offset)
+    if kind == "gzip":
+        return gzip.GzipFile(fileobj=fp)  # type: ignore
+    return io.BufferedReader(
+        _zstandard()
+        .ZstdDecompressor()
+        .stream_reader(fp, read_across_frames=True, closefd=True)
+    )
+
+
+def open_dataset_file(filepath: str, offset: int = 0) -> IO[bytes]:
+    """Open a dataset file, decompressing it if compressed.
+    Args:
+        filepath: path of the file.
+        offset: offset to start from, for compressed files the start of a block.
+            Defaults to 0.
+    Returns:
+        a binary file object.
+    """
+    if compression_type(filepath) is not None:
+        return open_compressed(filepath, offset)
+    fp = open(filepath, "rb")
+    fp.seek(offset)
+    return fp
+
+
+def build_block_index(filepath: str, chunk_size: int = 2**20) -> np.ndarray:
+    """Build the block index of a compressed line-delimited file.
+    Args:
+        filepath: path of the dataset.
+        chunk_size: size in bytes of the compressed chunks read while scanning the file.
+    Returns:
+        array concatenating the number of lines before each block and the compressed
+        offsets of each block, both with a last entry for the end of the file, so that
+        the last value is the file size as for offset indices.
+    """
+    kind = compression_type(filepath)
+    if kind is None:
+        raise ValueError(f"{filepath} is not compressed.")
+
+    size = os.path.getsize(filepath)
+    offsets: List[int] = [0]
+    lines_before: List[int] = [0]
+    number_of_newlines = 0
+    ends_with_newline = True
+    read_position = 0
+    decompressor = new_decompressor(kind)
+    data = b""
+    with open(filepath, "rb") as fp:
+        while True:
+            if not data:
+                data = fp.read(chunk_size)
+                if not data:
+                    break
+                read_position += len(data)
+            output = decompressor.decompress(data)
+            if output:
+                number_of_newlines += output.count(b"\n")
+                ends_with_newline = output.endswith(b"\n")
+            data = b""
+            if decompressor.eof:
+                data = decompressor.unused_data
+                member_end = read_position - len(data)
+                # blocks hold whole lines, members splitting a line are merged
+                if ends_with_newline and member_end < size:
+                    offsets.append(member_end)
+                    lines_before.append(number_of_newlines)
+                decompressor = new_decompressor(kind)
+
+    number_of_lines = number_of_newlines + (0 if ends_with_newline else 1)
+    return np.array(
+        lines_before + [number_of_lines] + offsets + [size], dtype=OFFSET_INDEX_DTYPE
+    )
+
+
+def load_block_index(filepath: str, index_path: Optional[str] = None) -> np.ndarray:
+    """Load the block index of a compressed file, building it when missing or stale.
+    Args:
+        filepath: path of the dataset.
+        index_path: path of the block index. Defaults to a sidecar file next to the dataset.
+    Returns:
+        array of shape (2, number of blocks + 1) with the number of lines before each
+        block and the compressed offset of each block.
+    """
+    if index_path is None:
+        index_path = f"{filepath}{BLOCK_INDEX_SUFFIX}"
+    return load_offset_index(
+        filepath, index_path, build_function=build_block_index
+    ).reshape(2, -1)
+
+
+class BlockReader:
+    """Random access to the lines of a compressed file through its block index."""
+
+    def __init__(self, filepath: str, max_block_size: int = MAX_BLOCK_SIZE) -> None:
+        """Initialize the reader.
+        Args:
+            filepath: path of the compressed file.
+            max_block_size: compressed size in bytes of the largest blocks decompressed
+                in memory for random access. Defaults to MAX_BLOCK_SIZE.
+        """
+        self.filepath = filepath
+        self.max_block_size = max_block_size
+        self.kind = compression_type(filepath)
+        self.block_index = load_block_index(filepath)
+        self.lines_before = self.block_index[0]
+        self.offsets = self.block_index[1]
+        self._block: Optional[int] = None
+        self._lines: List[bytes] = []
+
+    def __len__(self) -> int:
+        """Number of lines of the file.
+        Returns:
+            number of lines.
+        """
+        return int(self.lines_before[-1])
+
+    @property
+    def number_of_blocks(self) -> int:
+        """Number of blocks of the file.
+        Returns:
+            number of blocks.
+        """
+        return len(self.offsets) - 1
+
+    @property
+    def largest_block_size(self) -> int:
+        """Compressed size of the largest block of the file.
+        Returns:
+            size in bytes.
+        """
+        return int(np.diff(self.offsets).max()) if self.number_of_blocks else 0
+
+    def check_random_access(self) -> None:
+        """Check that blocks are small enough to be decompressed in memory.
+        Raises:
+            ValueError: in case a block is larger than max_block_size, e.g., a large file
+                compressed in one go.
+        """
+        if self.largest_block_size > self.max_block_size:
+            raise ValueError(
+                f"{self.filepath} has a compressed block of "
+                f"{self.largest_block_size / 2**20:.1f} MiB, too large for random "
+                "access: compress it in blocks with write_block_compressed, stream it or "
+                "pre-tokenize it with a tokenized cache directory."
+            )
+
+    def block_lines(self, block: int) -> List[bytes]:
+        """Decompress the lines of a block, caching the last block decompressed.
+        Args:
+            block: index of the block.
+        Returns:
+            the lines of the block.
+        """
+        if block != self._block:
+            self.check_random_access()
+            start, end = int(self.offsets[block]), int(self.offsets[block + 1])
+            with open(self.filepath, "rb") as fp:
+                fp.seek(start)
+                data = decompress(self.kind, fp.read(end - start))  # type: ignore
+            self._lines = data.splitlines(keepends=True)
+            self._block = block
+        return self._lines
+
+    def read_line(self, index: int) -> bytes:
+        """Read a line, decompressing only the block containing it.
+        Args:
+            index: index of the line.
+        Returns:
+            the line.
+        """
+        block = int(np.searchsorted(self.lines_before, index, side="right")) - 1
+        return self.block_lines(block)[index - int(self.lines_before[block])]
+
+    def read_blocks(self, start: int, end: Optional[int]) -> Iterator[bytes]:
+        """Read the lines of the blocks starting in a range of compressed offsets.
+
+        The blocks are decompressed sequentially, without holding them in memory.
+        Args:
+            start: start of the range.
+            end: end of the range, None for the end of file.
+        Returns:
+            an iterator over the lines.
+        """
+        block_starts = self.offsets[:-1]
+        first = int(np.searchsorted(block_starts, start, side="left"))
+        last = (
+            self.number_of_blocks
+            if end is None
+            else int(np.searchsorted(block_starts, end, side="left"))
+        )
+        if first >= last:
+            return
+        number_of_lines = int(self.lines_before[last] - self.lines_before[first])
+        with open_compressed(self.filepath, int(self.offsets[first])) as fp:
+            yield from itertools.islice(fp, number_of_lines)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state to pickle, e.g., when spawning dataloader workers.
+        Returns:
+           state of the reader without cached block.
+        """
+        state = self.__dict__.copy()
+        state["_block"] = None
+        state["_lines"] = []
+        return state
+
+
+def write_block_compressed(
+    source_filepath: str, filepath: str, lines_per_block: int = 1024
+) -> None:
+    """Compress a line-delimited file in independent blocks, for cheap random access.
+    Args:
+        source_filepath: path of the uncompressed file.
+        filepath: path of the compressed file, ending with .gz or .zst.
+        lines_per_block: number of lines per block, a gzip member or a zstd frame.
+            Defaults to 1024.
+    """
+    kind = compression_type(filepath)
+    if kind is None:
+        raise ValueError(
+            f"{filepath} should end with one of {', '.join(COMPRESSION_SUFFIXES)}."
+        )
+
+    def _write(fp: IO[bytes]) -> None:
+        compressor = None if kind == "gzip" else _zstandard().ZstdCompressor()
+        with open(source_filepath, "rb") as source:
+            while True:
+                lines = list(itertools.islice(source, lines_per_block))
+                if not lines:
+                    break
+                block = b"".join(lines)
+                fp.write(
+                    gzip.compress(block)
+                    if compressor is None
+                    else compressor.compress(block)
+                )
+
+    atomic_write(filepath, _write)
@@ -23,27 +23,129 @@
 #
 """Dataset routines-filtering, dataset building."""
 
+import contextlib
+import functools
+import glob
+import itertools
 import json
 import logging
 import os
+from bisect import bisect_right
+from collections import deque
 from functools import lru_cache
 from pathlib import PosixPath
-from typing import Any, Callable, Dict, List, Union
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 import sentencepiece as _sentencepiece
+import numpy as np
 import pytorch_lightning as pl
+import torch.distributed as dist
 from datasets import DatasetDict
-from torch.utils.data import ConcatDataset, DataLoader, Dataset
-from transformers import (
-    AutoModelForSeq2SeqLM,
-    AutoTokenizer,
-    DataCollatorForLanguageModeling,
-    DataCollatorForPermutationLanguageModeling,
-    DataCollatorForSeq2Seq,
-    default_data_collator,
+from torch.utils.data import (
+    BatchSampler,
+    ConcatDataset,
+    DataLoader,
+    Dataset,
+    DistributedSampler,
+    Sampler,
+    SequentialSampler,
+    Subset,
 )
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 from transformers.tokenization_utils_base import BatchEncoding
 
+from .cache import CacheManager, entry_name, parse_size
+from .collators import (
+    BlockDiagonalAttentionCollator,
+    DecoderInputsFromLabels,
+    MaskedLanguageModelingCollator,
+    PermutationLanguageModelingCollator,
+    Seq2SeqCollator,
+    TensorCollator,
+    padding_values,
+    strip_padding,
+)
+from .columnar import (
+    ColumnarDataset,
+    columnar_filepaths,
+    is_columnar_dataset,
+    is_saved_dataset,
+    load_columnar_dataset,
+    tokenize_columnar_dataset,
+)
+from .compression import (
+    BlockReader,
+    compression_type,
+    is_dataset_file,
+    load_block_index,
+    open_dataset_file,
+)
+from .echoing import EchoingDataLoader
+from .indexing import MANIFEST_FILENAME, load_manifest, load_offset_index
+from .loading import (
+    dataloader_settings,
+    probe_dataloader_settings,
+    resolve_num_workers,
+    worker_payload_size,
+)
+from .memory import ExampleCache, total_statistics
+from .mixture import mixture_probabilities, parse_mixture
+from .packing import PackedDataset
+from .parsing import ExampleParser, parse_fields
+from .samplers import (
+    BlockShuffleSampler,
+    EvenBatchSampler,
+    LengthGroupedBatchSampler,
+    MixtureSampler,
+    ResumableBatchSampler,
+    TokenBudgetBatchSampler,
+    WorkerRoutedSampler,
+    dataset_lengths,
+    fetch_items,
+    padding_efficiency,
+)
+from .sharding import (
+    balanced_assignment,
+    broadcast_from_rank_zero,
+    distributed_world,
+    gather_across_ranks,
+    local_rank,
+    local_world_size,
+    max_across_ranks,
+    sum_across_ranks,
+)
+from .streaming import (
+    EchoingStreamingDataLoader,
+    StreamingDataLoader,
+    StreamingLMDataset,
+)
+from .tokenization import (
+    CausalLanguageModelingTokenizeFunction,
+    ConditionalGenerationTokenizeFunction,
+    TokenizeFunction,
+)
+from .tokenized import (
+    compute_fingerprint,
+    file_fingerprint,
+    load_tokenized_dataset,
+    node_cache_dir,
+    tokenizer_fingerprint,
+)
+
 # Sentencepiece has to be loaded before lightning
 _sentencepiece
 
@@ -58,19 +160,94 @@ class LMDataset(Dataset):
         self,
         filepath: str,
         tokenizer: Callable,
+        use_offset_index: bool = False,
+        length: Optional[int] = None,
+        parser: Optional[Callable[[bytes], Dict[str, Any]]] = None,
+        example_cache: Optional[ExampleCache] = None,
     ) -> None:
         """Initialize the LM data module.
         Args:
             filepath: path where the dataset is located.
             tokenizer: tokenize function to be used in the module.
+            use_offset_index: whether to read single examples through a memory-mapped
+                byte-offset index instead of loading the whole file in memory.
+                Defaults to False.
+            length: number of examples, if already known, to avoid counting them.
+                Defaults to None, a.k.a., count the examples.
+            parser: function parsing a JSON line in an example. Defaults to None,
+                a.k.a., json.loads.
+            example_cache: cache keeping tokenized examples in memory within a budget,
+                examples not cached being read through the offset index. Defaults to
+                None, a.k.a., no cache.
         """
 
         self.filepath = filepath
         self.tokenizer = tokenizer
-        self.length = LMDataset.count_examples(filepath)
+        self.parser = parser if parser is not None else json.loads
+        self.example_cache = example_cache
+
+        if not is_dataset_file(self.filepath):
+            raise ValueError(
+                f"{filepath} is not a .jsonl or a json, optionally compressed."
+            )
+
+        self.offsets: Optional[np.ndarray] = None
+        self.block_reader: Optional[BlockReader] = None
+        self._fp: Optional[IO[bytes]] = None
+        self._fp_pid: Optional[int] = None
+        if compression_type(filepath) is not None:
+            # compressed files are always read through their block index
+            self.block_reader = BlockReader(filepath)
+            self.block_reader.check_random_access()
+            self.length = len(self.block_reader)
+        elif use_offset_index or example_cache is not None:
+            # bounded memory rather than the whole file loaded in memory
+            self.offsets = load_offset_index(filepath)
+            self.length = len(self.offsets) - 1
+        elif length is not None:
+            self.length = length
+        else:
+            self.length = LMDataset.count_examples(filepath)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state to pickle, e.g., when spawning dataloader workers.
+        Returns:
+           state of the dataset without open file handles.
+        """
+        state = self.__dict__.copy()
+        state["_fp"] = None
+        state["_fp_pid"] = None
+        return state
+
+    @property
+    def random_access(self) -> bool:
+        """Whether single examples can be read without loading the whole file.
+        Returns:
+            whether the file has an offset or a block index.
+        """
+        return self.offsets is not None or self.block_reader is not None
+
+    def read_example(self, index: int) -> Dict[str, str]:
+        """Read a single instance using the offset or block index.
+        Args:
+            index: index of the instance.
+        Returns:
+           the instance.
+        """
+        if self.block_reader is not None:
+            return self.parser(self.block_reader.read_line(index))
+        if self.offsets is None:
+            raise ValueError("Reading single examples requires an offset index.")
 
-        if not self.filepath.endswith(".jsonl") and not self.filepath.endswith(".json"):
-            raise ValueError(f"{filepath} is not a .jsonl or a json.")
+        # file handles are opened per process, since forked workers would share the position
+        pid = os.getpid()
+        if self._fp is None or self._fp_pid != pid:
+            self._fp = open(self.filepath, "rb")
+            self._fp_pid = pid
+
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        self._fp.seek(start)
+        return self.parser(self._fp.read(end - start))
 
     @lru_cache()
     def examples_reader(self) -> List[Dict[str, str]]:
@@ -78,8 +255,8 @@ class LMDataset(Dataset):
         Returns:
            list of instances.
         """
-        with open(self.filepath) as fp:
-            return [json.loads(line.strip()) for line in fp]
+        with open(self.filepath, "rb") as fp:
+            return [self.parser(line) for line in fp]
 
     @staticmethod
     def count_examples(filepath: str) -> int:
@@ -89,6 +266,8 @@ class LMDataset(Dataset):
         Returns:
            number of examples existed in the given filepath.
         """
+        if compression_type(filepath) is not None:
+            return int(load_block_index(filepath)[0, -1])
 
         def _make_gen(reader):
             while True:
@@ -97,8 +276,15 @@ class LMDataset(Dataset):
                     break
                 yield b
 
+        count = 0
+        last_buffer = b""
         with open(filepath, "rb") as f:
-            count = sum(buf.count(b"\n") for buf in _make_gen(f.raw.read))  # type: ignore
+            for buf in _make_gen(f.raw.read):  # type: ignore
+                count += buf.count(b"\n")
+                last_buffer = buf
+        # a last line without a trailing newline is an example too
+        if last_buffer and not last_buffer.endswith(b"\n"):
+            count += 1
         return count
 
     def __len__(self) -> int:
@@ -115,16 +301,180 @@ class LMDataset(Dataset):
         Returns:
             tokenized item.
         """
+        if self.example_cache is not None:
+            example = self.example_cache.get((self.filepath, int(index)))
+            if example is not None:
+                return example
 
-        examples = self.examples_reader()
-        example = self.tokenizer(examples[index])
+        if self.random_access:
+            example = self.tokenizer(self.read_example(index))
+        else:
+            examples = self.examples_reader()
+            example = self.tokenizer(examples[index])
 
+        if self.example_cache is not None:
+            self.example_cache.put((self.filepath, int(index)), example)
         return example
 
+    def __getitems__(self, indices: List[int]) -> List[BatchEncoding]:
+        """Get several items of the dataset, tokenizing at once those not cached.
+        Args:
+            indices: indices of the items.
+        Returns:
+            tokenized items.
+        """
+        if self.example_cache is None:
+            return self.tokenize_items(indices)
+
+        items = [
+            self.example_cache.get((self.filepath, int(index))) for index in indices
+        ]
+        missing = [position for position, item in enumerate(items) if item is None]
+        if missing:
+            tokenized = self.tokenize_items([indices[position] for position in missing])
+            for position, item in zip(missing, tokenized):
+                items[position] = item
+                self.example_cache.put((self.filepath, int(indices[position])), item)
+        return items  # type: ignore
+
+    def tokenize_items(self, indices: List[int]) -> List[BatchEncoding]:
+        """Read and tokenize several items of the dataset at once.
+        Args:
+            indices: indices of the items.
+        Returns:
+            tokenized items.
+        """
+        if self.random_access:
+            examples = [self.read_example(index) for index in indices]
+        else:
+            all_examples = self.examples_reader()
+            examples = [all_examples[index] for index in indices]
+        if not examples:
+            return []
+
+        # a single tokenizer call on the columns of the examples
+        columns = {key: [example[key] for example in examples] for key in examples[0]}
+        batch = self.tokenizer(columns)
+        return [
+            BatchEncoding(data={key: values[position] for key, values in batch.items()})
+            for position in range(len(examples))
+        ]
+
+
+class LazyConcatDataset(ConcatDataset):
+    """Concatenation of datasets built only when their examples are first accessed."""
+
+    def __init__(
+        self,
+        filepaths: List[str],
+        lengths: Sequence[int],
+        build_function: Callable[..., Dataset],
+    ) -> None:
+        """Initialize the lazy concatenation.
+        Args:
+            filepaths: paths of the files of the datasets.
+            lengths: number of examples of each file.
+            build_function: function building the dataset of a file given its path and,
+                as keyword argument, length.
+        """
+        # ConcatDataset.__init__ is not called since it would build every dataset
+        self.filepaths = filepaths
+        self.build_function = build_function
+        self.cumulative_sizes = np.cumsum(lengths, dtype=np.int64).tolist()
+        self._datasets: Dict[int, Dataset] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state to pickle, e.g., when spawning dataloader workers.
+        Returns:
+           state of the dataset without the datasets built so far.
+        """
+        state = self.__dict__.copy()
+        state["_datasets"] = {}
+        return state
+
+    def dataset(self, dataset_index: int) -> Dataset:
+        """Get a dataset, building it on first access.
+        Args:
+            dataset_index: index of the dataset.
+        Returns:
+            the dataset.
+        """
+        if dataset_index not in self._datasets:
+            start = self.cumulative_sizes[dataset_index - 1] if dataset_index > 0 else 0
+            self._datasets[dataset_index] = self.build_function(
+                self.filepaths[dataset_index],
+                length=self.cumulative_sizes[dataset_index] - start,
+            )
+        return self._datasets[dataset_index]
+
+    @property
+    def datasets(self) -> List[Dataset]:  # type: ignore
+        """All the datasets, building the ones not accessed yet.
+        Returns:
+            the datasets.
+        """
+        return [self.dataset(index) for index in range(len(self.filepaths))]
+
+    def __getitem__(self, index: int) -> Any:
+        """Get an item of the dataset.
+        Args:
+            index: index of the item.
+        Returns:
+            the item of the dataset containing it.
+        """
+        if index < 0:
+            if -index > len(self):
+                raise ValueError(
+                    "absolute value of index should not exceed dataset length"
+                )
+            index = len(self) + index
+        dataset_index = bisect_right(self.cumulative_sizes, index)
+        start = self.cumulative_sizes[dataset_index - 1] if dataset_index > 0 else 0
+        return self.dataset(dataset_index)[index - start]
+
+    def __getitems__(self, indices: List[int]) -> List[Any]:
+        """Get several items, fetching them at once from each dataset containing them.
+        Args:
+            indices: indices of the items.
+        Returns:
+            the items, in the order of the indices.
+        """
+        positions_by_dataset: Dict[int, List[int]] = {}
+        local_indices_by_dataset: Dict[int, List[int]] = {}
+        for position, index in enumerate(indices):
+            if index < 0:
+                index += len(self)
+            dataset_index = bisect_right(self.cumulative_sizes, index)
+            start = self.cumulative_sizes[dataset_index - 1] if dataset_index > 0 else 0
+            positions_by_dataset.setdefault(dataset_index, []).append(position)
+            local_indices_by_dataset.setdefault(dataset_index, []).append(index - start)
+
+        items: List[Any] = [None] * len(indices)
+        for dataset_index, positions in positions_by_dataset.items():
+            dataset_items = fetch_items(
+                self.dataset(dataset_index), local_indices_by_dataset[dataset_index]
+            )
+            for position, item in zip(positions, dataset_items):
+                items[position] = item
+        return items
+
+
+def is_glob_pattern(path: str) -> bool:
+    """Check whether a path is a glob pattern.
+    Args:
+        path: path to check.
+    Returns:
+        whether the path contains glob wildcards.
+    """
+    return any(character in path for character in "*?[")
+
 
 class DataModule(pl.LightningDataModule):
     """Pytorch-lightning-style data module for LM dataset."""
 
+    # tokenize function held by the datasets
+    tokenize_function_class: Type[TokenizeFunction] = TokenizeFunction
+
     def __init__(self, dataset_args: Dict[str, Any], tokenizer: AutoTokenizer) -> None:
         """Initialize the data module.
         Args:
@@ -140,39 +490,473 @@ class DataModule(pl.LightningDataModule):
 
         self.tokenizer = tokenizer
 
-        self.data_collator = default_data_collator
-
-        if "num_dataloader_workers" not in self.dataset_args:
-            self.dataset_args["num_dataloader_workers"] = 0
-
-            cpus_count = os.cpu_count()
-            if cpus_count is not None:
-                self.dataset_args["num_dataloader_workers"] = min(
-                    self.dataset_args["num_dataloader_workers"], cpus_count
-                )
-
-    def build_dataset(self, path: Union[str, PosixPath]) -> Dataset:
+        self.data_collator: Callable = TensorCollator()
+
+        self.datasets: Dict[str, Dataset] = {}
+        self.lengths: Dict[str, np.ndarray] = {}
+
+        # number of DDP processes the datasets are sharded across
+        self.num_replicas = 1
+
+        # training batches consumed in the current epoch, stored in the checkpoints
+        self.consumed_epoch = 0
+        self.consumed_batches = 0
+        self._resume_state: Optional[Dict[str, Any]] = None
+
+        # resolved when the first dataloader is built, once DDP is initialized
+        self._dataloader_settings: Optional[Dict[str, Any]] = None
+
+        # mixture of training sources and tokens consumed from each one by this process
+        self.mixture_sources: List[str] = []
+        self.mixture_probabilities: Optional[np.ndarray] = None
+        self.mixture_sampler: Optional[MixtureSampler] = None
+        self.source_tokens = np.zeros(0, dtype=np.int64)
+
+        # tokenized validation examples sorted by length, read on the first round
+        self._validation_examples: Optional[List[Dict[str, Any]]] = None
+
+        # splits whose worker payload size has been logged
+        self._logged_payloads: Set[str] = set()
+
+        # tokenized examples kept in memory by each process reading them, the budget
+        # of the node being split among them when building the dataloaders. Each split
+        # has its own cache, counting its own hits and misses, and the datasets being
+        # built use the one of the training split unless set by split_example_cache
+        self.example_caches: Dict[str, ExampleCache] = {}
+        self.example_cache: Optional[ExampleCache] = None
+        self.example_cache_size: Optional[int] = None
+        example_cache_size = self.dataset_args.get("example_cache_size", None)
+        if example_cache_size is not None:
+            self.example_cache_size = parse_size(example_cache_size)
+            self.example_caches = {
+                split: ExampleCache(self.example_cache_size)
+                for split in ["train", "validation"]
+            }
+            self.example_cache = self.example_caches["train"]
+
+        # training batches yielded by the echoing dataloader, whether fresh and their
+        # echo factor, consumed in order before their transfer to the device
+        self.echoes: Deque[Tuple[bool, int]] = deque()
+        self.echo_factor = 1
+
+        # entries of the tokenized cache used by the datasets, never evicted, and the
+        # leases of the entries of columnar datasets, see CacheManager.lease
+        self._tokenized_cache_entries: Set[str] = set()
+        self._tokenized_cache_leases: Dict[str, IO] = {}
+
+    def build_dataset(
+        self, path: Union[str, PosixPath], num_replicas: int = 1, rank: int = 0
+    ) -> Dataset:
         """
         Build the dataset.
         Args:
             path: path where the dataset is located.
+            num_replicas: number of DDP processes the files are sharded across.
+                Defaults to 1, a.k.a., no sharding.
+            rank: rank of the current process. Defaults to 0.
         Returns:
             a torch Dataset.
         """
         path = str(path)
-        if path.endswith(".jsonl") or path.endswith(".json"):
-            return LMDataset(path, self.tokenize_function)
-        elif os.path.isdir(path):
+        if is_columnar_dataset(path):
+            if self.dataset_args.get("streaming", False):
+                raise ValueError(
+                    f"{path} is a columnar dataset, memory-mapped rather than streamed."
+                )
+            dataset = self.build_columnar_dataset(path)
+            if num_replicas > 1:
+                return Subset(
+                    dataset,
+                    range(
+                        len(dataset) * rank // num_replicas,
+                        len(dataset) * (rank + 1) // num_replicas,
+                    ),
+                )
+            return dataset
+        if self.dataset_args.get("streaming", False):
+            return StreamingLMDataset(  # type: ignore
+                self.dataset_filepaths(path),
+                self.build_tokenize_function(),
+                shuffle_buffer_size=self.dataset_args.get("shuffle_buffer_size", 0),
+                parser=self.example_parser(),
+            )
+        if num_replicas > 1:
+            return self.build_rank_shard(path, num_replicas, rank)
+        if is_glob_pattern(path) or os.path.isdir(path):
+            return self.build_files_dataset(
+                self.dataset_filepaths(path),
+                os.path.join(self.dataset_directory(path), MANIFEST_FILENAME),
+            )
+        elif is_dataset_file(path):
+            return self.build_file_dataset(path)
+        else:
+            raise TypeError(f"{path} type is not supported for dataset")
+
+    def build_columnar_dataset(self, path: str) -> ColumnarDataset:
+        """
+        Build the dataset of Arrow or Parquet files, or of a saved datasets folder.
+
+        Only the fields used by the tokenize function are read, the tokenized examples
+        are cached next to the files, or in the tokenized cache directory if configured,
+        and memory-mapped.
+
+        Args:
+            path: path where the dataset is located.
+        Returns:
+            the memory-mapped tokenized dataset.
+        """
+        tokenized_cache_dir = self.tokenized_cache_dir()
+        dataset = load_columnar_dataset(
+            path, self.example_fields(), cache_dir=tokenized_cache_dir
+        )
+        cache_file_name = None
+        if tokenized_cache_dir is not None:
+            filepaths = (
+                sorted(glob.glob(os.path.join(path, "*.arrow")))
+                if is_saved_dataset(path)
+                else columnar_filepaths(path)
+            )
+            fingerprint = compute_fingerprint(
+                {
+                    "files": [file_fingerprint(filepath) for filepath in filepaths],
+                    "fields": self.example_fields(),
+                    **self.tokenization_parameters(),
+                }
+            )
+            cache_file_name = os.path.join(
+                tokenized_cache_dir, f"columnar-{fingerprint}.arrow"
+            )
+            self.lease_tokenized_cache(f"columnar-{fingerprint}")
+        tokenized = tokenize_columnar_dataset(
+            dataset,
+            self.build_tokenize_function(),
+            num_proc=self.dataset_args.get("preprocessing_num_workers", 1),
+            cache_file_name=cache_file_name,
+        )
+        if tokenized_cache_dir is not None:
+            # converted and tokenized files stored in the cache
+            for cache_file in dataset.cache_files + tokenized.cache_files:
+                name = entry_name(tokenized_cache_dir, cache_file["filename"])
+                if name is not None:
+                    self._tokenized_cache_entries.add(name)
+                    self.lease_tokenized_cache(name)
+        return ColumnarDataset(tokenized)
+
+    def lease_tokenized_cache(self, name: str) -> None:
+        """Lease an entry of the tokenized cache as long as the data module is used.
+        Args:
+            name: name of the entry.
+        """
+        if name not in self._tokenized_cache_leases:
+            manager = CacheManager(self.tokenized_cache_dir())  # type: ignore
+            self._tokenized_cache_leases[name] = manager.lease(name)
+
+    def build_files_dataset(self, filepaths: List[str], manifest_path: str) -> Dataset:
+        """
+        Build the dataset of a set of files.
+        Args:
+            filepaths: paths of the files.
+            manifest_path: path of the manifest storing the number of examples of the files.
+        Returns:
+            a dataset concatenating the files, opened on first access.
+        """
+        if self.tokenized_cache_dir() is not None:
+            # shards are tokenized upfront rather than on first access in a worker
             return ConcatDataset(
-                datasets=[
-                    LMDataset(os.path.join(path, filename), self.tokenize_function)
-                    for filename in os.listdir(path)
-                    if filename.endswith(".jsonl") or filename.endswith(".json")
-                ]
+                datasets=[self.build_file_dataset(filepath) for filepath in filepaths]
             )
+        manifest = load_manifest(
+            filepaths, LMDataset.count_examples, manifest_path=manifest_path
+        )
+        # the files are opened in the workers, with the same datasets as build_file_dataset
+        return LazyConcatDataset(
+            filepaths,
+            [manifest[filepath]["lines"] for filepath in filepaths],
+            functools.partial(
+                LMDataset,
+                tokenizer=self.build_tokenize_function(),
+                use_offset_index=self.dataset_args.get("use_offset_index", False),
+                parser=self.example_parser(),
+                example_cache=self.example_cache,
+            ),
+        )
+
+    def build_rank_shard(self, path: str, num_replicas: int, rank: int) -> Dataset:
+        """
+        Build the shard of a dataset read by a DDP process.
+
+        Files are assigned on rank 0, balancing their sizes as a proxy of their number
+        of tokens, and broadcast, so that each process only counts and opens its files.
+        With fewer files than processes, the examples are split in contiguous ranges.
+
+        Args:
+            path: path where the dataset is located.
+            num_replicas: number of DDP processes.
+            rank: rank of the current process.
+        Returns:
+            the dataset of the files of the process.
+        """
+        filepaths = self.dataset_filepaths(path)
+        if len(filepaths) < num_replicas:
+            dataset: ConcatDataset = ConcatDataset(
+                [self.build_file_dataset(filepath) for filepath in filepaths]
+            )
+            return Subset(
+                dataset,
+                range(
+                    len(dataset) * rank // num_replicas,
+                    len(dataset) * (rank + 1) // num_replicas,
+                ),
+            )
+
+        assignment = broadcast_from_rank_zero(
+            lambda: balanced_assignment(
+                [os.path.getsize(filepath) for filepath in filepaths], num_replicas
+            )
+        )
+        shard_filepaths = [filepaths[index] for index in assignment[rank]]
+        logger.info(
+            f"Rank {rank} reads {len(shard_filepaths)} of {len(filepaths)} files of {path}"
+        )
+        # a manifest per rank, since processes update them concurrently
+        root, extension = os.path.splitext(MANIFEST_FILENAME)
+        manifest_filename = f"{root}.{rank}-of-{num_replicas}{extension}"
+        return self.build_files_dataset(
+            shard_filepaths,
+            os.path.join(self.dataset_directory(path), manifest_filename),
+        )
+
+    def dataset_filepaths(self, path: str) -> List[str]:
+        """
+        List the files of a dataset.
+        Args:
+            path: path where the dataset is located, a file, a directory or a glob
+                pattern, recursive if it contains "**".
+        Returns:
+            the sorted paths of the files of the dataset.
+        """
+        if is_glob_pattern(path):
+            filepaths = glob.glob(path, recursive=True)
+        elif is_dataset_file(path):
+            return [path]
+        elif os.path.isdir(path):
+            filepaths = [os.path.join(path, filename) for filename in os.listdir(path)]
         else:
             raise TypeError(f"{path} type is not supported for dataset")
 
+        # hidden files, e.g., the manifest or temporary files, are not part of the dataset
+        filepaths = sorted(
+            filepath
+            for filepath in filepaths
+            if is_dataset_file(filepath)
+            and not os.path.basename(filepath).startswith(".")
+            and os.path.isfile(filepath)
+        )
+        if not filepaths:
+            raise ValueError(
+                f"No .jsonl or .json files, optionally compressed, found in {path}"
+            )
+        return filepaths
+
+    @staticmethod
+    def dataset_directory(path: str) -> str:
+        """
+        Get the directory containing the files of a dataset.
+        Args:
+            path: path where the dataset is located, a directory or a glob pattern.
+        Returns:
+            the directory, for glob patterns the longest path without wildcards.
+        """
+        if not is_glob_pattern(path):
+            return path
+        parts = path.split(os.sep)
+        prefix = []
+        for part in parts:
+            if is_glob_pattern(part):
+                break
+            prefix.append(part)
+        return os.sep.join(prefix) or os.curdir
+
+    def sample_texts(self, number_of_examples: int) -> List[str]:
+        """
+        Sample texts from the first examples of the training set.
+        Args:
+            number_of_examples: number of examples to sample.
+        Returns:
+            the text fields of the sampled examples.
+        """
+        path = str(self.dataset_args["train_file"])
+        mixture = parse_mixture(path)
+        if mixture is not None:
+            path = mixture[0][0]
+        texts: List[str] = []
+        if is_columnar_dataset(path):
+            examples = load_columnar_dataset(path, self.example_fields())
+            for example in examples.select(
+                range(min(number_of_examples, len(examples)))
+            ):
+                texts.extend(
+                    value for value in example.values() if isinstance(value, str)
+                )
+            return texts
+        filepath = self.dataset_filepaths(path)[0]
+        with open_dataset_file(filepath) as fp:
+            for line in itertools.islice(fp, number_of_examples):
+                if line.strip():
+                    texts.extend(
+                        value
+                        for value in json.loads(line).values()
+                        if isinstance(value, str)
+                    )
+        return texts
+
+    def build_file_dataset(
+        self, filepath: str, length: Optional[int] = None
+    ) -> Dataset:
+        """
+        Build the dataset for a single file.
+        Args:
+            filepath: path of the file.
+            length: number of examples of the file, if already known. Defaults to None.
+        Returns:
+            a torch Dataset, pre-tokenized if a tokenized cache directory is configured.
+        """
+        tokenized_cache_dir = self.tokenized_cache_dir()
+        if tokenized_cache_dir is not None:
+            dataset = load_tokenized_dataset(
+                filepath,
+                self.build_tokenize_function(),
+                cache_dir=tokenized_cache_dir,
+                parameters=self.tokenization_parameters(),
+                num_workers=self.dataset_args.get("preprocessing_num_workers", 1),
+                parser=self.example_parser(),
+                build=self.builds_tokenized_cache(),
+                timeout=self.dataset_args.get("tokenized_cache_timeout", 3600.0),
+            )
+            self._tokenized_cache_entries.add(os.path.basename(dataset.directory))
+            return dataset
+        return LMDataset(
+            filepath,
+            self.build_tokenize_function(),
+            use_offset_index=self.dataset_args.get("use_offset_index", False),
+            length=length,
+            parser=self.example_parser(),
+            example_cache=self.example_cache,
+        )
+
+    def tokenized_cache_dir(self) -> Optional[str]:
+        """Directory of the tokenized caches.
+        Returns:
+            the configured directory, a shared memory one for node-shared caches without
+            a configured directory, None if datasets are not pre-tokenized.
+        """
+        tokenized_cache_dir = self.dataset_args.get("tokenized_cache_dir", None)
+        if tokenized_cache_dir is None and self.dataset_args.get(
+            "node_shared_cache", False
+        ):
+            return node_cache_dir()
+        return tokenized_cache_dir
+
+    def manage_tokenized_cache(self) -> None:
+        """Record the use of the tokenized caches and evict unused ones beyond the budget.
+
+        The entries used by any process are kept, and a single process per node evicts,
+        since caches can be stored in node-local directories.
+        """
+        tokenized_cache_dir = self.tokenized_cache_dir()
+        if tokenized_cache_dir is None:
+            return
+        max_size = self.dataset_args.get("tokenized_cache_max_size", None)
+        manager = CacheManager(
+            tokenized_cache_dir,
+            max_size=parse_size(max_size) if max_size is not None else None,
+        )
+        manager.touch(self._tokenized_cache_entries)
+        if manager.max_size is None:
+            return
+        in_use = set().union(
+            *gather_across_ranks(sorted(self._tokenized_cache_entries))
+        )
+        if local_rank() == 0:
+            manager.evict(keep=in_use)
+
+    def builds_tokenized_cache(self) -> bool:
+        """Whether the current process tokenizes the files missing from the cache.
+
+        With node-shared caches only the first process of each node tokenizes, the
+        others wait for the cache and memory-map it, sharing its pages. Files sharded by
+        rank differ across processes, so each process tokenizes its own.
+        Returns:
+            whether missing caches are built by the current process.
+        """
+        if (
+            not self.dataset_args.get("node_shared_cache", False)
+            or self.num_replicas > 1
+        ):
+            return True
+        return local_rank() == 0
+
+    def example_fields(self) -> List[str]:
+        """Fields of the examples used by the tokenize function.
+        Returns:
+            the configured fields, the text field by default.
+        """
+        return parse_fields(self.dataset_args.get("json_fields", None)) or ["text"]
+
+    def example_parser(self) -> ExampleParser:
+        """Parser of the JSON lines of the datasets.
+        Returns:
+            a parser keeping only the fields used by the tokenize function.
+        """
+        return ExampleParser(
+            backend=self.dataset_args.get("json_backend", "auto"),
+            fields=self.example_fields(),
+        )
+
+    def tokenization_parameters(self) -> Dict[str, Any]:
+        """Parameters affecting the output of the tokenize function.
+        Returns:
+            parameters used to fingerprint tokenized caches.
+        """
+        return {
+            "data_module": type(self).__name__,
+            "tokenizer": tokenizer_fingerprint(self.tokenizer),
+            "truncation": self.dataset_args.get("truncation", True),
+            "padding": self.padding(),
+            "max_length": self.dataset_args.get("max_length", 512),
+        }
+
+    def padding(self) -> Union[bool, str]:
+        """Padding strategy applied at tokenization time.
+        Returns:
+            no padding when padding dynamically in the collator or packing examples,
+            the configured padding otherwise.
+        """
+        if self.dataset_args.get("dynamic_padding", False) or self.dataset_args.get(
+            "packing", False
+        ):
+            return False
+        return self.dataset_args.get("padding", "max_length")
+
+    def pad_to_multiple_of(self) -> Optional[int]:
+        """Multiple dynamically padded lengths are rounded to.
+        Returns:
+            the configured multiple, if any.
+        """
+        return self.dataset_args.get("pad_to_multiple_of", None)
+
+    def build_tokenize_function(self) -> TokenizeFunction:
+        """Build the tokenize function held by the datasets.
+        Returns:
+            the tokenize function, carrying the tokenizer and the tokenization settings only.
+        """
+        return self.tokenize_function_class(
+            self.tokenizer,
+            truncation=self.dataset_args.get("truncation", True),
+            padding=self.padding(),
+            max_length=self.dataset_args.get("max_length", 512),
+        )
+
     def tokenize_function(
         self, examples: Dict[str, Union[int, slice]]
     ) -> BatchEncoding:
@@ -182,52 +966,766 @@ class DataModule(pl.LightningDataModule):
         Returns:
             tokenized examples.
         """
+        return self.build_tokenize_function()(examples)
 
-        truncation = self.dataset_args.get("truncation", True)
-        padding = self.dataset_args.get("padding", "max_length")
-        max_length = self.dataset_args.get("max_length", 512)
+    def load(self) -> None:
+        """Load datasets from the given files."""
+
+        if self.dataset_args.get("streaming", False):
+            self.load_streaming()
+            return
+
+        if self.dataset_args.get("shard_by_rank", False):
+            # the processes are known only once DDP is initialized
+            logger.info("Datasets are sharded by rank when setting up the data module")
+            return
+
+        self.load_datasets()
+
+    def setup(self, stage: Optional[str] = None) -> None:
+        """Set up the data module in each process, loading the datasets sharded by rank if requested.
+        Args:
+            stage: stage being set up, unused.
+        """
+        if self.dataset_args.get("shard_by_rank", False) and not self.datasets:
+            self.load_datasets(*distributed_world())
+
+    def load_datasets(self, num_replicas: int = 1, rank: int = 0) -> None:
+        """Load the training and validation datasets, optionally sharded by rank.
+        Args:
+            num_replicas: number of DDP processes. Defaults to 1, a.k.a., no sharding.
+            rank: rank of the current process. Defaults to 0.
+        """
+        self.num_replicas = num_replicas
+        self._validation_examples = None
+        self._tokenized_cache_entries = set()
+        for lease in self._tokenized_cache_leases.values():
+            lease.close()
+        self._tokenized_cache_leases = {}
+        train = self.build_training_dataset(num_replicas, rank)
+        with self.split_example_cache("validation"):
+            validation = self.build_dataset(
+                self.dataset_args["validation_file"], num_replicas, rank
+            )
+        self.datasets = {
+            "train": train,
+            "validation": validation,
+        }
+        self.manage_tokenized_cache()
 
-        return self.tokenizer(  # type: ignore
-            examples["text"],
-            truncation=truncation,
-            padding=padding,
-            max_length=max_length,
+        logger.info(
+            f"Training set size: {len(self.datasets['train'])} - Validation set size: {len(self.datasets['validation'])}"  # type: ignore
         )
 
-    def load(self) -> None:
-        """Load datasets from the given files."""
+        if self.dataset_args.get("packing", False):
+            self.datasets = {
+                split: self.pack(dataset) for split, dataset in self.datasets.items()
+            }
+
+        self.lengths = {}
+        if (
+            self.dataset_args.get("group_by_length", False)
+            or self.dataset_args.get("max_tokens_per_batch", None) is not None
+        ):
+            for split, dataset in self.datasets.items():
+                self.lengths[split] = dataset_lengths(dataset)
+
+    @contextlib.contextmanager
+    def split_example_cache(self, split: str) -> Iterator[None]:
+        """Build datasets reading examples through the example cache of a split.
+        Args:
+            split: dataset split, train or validation.
+        Returns:
+            a context manager setting the example cache of the datasets being built.
+        """
+        example_cache = self.example_cache
+        self.example_cache = self.example_caches.get(split)
+        try:
+            yield
+        finally:
+            self.example_cache = example_cache
+
+    def build_training_dataset(self, num_replicas: int = 1, rank: int = 0) -> Dataset:
+        """Build the training dataset, concatenating its sources if it is a mixture.
+        Args:
+            num_replicas: number of DDP processes the files are sharded across.
+                Defaults to 1, a.k.a., no sharding.
+            rank: rank of the current process. Defaults to 0.
+        Returns:
+            a torch Dataset.
+        Raises:
+            ValueError: in case options not supported with mixtures are requested.
+        """
+        mixture = parse_mixture(str(self.dataset_args["train_file"]))
+        if mixture is None:
+            return self.build_dataset(
+                self.dataset_args["train_file"], num_replicas, rank
+            )
+
+        for option in [
+            "shard_by_rank",
+            "packing",
+            "group_by_length",
+            "max_tokens_per_batch",
+            "shuffle_block_size",
+        ]:
+            if self.dataset_args.get(option, None):
+                raise ValueError(
+                    f"{option} is not supported with mixtures of training sources."
+                )
+        datasets = [self.build_dataset(path) for path, _ in mixture]
+        self.mixture_sources = [path for path, _ in mixture]
+        self.mixture_probabilities = mixture_probabilities(
+            [len(dataset) for dataset in datasets],  # type: ignore
+            [weight for _, weight in mixture],
+            temperature=self.dataset_args.get("mixture_temperature", 1.0),
+        )
+        self.source_tokens = np.zeros(len(mixture), dtype=np.int64)
+        for path, dataset, probability in zip(
+            self.mixture_sources, datasets, self.mixture_probabilities
+        ):
+            logger.info(
+                f"Mixture source {path}: {len(dataset)} examples, "  # type: ignore
+                f"sampled with probability {probability:.4f}"
+            )
+        return ConcatDataset(datasets)
+
+    def load_streaming(self) -> None:
+        """Load streaming datasets from the given files, without scanning them.
+        Raises:
+            ValueError: in case options requiring random access are requested.
+        """
+        for option in [
+            "tokenized_cache_dir",
+            "node_shared_cache",
+            "group_by_length",
+            "max_tokens_per_batch",
+            "packing",
+        ]:
+            if self.dataset_args.get(option, None):
+                raise ValueError(f"{option} is not supported with streaming datasets.")
+        if parse_mixture(str(self.dataset_args["train_file"])) is not None:
+            raise ValueError("Mixtures of training sources require random access.")
 
         self.datasets = {
             "train": self.build_dataset(self.dataset_args["train_file"]),
             "validation": self.build_dataset(self.dataset_args["validation_file"]),
         }
+        # validation rounds have to be comparable
+        self.datasets["validation"].shuffle_buffer_size = 0  # type: ignore
+        self.lengths = {}
 
         logger.info(
-            f"Training set size: {len(self.datasets['train'])} - Validation set size: {len(self.datasets['validation'])}"  # type: ignore
+            f"Streaming training set from {len(self.datasets['train'].filepaths)} files - "  # type: ignore
+            f"Streaming validation set from {len(self.datasets['validation'].filepaths)} files"  # type: ignore
         )
 
+    def pack(self, dataset: Dataset) -> PackedDataset:
+        """Pack the examples of a dataset in rows of max_length tokens.
+        Args:
+            dataset: dataset of tokenized examples.
+        Returns:
+            the packed dataset.
+        Raises:
+            NotImplementedError: in case packing is not supported by the data module.
+        """
+        raise NotImplementedError(
+            f"Packing is not supported by {type(self).__name__}, only by CLM and MLM."
+        )
+
+    def build_packed_dataset(
+        self, dataset: Dataset, separator_token_id: Optional[int]
+    ) -> PackedDataset:
+        """Build a packed dataset using the packing arguments.
+        Args:
+            dataset: dataset of tokenized examples.
+            separator_token_id: token separating packed examples.
+        Returns:
+            the packed dataset.
+        """
+        return PackedDataset(
+            dataset,
+            max_length=self.dataset_args.get("max_length", 512),
+            pad_values=padding_values(self.tokenizer),
+            separator_token_id=separator_token_id,
+            position_ids=self.dataset_args.get("packing_position_ids", False),
+            document_ids=self.dataset_args.get("packing_block_attention", False),
+        )
+
+    def batch_collator(self, collator: Optional[Callable] = None) -> Callable:
+        """Collator used by the dataloaders.
+        Args:
+            collator: collator of the examples. Defaults to None, a.k.a., the data
+                collator of the data module.
+        Returns:
+            the data collator, padding dynamically each batch and building
+            block-diagonal attention masks for packed examples if requested.
+        Raises:
+            ValueError: in case dynamic padding is requested for a collator other than
+                a TensorCollator.
+        """
+        collator = collator if collator is not None else self.data_collator
+        if self.dataset_args.get("dynamic_padding", False):
+            if not isinstance(collator, TensorCollator):
+                raise ValueError("Dynamic padding requires a TensorCollator.")
+            # padded while stacking, without intermediate padded lists
+            collator = collator.with_padding(self.tokenizer, self.pad_to_multiple_of())
+        if self.dataset_args.get("packing", False) and self.dataset_args.get(
+            "packing_block_attention", False
+        ):
+            collator = BlockDiagonalAttentionCollator(collator)
+        return collator
+
+    def echo_collators(self) -> Tuple[Callable, Optional[Callable]]:
+        """Collator of the echoed batches and transform applied to each echo.
+        Returns:
+            the batch collator and no transform, echoes being identical.
+        """
+        return self.batch_collator(), None
+
+    def build_batch_sampler(
+        self, split: str, shuffle: bool, start_batch: int = 0, num_workers: int = 1
+    ) -> Optional[BatchSampler]:
+        """Build the batch sampler for a split.
+        Args:
+            split: dataset split, train or validation.
+            shuffle: whether to shuffle the batches.
+            start_batch: number of batches of the first epoch to skip. Defaults to 0.
+            num_workers: number of dataloader workers examples are routed to, see
+                routing_workers. Defaults to 1.
+        Returns:
+            a token-budget or a length-grouped batch sampler if requested, otherwise None.
+        """
+        if split not in self.lengths:
+            return None
+
+        sampler = SequentialSampler(self.datasets[split])  # type: ignore
+        bucket_size_multiplier = self.dataset_args.get("bucket_size_multiplier", 100)
+        # same seed as the samplers set up by lightning
+        seed = int(os.getenv("PL_GLOBAL_SEED", 0))
+        batch_sampler: Union[LengthGroupedBatchSampler, TokenBudgetBatchSampler]
+        if self.dataset_args.get("max_tokens_per_batch", None) is not None:
+            batch_sampler = TokenBudgetBatchSampler(
+                sampler,
+                max_tokens=self.dataset_args["max_tokens_per_batch"],
+                lengths=self.lengths[split],
+                pad_to_multiple_of=self.pad_to_multiple_of(),
+                bucket_size_multiplier=bucket_size_multiplier,
+                shuffle=shuffle,
+                seed=seed,
+                start_batch=start_batch,
+                num_workers=num_workers,
+            )
+        else:
+            batch_sampler = LengthGroupedBatchSampler(
+                sampler,
+                batch_size=self.batch_size(split),
+                drop_last=False,
+                lengths=self.lengths[split],
+                bucket_size_multiplier=bucket_size_multiplier,
+                shuffle=shuffle,
+                seed=seed,
+                start_batch=start_batch,
+                num_workers=num_workers,
+            )
+        if self.dataset_args.get("dynamic_padding", False):
+            efficiency = padding_efficiency(
+                batch_sampler.batches(), self.lengths[split], self.pad_to_multiple_of()
+            )
+            logger.info(f"Padding efficiency of {split} batches: {efficiency:.3f}")
+        return batch_sampler
+
+    def build_block_shuffle_sampler(
+        self, dataset: Dataset, start_batch: int = 0, num_workers: int = 1
+    ) -> Optional[BlockShuffleSampler]:
+        """Build the sampler shuffling blocks of contiguous examples, if requested.
+        Args:
+            dataset: dataset to sample.
+            start_batch: number of batches of the first epoch to skip. Defaults to 0.
+            num_workers: number of dataloader workers examples are routed to, see
+                routing_workers. Defaults to 1.
+        Returns:
+            the block-shuffle sampler, None if not requested or for streaming datasets.
+        """
+        block_size = self.dataset_args.get("shuffle_block_size", None)
+        if block_size is None or isinstance(dataset, StreamingLMDataset):
+            return None
+        # sharded datasets are already local to the process
+        num_replicas, rank = (1, 0) if self.num_replicas > 1 else distributed_world()
+        return BlockShuffleSampler(
+            dataset,
+            block_size=block_size,
+            window_blocks=self.dataset_args.get("shuffle_window_blocks", 16),
+            num_replicas=num_replicas,
+            rank=rank,
+            # same seed as the samplers set up by lightning
+            seed=int(os.getenv("PL_GLOBAL_SEED", 0)),
+            start_index=start_batch * self.dataset_args["batch_size"],
+            batch_size=self.dataset_args["batch_size"],
+            num_workers=num_workers,
+        )
+
+    def build_mixture_sampler(
+        self, dataset: Dataset, start_batch: int = 0, num_workers: int = 1
+    ) -> Optional[MixtureSampler]:
+        """Build the sampler of a mixture of training sources.
+        Args:
+            dataset: concatenation of the sources.
+            start_batch: number of batches of the first epoch to skip. Defaults to 0.
+            num_workers: number of dataloader workers examples are routed to, see
+                routing_workers. Defaults to 1.
+        Returns:
+            the mixture sampler.
+        """
+        if self.mixture_probabilities is None:
+            return None
+        self.mixture_sampler = MixtureSampler(
+            dataset,  # type: ignore
+            self.mixture_probabilities,
+            # same seed as the samplers set up by lightning
+            seed=int(os.getenv("PL_GLOBAL_SEED", 0)),
+            start_index=start_batch * self.dataset_args["batch_size"],
+            batch_size=self.dataset_args["batch_size"],
+            num_workers=num_workers,
+        )
+        return self.mixture_sampler
+
+    def count_source_tokens(self, batch: Dict[str, Any]) -> None:
+        """Add the tokens of a batch to the tokens consumed from each mixture source.
+        Args:
+            batch: batch of examples drawn by the mixture sampler.
+        """
+        if self.mixture_sampler is None:
+            return
+        # batches are consumed in the order the sampler drew their examples
+        sources = [
+            self.mixture_sampler.sources.popleft()
+            for _ in range(len(batch["input_ids"]))
+        ]
+        if "attention_mask" in batch:
+            tokens = batch["attention_mask"].sum(dim=1)
+        else:
+            tokens = (batch["input_ids"] != self.tokenizer.pad_token_id).sum(dim=1)  # type: ignore
+        self.source_tokens += np.bincount(
+            sources, weights=tokens.numpy(), minlength=len(self.source_tokens)
+        ).astype(np.int64)
+
+    def log_source_tokens(self) -> None:
+        """Log the tokens consumed from each mixture source by all the processes."""
+        metrics = {
+            f"tokens/{os.path.basename(os.path.normpath(path))}": value
+            for path, value in zip(
+                self.mixture_sources, sum_across_ranks(self.source_tokens.tolist())
+            )
+        }
+        self.log_metrics(metrics)
+
+    def log_example_cache(self) -> None:
+        """Log the hit rate of the training example cache over all the processes."""
+        hits, misses = sum_across_ranks(
+            total_statistics(self.example_caches["train"].statistics)
+        )
+        self.log_metrics(
+            {
+                "example_cache/hit_rate": hits / max(1, hits + misses),
+                "example_cache/hits": hits,
+                "example_cache/misses": misses,
+            }
+        )
+
+    def log_metrics(self, metrics: Dict[str, Any]) -> None:
+        """Log metrics with the loggers of the trainer.
+        Args:
+            metrics: metrics by name.
+        """
+        for trainer_logger in self.trainer.loggers:  # type: ignore
+            trainer_logger.log_metrics(metrics, step=self.trainer.global_step)  # type: ignore
+
+    def on_before_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        """Count the training batches consumed in the current epoch, logging data metrics.
+        Args:
+            batch: batch about to be transferred to the device.
+            dataloader_idx: index of the dataloader, unused.
+        Returns:
+            the batch, unchanged.
+        """
+        if self.trainer is not None and self.trainer.training:
+            if self.trainer.current_epoch != self.consumed_epoch:
+                self.consumed_epoch, self.consumed_batches = (
+                    self.trainer.current_epoch,
+                    0,
+                )
+            if self.echoes:
+                fresh, self.echo_factor = self.echoes.popleft()
+                if not fresh:
+                    # echoes of a batch already counted
+                    return batch
+            self.consumed_batches += 1
+            logs = self.consumed_batches % self.trainer.log_every_n_steps == 0  # type: ignore
+            if self.mixture_sampler is not None:
+                self.count_source_tokens(batch)
+                if logs:
+                    self.log_source_tokens()
+            if self.example_cache is not None and logs:
+                self.log_example_cache()
+            if self.dataset_args.get("echo_factor", None) is not None and logs:
+                self.log_metrics({"data_echoing/echo_factor": self.echo_factor})
+        return batch
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Data loading state stored in the checkpoints.
+
+        Batches are sampled deterministically from the epoch, and DDP processes consume
+        the same number of batches, so the consumed batches of the epoch locate the next
+        unseen batch of every process.
+
+        Returns:
+            epoch, number of training batches consumed in it, number of processes and
+            tokens consumed from each mixture source.
+        """
+        return {
+            "epoch": self.consumed_epoch,
+            "consumed_batches": self.consumed_batches,
+            "num_replicas": distributed_world()[0],
+            # summed over the processes, checkpoints being saved by all of them
+            "source_tokens": sum_across_ranks(self.source_tokens.tolist()),
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restore the data loading state of a checkpoint, to resume its epoch.
+        Args:
+            state_dict: state stored in the checkpoint.
+        """
+        self.consumed_epoch = state_dict["epoch"]
+        self.consumed_batches = state_dict["consumed_batches"]
+        self._resume_state = dict(state_dict)
+        source_tokens = state_dict.get("source_tokens", [])
+        if (
+            len(source_tokens) == len(self.source_tokens)
+            and distributed_world()[1] == 0
+        ):
+            # the first process carries on the totals of all the processes
+            self.source_tokens = np.array(source_tokens, dtype=np.int64)
+
+    def resume_start_batch(self) -> int:
+        """Number of batches to skip to resume the epoch of a restored checkpoint.
+        Returns:
+            the batches consumed in the restored epoch, 0 if not resuming it.
+        """
+        if self._resume_state is None:
+            return 0
+        state, self._resume_state = self._resume_state, None
+        current_epoch = self.trainer.current_epoch if self.trainer is not None else 0
+        if state["epoch"] != current_epoch or state["consumed_batches"] == 0:
+            return 0
+        if state["num_replicas"] != distributed_world()[0]:
+            logger.warning(
+                f"Resuming with {distributed_world()[0]} processes instead of "
+                f"{state['num_replicas']}, the batches of the epoch differ"
+            )
+        return state["consumed_batches"]
+
+    def dataloader_settings(self) -> Dict[str, Any]:
+        """Performance settings of the dataloaders, probed on the training split if requested.
+        Returns:
+            keyword arguments of the dataloaders: number of workers, persistent workers,
+            prefetch factor and pinned memory.
+        """
+        if self._dataloader_settings is not None:
+            return self._dataloader_settings
+
+        num_workers = self.dataset_args.get("num_dataloader_workers", "auto")
+        prefetch_factor = self.dataset_args.get("prefetch_factor", None)
+        settings = dataloader_settings(
+            resolve_num_workers(num_workers),
+            persistent_workers=self.dataset_args.get("persistent_workers", True),
+            prefetch_factor=prefetch_factor,
+            pin_memory=self.dataset_args.get("pin_memory", None),
+        )
+        probe_batches = self.dataset_args.get("dataloader_probe_batches", 0)
+        if probe_batches > 0 and "train" in self.datasets:
+            settings = probe_dataloader_settings(
+                lambda candidate: self.build_dataloader("train", True, candidate),
+                settings,
+                probe_batches,
+                probe_workers=str(num_workers) == "auto",
+                probe_prefetch=prefetch_factor is None,
+            )
+        logger.info(f"Dataloader settings: {settings}")
+        self._dataloader_settings = settings
+        return settings
+
+    def routing_workers(self, settings: Dict[str, Any]) -> int:
+        """Number of dataloader workers examples are routed to, so that each example is
+        always read, and cached, by the same worker.
+        Args:
+            settings: dataloader performance settings.
+        Returns:
+            the number of workers with an example cache, otherwise 1.
+        """
+        if self.example_cache is None:
+            return 1
+        return max(1, settings.get("num_workers", 0))
+
+    def example_cache_share(self, settings: Dict[str, Any]) -> int:
+        """Memory budget of each example cache of each process reading examples.
+
+        The budget is split among the processes of the node and among the caches of
+        the training and validation splits, held by the workers of their dataloaders,
+        which are alive at the same time, or both by the main process.
+        Args:
+            settings: dataloader performance settings.
+        Returns:
+            the budget in bytes of each cache of each reader.
+        """
+        num_devices = getattr(self.trainer, "num_devices", None)
+        local_processes = num_devices or local_world_size()
+        splits = len({"train", "validation"} & set(self.datasets))
+        readers = max(1, settings.get("num_workers", 0)) * max(1, splits)
+        return self.example_cache_size // max(1, local_processes * readers)  # type: ignore
+
+    def build_dataloader(
+        self,
+        split: str,
+        shuffle: bool = False,
+        settings: Optional[Dict[str, Any]] = None,
+        start_batch: int = 0,
+        echo: bool = False,
+    ) -> DataLoader:
+        """Create the DataLoader for a split.
+        Args:
+            split: dataset split, train or validation.
+            shuffle: whether to shuffle the batches when grouping by length. Defaults to False.
+            settings: dataloader performance settings. Defaults to None, a.k.a., the
+                ones of the data module.
+            start_batch: number of batches of the first epoch to skip, when resuming
+                an epoch. Defaults to 0.
+            echo: whether to use each batch several times, see EchoingDataLoader.
+                Defaults to False.
+        Returns:
+            pytorch-like dataloader.
+        """
+        if settings is None:
+            settings = self.dataloader_settings()
+        dataset = self.datasets[split]
+        if (
+            isinstance(dataset, StreamingLMDataset)
+            and dist.is_available()
+            and dist.is_initialized()
+        ):
+            # resolved here since spawned workers have no process group
+            dataset.num_replicas, dataset.rank = dist.get_world_size(), dist.get_rank()
+        if start_batch > 0 and isinstance(dataset, StreamingLMDataset):
+            logger.warning(
+                "Streaming datasets can not skip consumed batches, the epoch is restarted"
+            )
+            start_batch = 0
+
+        num_workers = self.routing_workers(settings)
+        example_cache = self.example_caches.get(split)
+        if example_cache is not None:
+            example_cache.max_bytes = self.example_cache_share(settings)
+            if settings.get("num_workers", 0) > 0:
+                # entries of the main process would be copied into forked workers
+                example_cache.clear()
+
+        batch_sampler = self.build_batch_sampler(
+            split, shuffle, 0 if self.num_replicas > 1 else start_batch, num_workers
+        )
+        sampler: Optional[Sampler] = None
+        if batch_sampler is None and shuffle and split == "train":
+            sampler = self.build_mixture_sampler(dataset, start_batch, num_workers)
+        if batch_sampler is None and shuffle and sampler is None:
+            sampler = self.build_block_shuffle_sampler(
+                dataset, 0 if self.num_replicas > 1 else start_batch, num_workers
+            )
+        if sampler is not None and self.num_replicas == 1:
+            # skipped by the sampler
+            start_batch = 0
+        if batch_sampler is None and start_batch > 0 and self.num_replicas == 1:
+            batch_sampler = ResumableBatchSampler(
+                SequentialSampler(dataset),  # type: ignore
+                batch_size=self.batch_size(split),
+                drop_last=False,
+                start_batch=start_batch,
+            )
+        if self.num_replicas > 1:
+            # processes sample their own shard, in the same number of batches
+            if batch_sampler is None:
+                batch_sampler = BatchSampler(
+                    sampler
+                    or WorkerRoutedSampler(
+                        DistributedSampler(
+                            dataset, num_replicas=1, rank=0, shuffle=shuffle
+                        ),
+                        self.batch_size(split),
+                        num_workers,
+                    ),
+                    batch_size=self.batch_size(split),
+                    drop_last=False,
+                )
+            batch_sampler = EvenBatchSampler(
+                batch_sampler,
+                max_across_ranks(len(batch_sampler)),
+                start_batch=start_batch,
+            )
+        streaming = isinstance(dataset, StreamingLMDataset)
+        # streaming shards differ in size, DDP processes stop with the first exhausted
+        dataloader_class: Callable[..., DataLoader] = (
+            StreamingDataLoader if streaming else DataLoader
+        )
+        collator = self.batch_collator()
+        if echo:
+            collator, transform = self.echo_collators()
+            dataloader_class = functools.partial(
+                EchoingStreamingDataLoader if streaming else EchoingDataLoader,
+                echo_factor=self.dataset_args.get("echo_factor", "auto"),
+                max_echo_factor=self.dataset_args.get("max_echo_factor", 4),
+                transform=transform,
+                echoes=self.echoes,
+            )
+        if batch_sampler is not None:
+            dataloader = dataloader_class(
+                self.datasets[split],  # type: ignore
+                batch_sampler=batch_sampler,
+                collate_fn=collator,
+                **settings,
+            )
+        else:
+            dataloader = dataloader_class(
+                self.datasets[split],  # type: ignore
+                batch_size=self.batch_size(split),
+                sampler=sampler,
+                collate_fn=collator,
+                **settings,
+            )
+        # pickling the dataset takes as long as starting the workers, debugging only
+        if (
+            logger.isEnabledFor(logging.DEBUG)
+            and settings.get("num_workers", 0) > 0
+            and split not in self._logged_payloads
+        ):
+            self._logged_payloads.add(split)
+            payload_size = worker_payload_size(dataloader)
+            if payload_size is not None:
+                logger.debug(
+                    f"Payload pickled into each {split} dataloader worker: "
+                    f"{payload_size / 2**20:.2f} MiB"
+                )
+        return dataloader
+
     def train_dataloader(self) -> DataLoader:
         """Create the DataLoader for the traning step.
         Returns:
             pytorch-like dataloader.
         """
-        return DataLoader(
-            self.datasets["train"],  # type: ignore
-            batch_size=self.dataset_args["batch_size"],
-            num_workers=self.dataset_args["num_dataloader_workers"],
-            collate_fn=self.data_collator,
+        return self.build_dataloader(
+            "train",
+            shuffle=True,
+            start_batch=self.resume_start_batch(),
+            echo=self.dataset_args.get("echo_factor", None) is not None,
+        )
+
+    def batch_size(self, split: str) -> int:
+        """Number of examples per batch of a split.
+        Args:
+            split: dataset split, train or validation.
+        Returns:
+            the batch size, the evaluation one for validation if configured.
+        """
+        if split == "validation":
+            return (
+                self.dataset_args.get("eval_batch_size", None)
+                or self.dataset_args["batch_size"]
+            )
+        return self.dataset_args["batch_size"]
+
+    def stripped_padding_collator(self) -> Optional[Callable]:
+        """Collator padding examples whose tokenization padding has been stripped.
+        Returns:
+            the collator padding to the longest example of each batch, None if examples
+            are not padded at tokenization time.
+        """
+        if self.padding() == "max_length" and isinstance(
+            self.data_collator, TensorCollator
+        ):
+            return self.data_collator.with_padding(  # type: ignore
+                self.tokenizer, self.pad_to_multiple_of()
+            )
+        return None
+
+    def validation_limit(self) -> int:
+        """Number of validation examples read by the process, see limit_val_batches.
+        Returns:
+            the number of examples of the validated batches, all of them if no trainer
+            is attached.
+        """
+        dataset = self.datasets["validation"]
+        limit = getattr(self.trainer, "limit_val_batches", None)
+        if limit is None or limit == 1.0:
+            return len(dataset)  # type: ignore
+        if isinstance(limit, float):
+            return int(limit * len(dataset))  # type: ignore
+        # batches of each process, sampled by lightning unless the dataset is sharded
+        num_replicas = 1 if self.num_replicas > 1 else distributed_world()[0]
+        return min(
+            len(dataset), limit * self.batch_size("validation") * num_replicas  # type: ignore
+        )
+
+    def build_validation_examples(self) -> List[Dict[str, Any]]:
+        """Tokenize the validation examples once, sorted by length.
+
+        Padding added at tokenization time is removed, so that batches of consecutive
+        examples are padded by the collator to their longest example, with minimal
+        padding. Only the examples of the validated batches are read.
+
+        Returns:
+            the tokenized validation examples.
+        """
+        dataset = self.datasets["validation"]
+        batch_size = self.batch_size("validation")
+        number_of_examples = self.validation_limit()
+        examples: List[Dict[str, Any]] = []
+        for start in range(0, number_of_examples, batch_size):
+            examples.extend(
+                fetch_items(
+                    dataset, range(start, min(start + batch_size, number_of_examples))
+                )
+            )
+        if self.stripped_padding_collator() is not None:
+            examples = [
+                strip_padding(
+                    example,
+                    self.tokenizer.pad_token_id,  # type: ignore
+                    self.tokenizer.padding_side,  # type: ignore
+                )
+                for example in examples
+            ]
+
+        order = np.argsort(
+            [len(example["input_ids"]) for example in examples], kind="stable"
         )
+        logger.info(f"Cached {len(examples)} validation examples")
+        return [examples[index] for index in order]
 
     def val_dataloader(self) -> DataLoader:
         """Create the DataLoader for the traning step.
         Returns:
             pytorch-like dataloader.
         """
+        if not self.dataset_args.get("cache_validation_batches", False) or isinstance(
+            self.datasets["validation"], StreamingLMDataset
+        ):
+            return self.build_dataloader("validation")
+
+        if self._validation_examples is None:
+            self._validation_examples = self.build_validation_examples()
+        # examples are already tokenized, in memory, and collated by the workers
         return DataLoader(
-            self.datasets["validation"],  # type: ignore
-            batch_size=self.dataset_args["batch_size"],
-            num_workers=self.dataset_args["num_dataloader_workers"],
-            collate_fn=self.data_collator,
+            self._validation_examples,  # type: ignore
+            batch_size=self.batch_size("validation"),
+            collate_fn=self.stripped_padding_collator() or self.batch_collator(),
+            **self.dataloader_settings(),
         )
 
 
@@ -244,82 +1742,114 @@ class MLMDataModule(DataModule):
         """
         super().__init__(dataset_args, tokenizer)
 
-        self.data_collator = DataCollatorForLanguageModeling(
+        self.data_collator = MaskedLanguageModelingCollator(
             self.tokenizer, self.dataset_args["mlm_probability"]  # type: ignore
         )
 
         self.load()
 
+    def pack(self, dataset: Dataset) -> PackedDataset:
+        """Pack the examples of a dataset in rows of max_length tokens.
+        Args:
+            dataset: dataset of tokenized examples.
+        Returns:
+            the packed dataset, examples separated by SEP tokens.
+        """
+        return self.build_packed_dataset(dataset, self.tokenizer.sep_token_id)  # type: ignore
+
+    def echo_collators(self) -> Tuple[Callable, Optional[Callable]]:
+        """Collator of the echoed batches and transform applied to each echo.
+        Returns:
+            a collator stacking examples without masking them and a transform drawing
+            new masks for each echo, so that echoes differ.
+        """
+        return (
+            self.batch_collator(self.data_collator.without_masking()),  # type: ignore
+            functools.partial(self.data_collator.mask, in_place=False),  # type: ignore
+        )
+
 
 class CGMDataModule(DataModule):
     """Pytorch-lightning-style data module for conditional generation dataset."""
 
+    tokenize_function_class = ConditionalGenerationTokenizeFunction
+
     def __init__(
         self,
         dataset_args: Dict[str, Union[float, str, int]],
-        model: AutoModelForSeq2SeqLM,
+        model: Optional[AutoModelForSeq2SeqLM],
         tokenizer: AutoTokenizer,
     ) -> None:
         """
         Initialize the data module.
         Args:
             dataset_args: dictionary containing the metadata for the lightning data module creation.
-            model: model to be used in the module.
+            model: model to be used in the module, if None decoder input ids are not prepared.
+                A DecoderInputsFromLabels can be passed instead to avoid loading the model.
             tokenizer: tokenizer to be used in the module.
         """
         super().__init__(dataset_args, tokenizer)
 
-        self.data_collator = DataCollatorForSeq2Seq(
-            tokenizer,
-            model=model,
-            label_pad_token_id=-100,
-            pad_to_multiple_of=None,
-        )
+        # sources and targets are padded to their longest sequence in each batch
+        self.data_collator = Seq2SeqCollator(
+            # only what preparing decoder input ids requires is shipped to the workers
+            DecoderInputsFromLabels.from_model(model)
+            if model is not None
+            else None
+        ).with_padding(tokenizer, self.pad_to_multiple_of())
 
         self.load()
 
-    def tokenize_function(
-        self, examples: Dict[str, Union[int, slice]]
-    ) -> BatchEncoding:
-        """Tokenize the given examples.
-        Args:
-            examples: list of examples.
+    def padding(self) -> Union[bool, str]:
+        """Padding strategy applied at tokenization time.
         Returns:
-            tokenized examples.
+            no padding, sources and targets are padded dynamically by the collator.
         """
+        return False
 
-        truncation = self.dataset_args.get("truncation", True)
-        padding = self.dataset_args.get("padding", "max_length")
+    def build_tokenize_function(self) -> ConditionalGenerationTokenizeFunction:
+        """Build the tokenize function held by the datasets.
+        Returns:
+            the tokenize function, truncating sources and targets to their own lengths.
+        """
         max_length = self.dataset_args.get("max_length", 512)
-
-        data_inputs = self.tokenizer(  # type: ignore
-            examples["source"],
-            truncation=truncation,
-            padding=padding,
-            max_length=max_length,
-        )
-
-        targets = self.tokenizer(  # type: ignore
-            examples["target"],
-            truncation=truncation,
-            padding=padding,
-            max_length=max_length,
+        return ConditionalGenerationTokenizeFunction(
+            self.tokenizer,
+            truncation=self.dataset_args.get("truncation", True),
+            padding=self.padding(),
+            max_length=self.dataset_args.get("max_source_length", None) or max_length,
+            max_target_length=self.dataset_args.get("max_target_length", None)
+            or max_length,
         )
 
-        if padding == "max_length":
-            targets["inputs_ids"] = [
-                -100 if x == self.tokenizer.pad_token_id else x
-                for x in targets["input_ids"]
-            ]
-
-        data_inputs["labels"] = targets["input_ids"]
+    def tokenization_parameters(self) -> Dict[str, Any]:
+        """Parameters affecting the output of the tokenize function.
+        Returns:
+            parameters used to fingerprint tokenized caches.
+        """
+        tokenize_function = self.build_tokenize_function()
+        return {
+            **super().tokenization_parameters(),
+            "max_length": tokenize_function.max_length,
+            "max_target_length": tokenize_function.max_target_length,
+        }
 
-        return BatchEncoding(data=data_inputs)
+    def example_fields(self) -> List[str]:
+        """Fields of the examples used by the tokenize function.
+        Returns:
+            the configured fields, the source and target fields by default.
+        """
+        return parse_fields(self.dataset_args.get("json_fields", None)) or [
+            "source",
+            "target",
+        ]
 
 
 class CLMDataModule(DataModule):
     """Pytorch-lightning-style data module for CLM dataset."""
 
+    tokenize_function_class = CausalLanguageModelingTokenizeFunction
+
     def __init__(
         self, dataset_args: Dict[str, Union[float, str, int]], tokenizer: AutoTokenizer
     ) -> None:
@@ -333,21 +1863,14 @@ class CLMDataModule(DataModule):
 
         self.load()
 
-    def tokenize_function(
-        self, examples: Dict[str, Union[int, slice]]
-    ) -> BatchEncoding:
-        """Tokenize the given examples.
+    def pack(self, dataset: Dataset) -> PackedDataset:
+        """Pack the examples of a dataset in rows of max_length tokens.
         Args:
-            examples: list of examples.
+            dataset: dataset of tokenized examples.
         Returns:
-            tokenized examples.
+            the packed dataset, examples separated by EOS tokens.
         """
-
-        tokenized_data = super().tokenize_function(examples)
-
-        tokenized_data["labels"] = tokenized_data["input_ids"].copy()
-
-        return tokenized_data
+        return self.build_packed_dataset(dataset, self.tokenizer.eos_token_id)  # type: ignore
 
 
 class PLMDataModule(DataModule):
@@ -363,10 +1886,18 @@ class PLMDataModule(DataModule):
         """
         super().__init__(dataset_args, tokenizer)
 
-        self.data_collator = DataCollatorForPermutationLanguageModeling(
-            tokenizer=self.tokenizer,  # type: ignore
-            plm_probability=self.dataset_args["plm_probability"],
-            max_span_length=self.dataset_args["max_span_length"],
+        self.data_collator = PermutationLanguageModelingCollator(
+            tokenizer=self.tokenizer,
+            plm_probability=self.dataset_args["plm_probability"],  # type: ignore
+            max_span_length=self.dataset_args["max_span_length"],  # type: ignore
         )
 
         self.load()
+
+    def pad_to_multiple_of(self) -> Optional[int]:
+        """Multiple dynamically padded lengths are rounded to.
+        Returns:
+            an even multiple, since permutation language modeling requires even lengths.
+        """
+        pad_to_multiple_of = super().pad_to_multiple_of() or 1
+        return pad_to_multiple_of * (2 if pad_to_multiple_of % 2 else 1)
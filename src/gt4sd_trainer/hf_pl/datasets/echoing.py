@@ -0,0 +1,230 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Data echoing, reusing batches when the input pipeline is the bottleneck."""
+
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple, Union
+
+from torch.utils.data import DataLoader
+
+from .sharding import distributed_world, max_across_ranks
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# waiting for data longer than this fraction of a step increases the echo factor
+STALL_TOLERANCE = 0.1
+# fresh batches without stalls before trying a lower echo factor
+PROBE_INTERVAL = 50
+# weight of the past in the moving averages of the waiting and step times
+SMOOTHING = 0.9
+# fresh batches between agreements of the DDP processes on the echo factor
+SYNC_INTERVAL = 10
+
+
+def parse_echo_factor(echo_factor: Union[int, str]) -> Union[int, str]:
+    """Parse an echo factor.
+    Args:
+        echo_factor: number of times each batch is used, or auto.
+    Returns:
+        the echo factor, an integer or auto.
+    Raises:
+        ValueError: in case the echo factor is neither a positive integer nor auto.
+    """
+    if str(echo_factor) == "auto":
+        return "auto"
+    try:
+        value = int(echo_factor)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise ValueError(
+            f"Echo factor should be a positive integer or auto, got {echo_factor}"
+        )
+    return value
+
+
+class EchoFactorController:
+    """Echo factor adapted to the time spent waiting for data and the step time.
+
+    With an echo factor k, the input pipeline has k steps to produce each batch. Waiting
+    for a batch means producing it took the waiting time on top of them, so k is raised
+    to cover the production time. Without waiting, a lower factor is tried from time to
+    time, since the pipeline might have become faster. Factors are proposed by `update`
+    and take effect with `apply`, so that DDP processes can agree on a common one.
+    """
+
+    def __init__(self, max_echo_factor: int = 4) -> None:
+        """Initialize the controller.
+        Args:
+            max_echo_factor: maximum number of times each batch is used. Defaults to 4.
+        """
+        self.max_echo_factor = max_echo_factor
+        self.echo_factor = 1
+        self.wait_time: Optional[float] = None
+        self.step_time: Optional[float] = None
+        self.batches_without_stalls = 0
+
+    def update(self, wait_time: float, step_time: float) -> int:
+        """Update the measurements with the times of a fresh batch.
+        Args:
+            wait_time: time in seconds spent waiting for the batch.
+            step_time: average time in seconds of the steps on its echoes.
+        Returns:
+            the echo factor proposed for the next batches.
+        """
+        if self.wait_time is None or self.step_time is None:
+            self.wait_time, self.step_time = wait_time, step_time
+        else:
+            self.wait_time = SMOOTHING * self.wait_time + (1 - SMOOTHING) * wait_time
+            self.step_time = SMOOTHING * self.step_time + (1 - SMOOTHING) * step_time
+        if self.step_time <= 0:
+            return self.echo_factor
+
+        if self.wait_time > STALL_TOLERANCE * self.step_time:
+            production_time = self.wait_time + self.echo_factor * self.step_time
+            echo_factor = math.ceil(production_time / self.step_time - STALL_TOLERANCE)
+            self.batches_without_stalls = 0
+        else:
+            echo_factor = self.echo_factor
+            self.batches_without_stalls += 1
+            # proposed until applied, agreements might come later
+            if self.batches_without_stalls >= PROBE_INTERVAL:
+                echo_factor -= 1
+        return max(1, min(self.max_echo_factor, echo_factor))
+
+    def apply(self, echo_factor: int) -> None:
+        """Use an echo factor for the next batches.
+        Args:
+            echo_factor: echo factor, e.g., the largest one proposed by the DDP processes.
+        """
+        if echo_factor != self.echo_factor:
+            logger.debug(f"Echo factor {self.echo_factor} -> {echo_factor}")
+            # times measured with another factor are not representative anymore
+            self.wait_time = None
+            self.batches_without_stalls = 0
+            self.echo_factor = echo_factor
+
+
+class EchoingDataLoader(DataLoader):
+    """DataLoader using each batch several times, transformed anew for each use.
+
+    A DataLoader subclass, so that trainers can inject distributed samplers. The echoes
+    of each batch are recorded in `echoes`, shared with the data module, in the order
+    they are yielded. In auto mode, DDP processes agree every SYNC_INTERVAL fresh
+    batches on the largest echo factor proposed, so that they run the same number of
+    steps, provided that they load the same number of batches.
+    """
+
+    def __init__(
+        self,
+        *args,
+        echo_factor: Union[int, str] = "auto",
+        max_echo_factor: int = 4,
+        transform: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        echoes: Optional[Deque[Tuple[bool, int]]] = None,
+        **kwargs,
+    ) -> None:
+        """Initialize the dataloader.
+        Args:
+            args: positional arguments of the DataLoader.
+            echo_factor: number of times each batch is used, or auto to adapt it to the
+                time spent waiting for data. Defaults to auto.
+            max_echo_factor: maximum number of times each batch is used in auto mode.
+                Defaults to 4.
+            transform: function applied to each echo, e.g., drawing new masks, it should
+                not modify the batch in place. Defaults to None, a.k.a., identical echoes.
+            echoes: deque recording for each yielded batch whether it is fresh and the
+                echo factor. Defaults to None, a.k.a., a new deque.
+            kwargs: keyword arguments of the DataLoader.
+        """
+        super().__init__(*args, **kwargs)
+        self.echo_factor = parse_echo_factor(echo_factor)
+        self.max_echo_factor = max_echo_factor
+        self.transform = transform
+        self.echoes: Deque[Tuple[bool, int]] = echoes if echoes is not None else deque()
+        self.controller = EchoFactorController(max_echo_factor)
+
+    def __len__(self) -> int:
+        """Number of batches yielded in an epoch.
+
+        In auto mode, the number of echoes is not known in advance and the length is an
+        upper bound, using every batch max_echo_factor times. Epochs end earlier with
+        lower factors, yet fractions of epochs, e.g., a float val_check_interval, and
+        the estimated number of steps of learning rate schedules refer to the bound.
+        Returns:
+            the number of echoes of the batches.
+        """
+        echo_factor = (
+            self.max_echo_factor if self.echo_factor == "auto" else self.echo_factor
+        )
+        return super().__len__() * int(echo_factor)
+
+    def __iter__(self) -> Iterator[Any]:  # type: ignore
+        """Iterate over the echoes of the batches.
+        Returns:
+            an iterator over the batches, each one used echo factor times.
+        """
+        self.echoes.clear()
+        return self.echo(super().__iter__())
+
+    def echo(self, batches: Iterator[Any]) -> Iterator[Any]:
+        """Yield the echoes of batches, adapting the echo factor in auto mode.
+        Args:
+            batches: iterator over the fresh batches.
+        Returns:
+            an iterator over the echoes.
+        """
+        echo_factor = (
+            self.controller.echo_factor
+            if self.echo_factor == "auto"
+            else int(self.echo_factor)
+        )
+        num_replicas, _ = distributed_world()
+        fresh_batches = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            wait_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for echo in range(echo_factor):
+                self.echoes.append((echo == 0, echo_factor))
+                yield self.transform(batch) if self.transform is not None else batch
+            step_time = (time.perf_counter() - start) / echo_factor
+
+            if self.echo_factor == "auto":
+                proposal = self.controller.update(wait_time, step_time)
+                fresh_batches += 1
+                if num_replicas == 1:
+                    self.controller.apply(proposal)
+                elif fresh_batches % SYNC_INTERVAL == 0:
+                    self.controller.apply(max_across_ranks(proposal))
+                echo_factor = self.controller.echo_factor
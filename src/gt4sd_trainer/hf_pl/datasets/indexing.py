@@ -0,0 +1,211 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Indices for line-delimited dataset files: byte offsets and directory manifests."""
+
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+OFFSET_INDEX_SUFFIX = ".idx"
+OFFSET_INDEX_DTYPE = np.uint64
+MANIFEST_FILENAME = ".gt4sd_manifest.json"
+
+
+def build_offset_index(filepath: str, chunk_size: int = 2**20) -> np.ndarray:
+    """Build the byte-offset index of a line-delimited file.
+    Args:
+        filepath: path of the dataset.
+        chunk_size: size in bytes of the blocks read while scanning the file.
+    Returns:
+        array of N + 1 offsets, where the i-th line spans the bytes between
+        the i-th and the (i + 1)-th offsets.
+    """
+    size = os.path.getsize(filepath)
+    starts = [np.zeros(1, dtype=OFFSET_INDEX_DTYPE)]
+    position = 0
+    with open(filepath, "rb") as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 0x0A)
+            starts.append((newlines + position + 1).astype(OFFSET_INDEX_DTYPE))
+            position += len(chunk)
+    offsets = np.concatenate(starts)
+    # a last line without a trailing newline still has to be closed
+    if offsets[-1] != size:
+        offsets = np.append(offsets, OFFSET_INDEX_DTYPE(size))
+    return offsets
+
+
+def is_offset_index_valid(filepath: str, index_path: str) -> bool:
+    """Check whether an offset index on disk matches its dataset file.
+    Args:
+        filepath: path of the dataset.
+        index_path: path of the offset index.
+    Returns:
+        whether the index can be used for the dataset.
+    """
+    if not os.path.isfile(index_path):
+        return False
+    index_size = os.path.getsize(index_path)
+    itemsize = np.dtype(OFFSET_INDEX_DTYPE).itemsize
+    if index_size == 0 or index_size % itemsize:
+        return False
+    if os.path.getmtime(index_path) < os.path.getmtime(filepath):
+        return False
+    with open(index_path, "rb") as fp:
+        fp.seek(index_size - itemsize)
+        last_offset = np.frombuffer(fp.read(itemsize), dtype=OFFSET_INDEX_DTYPE)[0]
+    return int(last_offset) == os.path.getsize(filepath)
+
+
+def atomic_write(path: str, write_function: Callable[[Any], None]) -> None:
+    """Atomically write a file, safe for concurrent writers.
+    Args:
+        path: path of the file.
+        write_function: function writing the content to a binary file object.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=directory, prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(file_descriptor, "wb") as fp:
+            write_function(fp)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def save_offset_index(offsets: np.ndarray, index_path: str) -> None:
+    """Atomically store an offset index, safe for concurrent writers.
+    Args:
+        offsets: offsets to store.
+        index_path: path of the offset index.
+    """
+    atomic_write(index_path, offsets.astype(OFFSET_INDEX_DTYPE).tofile)
+
+
+def load_offset_index(
+    filepath: str,
+    index_path: Optional[str] = None,
+    build_function: Callable[[str], np.ndarray] = build_offset_index,
+) -> np.ndarray:
+    """Load the offset index of a file, building it when missing or stale.
+    Args:
+        filepath: path of the dataset.
+        index_path: path of the offset index. Defaults to a sidecar file next to the dataset.
+        build_function: function building the index, its last value has to be the
+            file size. Defaults to build_offset_index.
+    Returns:
+        memory-mapped offsets, or in-memory ones if the index can not be stored.
+    """
+    if index_path is None:
+        index_path = f"{filepath}{OFFSET_INDEX_SUFFIX}"
+
+    if not is_offset_index_valid(filepath, index_path):
+        logger.info(f"Building offset index for {filepath}")
+        offsets = build_function(filepath)
+        try:
+            save_offset_index(offsets, index_path)
+        except OSError:
+            logger.warning(
+                f"Offset index {index_path} can not be stored, keeping it in memory"
+            )
+            return offsets
+
+    return np.memmap(index_path, dtype=OFFSET_INDEX_DTYPE, mode="r")
+
+
+def load_manifest(
+    filepaths: List[str],
+    count_function: Callable[[str], int],
+    manifest_path: str,
+    num_threads: Optional[int] = None,
+) -> Dict[str, Dict[str, int]]:
+    """Load the manifest of a set of files, counting examples only for new or changed files.
+    Args:
+        filepaths: paths of the files.
+        count_function: function counting the examples of a file.
+        manifest_path: path where the manifest is persisted.
+        num_threads: number of threads counting examples. Defaults to ThreadPoolExecutor's default.
+    Returns:
+        size, modification time and number of examples by file path.
+    """
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+    entries: Dict[str, Dict[str, int]] = {}
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as fp:
+                entries = json.load(fp)["files"]
+        except (OSError, ValueError, KeyError):
+            logger.warning(f"Ignoring unreadable manifest {manifest_path}")
+
+    def _entry(filepath: str) -> Dict[str, int]:
+        stat = os.stat(filepath)
+        entry = entries.get(os.path.relpath(filepath, manifest_directory), {})
+        if (
+            entry.get("size") == stat.st_size
+            and entry.get("mtime_ns") == stat.st_mtime_ns
+        ):
+            return entry
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "lines": count_function(filepath),
+        }
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        file_entries = dict(zip(filepaths, executor.map(_entry, filepaths)))
+
+    updated_entries = {
+        **entries,
+        **{
+            os.path.relpath(filepath, manifest_directory): entry
+            for filepath, entry in file_entries.items()
+        },
+    }
+    if updated_entries != entries:
+        try:
+            atomic_write(
+                manifest_path,
+                lambda fp: fp.write(
+                    json.dumps({"files": updated_entries}, indent=1).encode("utf-8")
+                ),
+            )
+        except OSError:
+            logger.warning(f"Manifest {manifest_path} can not be stored")
+
+    return file_entries
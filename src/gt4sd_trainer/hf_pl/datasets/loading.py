@@ -0,0 +1,243 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""DataLoader performance settings, resolved from the available cores and probed."""
+
+import logging
+import os
+import pickle
+import timeit
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+import torch
+from torch.utils.data import DataLoader
+
+from .sharding import local_world_size
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+#: default number of batches prefetched by each worker.
+DEFAULT_PREFETCH_FACTOR = 2
+
+
+def available_cpus() -> int:
+    """Number of cores the current process can run on.
+    Returns:
+        number of cores in the affinity mask of the process, or on the machine.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def auto_num_workers(training_threads: int = 1, max_workers: int = 8) -> int:
+    """Number of dataloader workers fitting in the share of cores of a training process.
+    Args:
+        training_threads: cores kept for the training process itself. Defaults to 1.
+        max_workers: maximum number of workers. Defaults to 8.
+    Returns:
+        number of workers, 0 if the process has no spare cores.
+    """
+    cores = available_cpus() // local_world_size()
+    return max(min(cores - training_threads, max_workers), 0)
+
+
+def resolve_num_workers(num_workers: Union[int, str], max_workers: int = 8) -> int:
+    """Resolve a number of dataloader workers.
+    Args:
+        num_workers: number of workers or "auto".
+        max_workers: maximum number of workers in auto mode. Defaults to 8.
+    Returns:
+        the number of workers.
+    Raises:
+        ValueError: in case the number of workers is neither a count nor auto.
+    """
+    if str(num_workers) == "auto":
+        return auto_num_workers(max_workers=max_workers)
+    try:
+        return max(int(num_workers), 0)
+    except ValueError:
+        raise ValueError(
+            f"Number of dataloader workers should be an integer or auto, got {num_workers}"
+        )
+
+
+def dataloader_settings(
+    num_workers: int,
+    persistent_workers: bool = True,
+    prefetch_factor: Optional[int] = None,
+    pin_memory: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """Keyword arguments of a DataLoader for the given performance settings.
+    Args:
+        num_workers: number of workers.
+        persistent_workers: keep the workers alive across epochs. Defaults to True.
+        prefetch_factor: batches prefetched by each worker. Defaults to None, a.k.a., 2.
+        pin_memory: copy batches in pinned memory. Defaults to None, a.k.a., if CUDA
+            is available.
+    Returns:
+        the DataLoader keyword arguments, omitting the worker ones without workers.
+    """
+    settings: Dict[str, Any] = {
+        "num_workers": num_workers,
+        "pin_memory": torch.cuda.is_available() if pin_memory is None else pin_memory,
+    }
+    if num_workers > 0:
+        settings["persistent_workers"] = persistent_workers
+        settings["prefetch_factor"] = (
+            DEFAULT_PREFETCH_FACTOR if prefetch_factor is None else prefetch_factor
+        )
+    return settings
+
+
+def measure_data_wait(dataloader: Iterable, number_of_batches: int) -> float:
+    """Average time spent waiting for a batch, after the first one.
+    Args:
+        dataloader: dataloader to measure.
+        number_of_batches: number of batches measured.
+    Returns:
+        average seconds per batch, excluding the start of the workers.
+    """
+    iterator = iter(dataloader)
+    try:
+        next(iterator)
+    except StopIteration:
+        return 0.0
+    waits: List[float] = []
+    start = timeit.default_timer()
+    for _ in range(number_of_batches):
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        end = timeit.default_timer()
+        waits.append(end - start)
+        start = end
+    # shuts down the workers
+    del iterator
+    return sum(waits) / len(waits) if waits else 0.0
+
+
+def probe_dataloader_settings(
+    build_function: Callable[[Dict[str, Any]], DataLoader],
+    settings: Dict[str, Any],
+    number_of_batches: int,
+    probe_workers: bool = True,
+    probe_prefetch: bool = True,
+    tolerance: float = 0.1,
+) -> Dict[str, Any]:
+    """Pick the number of workers and prefetch depth minimizing the data-wait time.
+
+    Fewer workers and shallower prefetching are kept when within tolerance of the
+    best wait, to leave cores and memory to the training process.
+
+    Args:
+        build_function: function building a dataloader from keyword arguments.
+        settings: dataloader keyword arguments, whose number of workers is the maximum probed.
+        number_of_batches: number of batches measured for each candidate.
+        probe_workers: whether to probe the number of workers. Defaults to True.
+        probe_prefetch: whether to probe the prefetch factor. Defaults to True.
+        tolerance: relative slack over the best wait time. Defaults to 0.1.
+    Returns:
+        the settings with the probed number of workers and prefetch factor.
+    """
+    max_workers = settings["num_workers"]
+    if max_workers == 0:
+        return settings
+    worker_counts = [max_workers]
+    if probe_workers:
+        worker_counts = sorted(
+            {max(max_workers // 4, 1), max(max_workers // 2, 1), max_workers}
+        )
+    prefetch_factors = [settings["prefetch_factor"]]
+    if probe_prefetch:
+        prefetch_factors = [DEFAULT_PREFETCH_FACTOR, 2 * DEFAULT_PREFETCH_FACTOR]
+    candidates = [
+        dataloader_settings(
+            num_workers,
+            persistent_workers=False,
+            prefetch_factor=prefetch_factor,
+            pin_memory=settings["pin_memory"],
+        )
+        for num_workers in worker_counts
+        for prefetch_factor in prefetch_factors
+    ]
+    if len(candidates) == 1:
+        return settings
+    waits = []
+    for candidate in candidates:
+        wait = measure_data_wait(build_function(candidate), number_of_batches)
+        logger.info(
+            f"Data wait with {candidate['num_workers']} workers and prefetch factor "
+            f"{candidate['prefetch_factor']}: {1000 * wait:.2f} ms/batch"
+        )
+        waits.append(wait)
+
+    best_wait = min(waits)
+    probed = next(
+        candidate
+        for candidate, wait in zip(candidates, waits)
+        if wait <= best_wait * (1 + tolerance)
+    )
+    return {**settings, **probed, "persistent_workers": settings["persistent_workers"]}
+
+
+class ByteCounter:
+    """File-like sink counting the bytes written to it, without storing them."""
+
+    def __init__(self) -> None:
+        """Initialize the counter."""
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        """Count written bytes.
+        Args:
+            data: bytes written.
+        Returns:
+            number of bytes written.
+        """
+        self.size += len(data)
+        return len(data)
+
+
+def worker_payload_size(dataloader: DataLoader) -> Optional[int]:
+    """Size of the objects pickled into each worker of a dataloader when it is started.
+
+    Objects are pickled into a byte counter, so that the payload is never held in memory,
+    yet it takes as long as pickling it: only call it for debugging.
+    Args:
+        dataloader: a dataloader.
+    Returns:
+        size in bytes of the dataset, collate and worker init functions, None if they
+        can not be pickled, e.g., with the fork start method only.
+    """
+    counter = ByteCounter()
+    try:
+        pickle.dump(
+            (dataloader.dataset, dataloader.collate_fn, dataloader.worker_init_fn),
+            counter,  # type: ignore
+        )
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    return counter.size
@@ -0,0 +1,226 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Bounded in-memory cache of tokenized examples."""
+
+import logging
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from transformers.tokenization_utils_base import BatchEncoding
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# rows of the shared statistics, one per process reading examples: the main process
+# and the dataloader workers, workers beyond the rows share them
+STATISTICS_ROWS = 65
+# approximate memory used by an entry besides its arrays
+ENTRY_OVERHEAD = 256
+
+
+def compact(example: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    """Store the sequences of a tokenized example in compact arrays.
+    Args:
+        example: tokenized example.
+    Returns:
+        the compacted example and its approximate size in bytes.
+    """
+    compacted: Dict[str, Any] = {}
+    size = ENTRY_OVERHEAD
+    for key, value in example.items():
+        if isinstance(value, (list, np.ndarray)):
+            array = np.asarray(value)
+            # token ids and labels fit in 32 bits
+            if array.dtype == np.int64 and (
+                array.size == 0 or np.abs(array).max() <= np.iinfo(np.int32).max
+            ):
+                array = array.astype(np.int32)
+            compacted[key] = array
+            size += array.nbytes
+        else:
+            compacted[key] = value
+    return compacted, size
+
+
+def expand(compacted: Dict[str, Any]) -> BatchEncoding:
+    """Restore a tokenized example from its compact arrays.
+    Args:
+        compacted: compacted example.
+    Returns:
+        the tokenized example, with lists as returned by the tokenizer.
+    """
+    return BatchEncoding(
+        data={
+            key: value.tolist() if isinstance(value, np.ndarray) else value
+            for key, value in compacted.items()
+        }
+    )
+
+
+def new_statistics() -> torch.Tensor:
+    """Allocate hit and miss counters shared by the processes reading examples.
+    Returns:
+        a tensor in shared memory, a row of hits and misses per process.
+    """
+    return torch.zeros((STATISTICS_ROWS, 2), dtype=torch.long).share_memory_()
+
+
+class ExampleCache:
+    """Cache of tokenized examples kept in memory within a byte budget.
+
+    Examples are stored in compact arrays and evicted with the CLOCK algorithm, an
+    approximation of LRU where a hit only sets a reference bit. Each process, e.g., each
+    dataloader worker, holds its own entries, while hits and misses are counted in
+    shared memory to be reported by the main process.
+    """
+
+    def __init__(
+        self, max_bytes: int, statistics: Optional[torch.Tensor] = None
+    ) -> None:
+        """Initialize the cache.
+        Args:
+            max_bytes: memory budget in bytes of the entries of a process.
+            statistics: shared hit and miss counters, see new_statistics. Defaults to
+                None, a.k.a., not shared.
+        """
+        self.max_bytes = max_bytes
+        self.statistics = statistics if statistics is not None else new_statistics()
+        self.clear()
+
+    def clear(self) -> None:
+        """Remove all the entries."""
+        self._slots: Dict[Hashable, int] = {}
+        self._keys: List[Optional[Hashable]] = []
+        self._values: List[Optional[Dict[str, Any]]] = []
+        self._sizes: List[int] = []
+        self._referenced = bytearray()
+        self._free: List[int] = []
+        self._hand = 0
+        self.size = 0
+        self._counters: Optional[np.ndarray] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state to pickle, e.g., when spawning dataloader workers.
+        Returns:
+           state of the cache without entries, each process filling its own.
+        """
+        state = self.__dict__.copy()
+        for key in ["_slots", "_keys", "_values", "_sizes", "_free"]:
+            state[key] = type(state[key])()
+        state["_referenced"] = bytearray()
+        state["_hand"] = 0
+        state["size"] = 0
+        state["_counters"] = None
+        return state
+
+    def counters(self) -> np.ndarray:
+        """Hit and miss counters of the current process.
+        Returns:
+            a view on the row of the shared statistics of the process.
+        """
+        if self._counters is None:
+            worker_info = get_worker_info()
+            row = 0 if worker_info is None else 1 + worker_info.id
+            self._counters = self.statistics.numpy()[row % STATISTICS_ROWS]
+        return self._counters
+
+    def get(self, key: Hashable) -> Optional[BatchEncoding]:
+        """Get an example.
+        Args:
+            key: key of the example.
+        Returns:
+            the example, None if not cached.
+        """
+        slot = self._slots.get(key)
+        counters = self.counters()
+        if slot is None:
+            counters[1] += 1
+            return None
+        counters[0] += 1
+        self._referenced[slot] = 1
+        return expand(self._values[slot])  # type: ignore
+
+    def put(self, key: Hashable, example: Dict[str, Any]) -> None:
+        """Cache an example, evicting examples not recently used to stay within budget.
+        Args:
+            key: key of the example.
+            example: tokenized example.
+        """
+        if key in self._slots:
+            return
+        compacted, size = compact(example)
+        if size > self.max_bytes:
+            return
+        while self.size + size > self.max_bytes:
+            self.evict()
+
+        if self._free:
+            slot = self._free.pop()
+            self._keys[slot], self._values[slot] = key, compacted
+            self._sizes[slot], self._referenced[slot] = size, 0
+        else:
+            slot = len(self._keys)
+            self._keys.append(key)
+            self._values.append(compacted)
+            self._sizes.append(size)
+            self._referenced.append(0)
+        self._slots[key] = slot
+        self.size += size
+
+    def evict(self) -> None:
+        """Evict the next entry not referenced since the hand of the clock last passed."""
+        while True:
+            self._hand %= len(self._keys)
+            slot = self._hand
+            self._hand += 1
+            if self._keys[slot] is None:
+                continue
+            if self._referenced[slot]:
+                self._referenced[slot] = 0
+                continue
+            del self._slots[self._keys[slot]]
+            self.size -= self._sizes[slot]
+            self._keys[slot], self._values[slot], self._sizes[slot] = None, None, 0
+            self._free.append(slot)
+            return
+
+    def __len__(self) -> int:
+        """Number of cached examples in the current process.
+        Returns:
+            number of entries.
+        """
+        return len(self._slots)
+
+
+def total_statistics(statistics: torch.Tensor) -> Tuple[int, int]:
+    """Total hits and misses over the processes reading examples.
+    Args:
+        statistics: shared hit and miss counters.
+    Returns:
+        hits and misses.
+    """
+    hits, misses = statistics.sum(dim=0).tolist()
+    return int(hits), int(misses)
@@ -0,0 +1,106 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Mixtures of training sources sampled with given weights."""
+
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+MIXTURE_SEPARATOR = ","
+WEIGHT_SEPARATOR = ":"
+
+
+def parse_mixture(specification: str) -> Optional[List[Tuple[str, Optional[float]]]]:
+    """Parse a mixture of sources, e.g., `corpus/:1,chemistry.jsonl:4`.
+
+    Sources are separated by commas, each one a path, directory or glob pattern
+    optionally followed by a colon and its weight.
+
+    Args:
+        specification: a path or a mixture specification.
+    Returns:
+        the path and weight, None if not given, of each source. None for a single path
+        without weight, a.k.a., not a mixture.
+    Raises:
+        ValueError: in case only some sources have a weight or a weight is negative.
+    """
+    sources: List[Tuple[str, Optional[float]]] = []
+    for source in specification.split(MIXTURE_SEPARATOR):
+        path, separator, weight = source.strip().rpartition(WEIGHT_SEPARATOR)
+        try:
+            sources.append((path, float(weight)) if separator else (weight, None))
+        except ValueError:
+            # a colon in the path
+            sources.append((source.strip(), None))
+
+    if len(sources) == 1 and sources[0][1] is None:
+        return None
+    weights = [weight for _, weight in sources]
+    if any(weight is None for weight in weights) and any(
+        weight is not None for weight in weights
+    ):
+        raise ValueError(
+            f"Either all or none of the sources of {specification} need a weight."
+        )
+    if any(weight is not None and weight < 0 for weight in weights):
+        raise ValueError(f"Weights of {specification} have to be non-negative.")
+    return sources
+
+
+def mixture_probabilities(
+    sizes: Sequence[int],
+    weights: Sequence[Optional[float]],
+    temperature: float = 1.0,
+) -> np.ndarray:
+    """Sampling probability of each source of a mixture.
+
+    Probabilities are proportional to the weights, or to the sizes of the sources if no
+    weight is given, raised to 1 / temperature: higher temperatures flatten the mixture
+    towards uniform sampling of the sources.
+
+    Args:
+        sizes: number of examples of each source.
+        weights: weight of each source, None to weight sources by size.
+        temperature: sampling temperature. Defaults to 1.0.
+    Returns:
+        the probabilities of the sources.
+    Raises:
+        ValueError: in case the temperature is not positive or no source can be sampled.
+    """
+    if temperature <= 0:
+        raise ValueError(f"Mixture temperature has to be positive, got {temperature}.")
+    scores = np.array(
+        [size if weight is None else weight for size, weight in zip(sizes, weights)],
+        dtype=np.float64,
+    )
+    # empty sources are never sampled
+    scores[np.asarray(sizes) == 0] = 0.0
+    if not (scores > 0).any():
+        raise ValueError("No source of the mixture can be sampled.")
+    probabilities = scores ** (1.0 / temperature)
+    return probabilities / probabilities.sum()
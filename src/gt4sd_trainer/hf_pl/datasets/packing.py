@@ -0,0 +1,172 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Packing of short tokenized examples into fixed-length rows."""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from torch.utils.data import Dataset
+from transformers.tokenization_utils_base import BatchEncoding
+
+from .samplers import dataset_lengths, fetch_items
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# values of the keys other than input_ids and labels for appended separators
+SEPARATOR_VALUES = {"attention_mask": 1, "special_tokens_mask": 1}
+
+
+def pack_examples(lengths: np.ndarray, max_length: int) -> np.ndarray:
+    """Greedily pack consecutive examples in rows without splitting them.
+    Args:
+        lengths: number of tokens of each example, including separators.
+        max_length: number of tokens per row.
+    Returns:
+        array of N + 1 example indices, where the i-th row contains the examples
+        between the i-th and the (i + 1)-th indices.
+    """
+    row_starts = [0]
+    row_length = 0
+    for index, length in enumerate(np.minimum(lengths, max_length).tolist()):
+        if row_length + length > max_length:
+            row_starts.append(index)
+            row_length = 0
+        row_length += length
+    if len(lengths):
+        row_starts.append(len(lengths))
+    return np.asarray(row_starts, dtype=np.int64)
+
+
+class PackedDataset(Dataset):
+    """Dataset packing consecutive tokenized examples in rows of fixed length."""
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        max_length: int,
+        pad_values: Dict[str, int],
+        separator_token_id: Optional[int] = None,
+        position_ids: bool = False,
+        document_ids: bool = False,
+    ) -> None:
+        """Initialize the packed dataset.
+        Args:
+            dataset: dataset of tokenized examples without padding.
+            max_length: number of tokens per row.
+            pad_values: value used to pad each key, e.g., -100 for labels.
+            separator_token_id: token appended to examples not ending with it,
+                e.g., EOS for CLM or SEP for MLM. Defaults to None, a.k.a., no separator.
+            position_ids: whether to emit position ids restarting at each example.
+                Defaults to False.
+            document_ids: whether to emit the 1-based index of the example of each token
+                in the row, used to build block-diagonal attention masks. Defaults to False.
+        """
+        self.dataset = dataset
+        self.max_length = max_length
+        self.pad_values = pad_values
+        self.position_ids = position_ids
+        self.document_ids = document_ids
+
+        # tokenizers adding separators already do it for every example
+        self.separator_token_id = separator_token_id
+        if (
+            separator_token_id is not None
+            and len(dataset)  # type: ignore
+            and dataset[0]["input_ids"][-1] == separator_token_id
+        ):
+            self.separator_token_id = None
+
+        lengths = dataset_lengths(dataset)
+        if self.separator_token_id is not None:
+            lengths = lengths + 1
+        self.row_starts = pack_examples(lengths, max_length)
+        self.length = max(0, len(self.row_starts) - 1)
+
+        logger.info(
+            f"Packed {len(lengths)} examples in {self.length} rows of {max_length} tokens "
+            f"(fill ratio: {np.minimum(lengths, max_length).sum() / max(1, self.length * max_length):.3f})"
+        )
+
+    def lengths(self) -> np.ndarray:
+        """Token length of each row.
+        Returns:
+            the number of tokens of each row, including padding.
+        """
+        return np.full(self.length, self.max_length, dtype=np.int64)
+
+    def __len__(self) -> int:
+        """Number of rows of the dataset.
+        Returns:
+           number of rows
+        """
+        return self.length
+
+    def __getitem__(self, index) -> BatchEncoding:
+        """Get a row of the dataset.
+        Args:
+            index: index of the row.
+        Returns:
+            packed examples, with labels set to -100 at the first token of each example
+            but the first one, so that no example is predicted from the previous one.
+        """
+        if index < 0:
+            index += self.length
+        start, end = int(self.row_starts[index]), int(self.row_starts[index + 1])
+
+        row: Dict[str, List[Any]] = {}
+        document_ids: List[int] = []
+        position_ids: List[int] = []
+        examples = fetch_items(self.dataset, range(start, end))
+        for document_id, example in enumerate(map(dict, examples), start=1):
+            if self.separator_token_id is not None:
+                for key, values in example.items():
+                    separator_value = (
+                        self.separator_token_id
+                        if key in {"input_ids", "labels"}
+                        else SEPARATOR_VALUES.get(key, 0)
+                    )
+                    example[key] = list(values) + [separator_value]
+
+            example_length = min(
+                len(example["input_ids"]), self.max_length - len(document_ids)
+            )
+            for key, values in example.items():
+                values = list(values[:example_length])
+                if key == "labels" and document_id > 1 and values:
+                    values[0] = -100
+                row.setdefault(key, []).extend(values)
+            document_ids.extend([document_id] * example_length)
+            position_ids.extend(range(example_length))
+
+        padding_length = self.max_length - len(document_ids)
+        for key, values in row.items():
+            values.extend([self.pad_values.get(key, 0)] * padding_length)
+        if self.position_ids:
+            row["position_ids"] = position_ids + [0] * padding_length
+        if self.document_ids:
+            row["document_ids"] = document_ids + [0] * padding_length
+
+        return BatchEncoding(data=row)
@@ -0,0 +1,152 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Parsing of JSON lines, with optional fast backends and field projection."""
+
+import json
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None  # type: ignore
+
+JSON_BACKENDS = ("auto", "orjson", "simdjson", "json")
+
+
+def parse_fields(fields: Optional[Union[str, Sequence[str]]]) -> Optional[List[str]]:
+    """Parse the fields projected from the examples.
+    Args:
+        fields: comma-separated fields or a sequence of fields, if any.
+    Returns:
+        the fields, None if no field is given.
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    return [field.strip() for field in fields if field.strip()] or None
+
+
+def resolve_json_backend(backend: str, fields: Optional[Sequence[str]] = None) -> str:
+    """Resolve the JSON backend to an installed one.
+    Args:
+        backend: requested backend, one of JSON_BACKENDS. With "auto", simdjson is preferred
+            when projecting fields, since it decodes lazily only the accessed values, then
+            orjson, then the standard library.
+        fields: fields projected, if any.
+    Returns:
+        the installed backend, falling back to the standard library.
+    Raises:
+        ValueError: in case the backend is not supported.
+    """
+    if backend not in JSON_BACKENDS:
+        raise ValueError(
+            f"JSON backend {backend} not supported, use one of {', '.join(JSON_BACKENDS)}."
+        )
+    installed = {"orjson": orjson is not None, "simdjson": simdjson is not None}
+    if backend == "auto":
+        preferences = ["simdjson", "orjson"] if fields else ["orjson", "simdjson"]
+        return next(
+            (candidate for candidate in preferences if installed[candidate]), "json"
+        )
+    if backend != "json" and not installed[backend]:
+        logger.warning(f"{backend} is not installed, falling back to json")
+        return "json"
+    return backend
+
+
+class ExampleParser:
+    """Parser of JSON lines keeping only the projected fields of each example."""
+
+    def __init__(
+        self, backend: str = "auto", fields: Optional[Sequence[str]] = None
+    ) -> None:
+        """Initialize the parser.
+        Args:
+            backend: JSON backend, one of JSON_BACKENDS. Defaults to "auto".
+            fields: fields to keep, all if None. Defaults to None.
+        """
+        self.fields = list(fields) if fields else None
+        self.backend = resolve_json_backend(backend, self.fields)
+        # simdjson parsers are not picklable, they are created lazily in each process
+        self._simdjson_parser: Any = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state to pickle, e.g., when spawning dataloader workers.
+        Returns:
+           state of the parser without backend parser.
+        """
+        state = self.__dict__.copy()
+        state["_simdjson_parser"] = None
+        return state
+
+    def __call__(self, line: Union[bytes, str]) -> Dict[str, Any]:
+        """Parse a JSON line.
+        Args:
+            line: the line.
+        Returns:
+            the example, restricted to the projected fields present in it.
+        """
+        if self.backend == "simdjson":
+            if self._simdjson_parser is None:
+                self._simdjson_parser = simdjson.Parser()
+            if isinstance(line, str):
+                line = line.encode("utf-8")
+            document = self._simdjson_parser.parse(line)
+            if self.fields is None:
+                return document.as_dict()
+            # values are decoded only when accessed, and copied before the parser is reused
+            return {
+                field: self._to_python(document[field])
+                for field in self.fields
+                if field in document
+            }
+
+        example = orjson.loads(line) if self.backend == "orjson" else json.loads(line)
+        if self.fields is None:
+            return example
+        return {field: example[field] for field in self.fields if field in example}
+
+    @staticmethod
+    def _to_python(value: Any) -> Any:
+        """Convert a lazily decoded simdjson value to a Python one.
+        Args:
+            value: the value.
+        Returns:
+            the Python value.
+        """
+        if hasattr(value, "as_dict"):
+            return value.as_dict()
+        if hasattr(value, "as_list"):
+            return value.as_list()
+        return value
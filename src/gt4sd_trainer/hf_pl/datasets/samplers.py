@@ -0,0 +1,884 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Samplers building batches of examples."""
+
+import itertools
+import logging
+from collections import deque
+from typing import Any, Deque, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
+
+import numpy as np
+from torch.utils.data import (
+    BatchSampler,
+    ConcatDataset,
+    Dataset,
+    DistributedSampler,
+    Sampler,
+)
+
+from .collators import round_to_multiple
+from .sharding import distributed_world
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+T = TypeVar("T")
+
+
+def dataset_lengths(dataset: Dataset) -> np.ndarray:
+    """Compute the token length of each example of a dataset.
+    Args:
+        dataset: a dataset of tokenized examples, it can expose a `lengths` method
+            to avoid iterating over all the examples.
+    Returns:
+        the number of input tokens of each example.
+    """
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate(
+            [np.zeros(0, dtype=np.int64)]
+            + [dataset_lengths(child) for child in dataset.datasets]
+        )
+    if hasattr(dataset, "lengths"):
+        return np.asarray(dataset.lengths(), dtype=np.int64)  # type: ignore
+    return np.array(
+        [len(dataset[index]["input_ids"]) for index in range(len(dataset))],  # type: ignore
+        dtype=np.int64,
+    )
+
+
+def fetch_items(dataset: Dataset, indices: Sequence[int]) -> List[Any]:
+    """Fetch several items of a dataset, in a single call if it supports batched fetching.
+    Args:
+        dataset: a dataset, it can expose a `__getitems__` method, e.g., to tokenize
+            all the items at once.
+        indices: indices of the items.
+    Returns:
+        the items.
+    """
+    getitems = getattr(dataset, "__getitems__", None)
+    if getitems is not None:
+        return getitems(list(indices))
+    return [dataset[index] for index in indices]
+
+
+def sorted_buckets(
+    indices: np.ndarray, lengths: np.ndarray, bucket_size: int
+) -> Iterator[np.ndarray]:
+    """Split indices in buckets, each one sorted by decreasing length.
+    Args:
+        indices: example indices.
+        lengths: token length of each example of the dataset.
+        bucket_size: number of examples per bucket.
+    Returns:
+        an iterator over the sorted buckets.
+    """
+    for start in range(0, len(indices), bucket_size):
+        bucket = indices[start : start + bucket_size]
+        yield bucket[np.argsort(-lengths[bucket], kind="stable")]
+
+
+def example_workers(indices: np.ndarray, num_workers: int) -> np.ndarray:
+    """Dataloader worker assigned to each example, e.g., the one caching it.
+
+    Indices are hashed, so that strided shards, e.g., of a DistributedSampler, are spread
+    over all the workers.
+    Args:
+        indices: example indices.
+        num_workers: number of dataloader workers.
+    Returns:
+        the worker of each example.
+    """
+    hashed = np.asarray(indices, dtype=np.uint64) * np.uint64(2654435761)
+    return ((hashed >> np.uint64(16)) % np.uint64(max(1, num_workers))).astype(np.int64)
+
+
+def interleave(groups: Sequence[Sequence[T]]) -> List[T]:
+    """Interleave the items of groups round-robin, the k-th item coming from the group
+    k modulo the number of groups as long as every group has items left.
+
+    Dataloaders hand the k-th batch to the worker k modulo the number of workers, so
+    interleaving the batches of each worker routes them to it.
+    Args:
+        groups: groups of items, e.g., the batches of each worker.
+    Returns:
+        the interleaved items, the surplus of the largest groups at the end.
+    """
+    items: List[T] = []
+    position = 0
+    while True:
+        round_items = [group[position] for group in groups if position < len(group)]
+        if not round_items:
+            return items
+        items.extend(round_items)
+        position += 1
+
+
+def worker_order(indices: np.ndarray, batch_size: int, num_workers: int) -> np.ndarray:
+    """Order of indices batched by a dataloader so that workers load their own examples.
+    Args:
+        indices: example indices, in sampling order.
+        batch_size: number of examples per batch.
+        num_workers: number of dataloader workers.
+    Returns:
+        positions of the indices, in the order chunks of batch_size examples of each
+        worker are interleaved.
+    """
+    if num_workers <= 1:
+        return np.arange(len(indices))
+    workers = example_workers(indices, num_workers)
+    chunks = []
+    for worker in range(num_workers):
+        positions = np.flatnonzero(workers == worker)
+        full = len(positions) - len(positions) % batch_size
+        chunks.append(
+            [
+                positions[start : start + batch_size]
+                for start in range(0, full, batch_size)
+            ]
+        )
+    rounds = min(len(worker_chunks) for worker_chunks in chunks)
+    routed = interleave([worker_chunks[:rounds] for worker_chunks in chunks])
+    # examples beyond the complete rounds are batched together in sampling order
+    routed_positions = np.concatenate([np.zeros(0, dtype=np.int64)] + routed)
+    remaining = np.ones(len(indices), dtype=bool)
+    remaining[routed_positions] = False
+    return np.concatenate([routed_positions, np.flatnonzero(remaining)])
+
+
+def padding_efficiency(
+    batches: Sequence[Sequence[int]],
+    lengths: np.ndarray,
+    pad_to_multiple_of: Optional[int] = None,
+) -> float:
+    """Ratio between real and padded tokens when padding each batch to its longest example.
+    Args:
+        batches: batches of example indices.
+        lengths: token length of each example.
+        pad_to_multiple_of: multiple padded lengths are rounded to. Defaults to None.
+    Returns:
+        the padding efficiency, 1.0 meaning no padding.
+    """
+    real_tokens = 0
+    padded_tokens = 0
+    for batch in batches:
+        batch_lengths = lengths[list(batch)]
+        real_tokens += int(batch_lengths.sum())
+        padded_tokens += len(batch) * round_to_multiple(
+            int(batch_lengths.max()), pad_to_multiple_of
+        )
+    return real_tokens / padded_tokens if padded_tokens else 1.0
+
+
+class ResumableBatchSampler(BatchSampler):
+    """Batch sampler able to resume an epoch after the batches already consumed.
+
+    The consumed batches are skipped as lists of indices, without fetching their
+    examples, only in the first epoch iterated. The length is the one of the whole
+    epoch, since training loops resume counting from the consumed batches.
+    """
+
+    def __init__(
+        self,
+        sampler: Sampler,
+        batch_size: int,
+        drop_last: bool,
+        start_batch: int = 0,
+    ) -> None:
+        """Initialize the batch sampler.
+        Args:
+            sampler: sampler providing example indices.
+            batch_size: number of examples per batch.
+            drop_last: whether to drop the last incomplete batch.
+            start_batch: number of batches of the first epoch to skip. Defaults to 0.
+        """
+        super().__init__(sampler, batch_size, drop_last)
+        self.start_batch = start_batch
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch of the wrapped sampler, if it supports it.
+        Args:
+            epoch: epoch number.
+        """
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)  # type: ignore
+
+    def epoch_batches(self) -> Iterator[List[int]]:
+        """Iterate over all the batches of the current epoch.
+        Returns:
+            an iterator over batches of example indices.
+        """
+        return super().__iter__()
+
+    def __iter__(self) -> Iterator[List[int]]:  # type: ignore
+        """Iterate over the batches of the current epoch not consumed yet.
+        Returns:
+            an iterator over batches of example indices.
+        """
+        # consumed on the first batch drawn, since dataloaders can discard iterators
+        start_batch, self.start_batch = self.start_batch, 0
+        batches = self.epoch_batches()
+        if start_batch > 0:
+            logger.info(f"Resuming the epoch after {start_batch} batches")
+            batches = itertools.islice(batches, start_batch, None)
+        yield from batches
+
+
+class LengthGroupedBatchSampler(ResumableBatchSampler):
+    """Batch sampler grouping examples of similar length to minimize padding.
+
+    Indices drawn from the wrapped sampler are split in buckets of
+    `batch_size * bucket_size_multiplier` examples, each bucket is sorted by length
+    and chunked in batches and, when shuffling, the order of the batches is randomized.
+    Under DDP the wrapped sampler is replaced by a DistributedSampler, so that each
+    process only groups its own indices. With several dataloader workers, examples can
+    be assigned to workers, see example_workers, and batched with examples of the same
+    worker, so that each example is always loaded by the same worker.
+    """
+
+    def __init__(
+        self,
+        sampler: Sampler,
+        batch_size: int,
+        drop_last: bool,
+        lengths: Union[Sequence[int], np.ndarray],
+        bucket_size_multiplier: int = 100,
+        shuffle: bool = True,
+        seed: int = 0,
+        start_batch: int = 0,
+        num_workers: int = 1,
+    ) -> None:
+        """Initialize the batch sampler.
+        Args:
+            sampler: sampler providing example indices.
+            batch_size: number of examples per batch.
+            drop_last: whether to drop the last incomplete batch.
+            lengths: token length of each example of the dataset.
+            bucket_size_multiplier: number of batches grouped in a bucket. Defaults to 100.
+            shuffle: whether to shuffle indices and batches. Defaults to True.
+            seed: random seed, combined with the epoch. Defaults to 0.
+            start_batch: number of batches of the first epoch to skip. Defaults to 0.
+            num_workers: number of dataloader workers examples are assigned to.
+                Defaults to 1, a.k.a., no assignment.
+        """
+        super().__init__(sampler, batch_size, drop_last, start_batch=start_batch)
+        self.lengths = np.asarray(lengths)
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch, changing the random order of the batches, and the one of the
+        wrapped sampler, e.g., the DistributedSampler injected under DDP.
+        Args:
+            epoch: epoch number.
+        """
+        super().set_epoch(epoch)
+        self.epoch = epoch
+
+    def batches(self) -> List[List[int]]:
+        """Build the batches of the current epoch.
+        Returns:
+            list of batches of example indices.
+        """
+        indices = np.fromiter(self.sampler, dtype=np.int64)
+        generator = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            indices = generator.permutation(indices)
+
+        workers = example_workers(indices, self.num_workers)
+        return interleave(
+            [
+                self.group(indices[workers == worker], generator)
+                for worker in range(max(1, self.num_workers))
+            ]
+        )
+
+    def group(
+        self, indices: np.ndarray, generator: np.random.Generator
+    ) -> List[List[int]]:
+        """Group indices in batches of similar length.
+        Args:
+            indices: example indices.
+            generator: random generator shuffling the batches.
+        Returns:
+            list of batches of example indices.
+        """
+        bucket_size = self.batch_size * self.bucket_size_multiplier
+        batches: List[List[int]] = []
+        for bucket in sorted_buckets(indices, self.lengths, bucket_size):
+            batches.extend(
+                bucket[batch_start : batch_start + self.batch_size].tolist()
+                for batch_start in range(0, len(bucket), self.batch_size)
+            )
+
+        # only the very last batch of the last bucket can be incomplete
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[index] for index in generator.permutation(len(batches))]
+        return batches
+
+    def epoch_batches(self) -> Iterator[List[int]]:
+        """Iterate over all the batches of the current epoch.
+        Returns:
+            an iterator over batches of example indices.
+        """
+        return iter(self.batches())
+
+
+class TokenBudgetBatchSampler(ResumableBatchSampler):
+    """Batch sampler building variable-size batches under a budget of padded tokens.
+
+    Examples are grouped in buckets sorted by length and greedily added to a batch
+    as long as the number of tokens of the padded batch stays within the budget.
+    Under DDP, batches are built over the whole dataset with the same random state
+    on every process and distributed round-robin, so that all processes iterate
+    over the same number of batches. Examples can be assigned to dataloader workers,
+    as in LengthGroupedBatchSampler.
+    """
+
+    def __init__(
+        self,
+        sampler: Sampler,
+        max_tokens: int,
+        lengths: Union[Sequence[int], np.ndarray],
+        drop_last: bool = False,
+        pad_to_multiple_of: Optional[int] = None,
+        bucket_size_multiplier: int = 100,
+        shuffle: bool = True,
+        seed: int = 0,
+        start_batch: int = 0,
+        num_workers: int = 1,
+    ) -> None:
+        """Initialize the batch sampler.
+        Args:
+            sampler: sampler providing example indices, a DistributedSampler under DDP.
+            max_tokens: maximum number of padded tokens per batch.
+            lengths: token length of each example of the dataset.
+            drop_last: whether to drop batches not evenly divisible across processes,
+                instead of repeating some of them. Defaults to False.
+            pad_to_multiple_of: multiple padded lengths are rounded to. Defaults to None.
+            bucket_size_multiplier: number of batches, of average length examples,
+                grouped in a bucket. Defaults to 100.
+            shuffle: whether to shuffle indices and batches. Defaults to True.
+            seed: random seed, combined with the epoch. Defaults to 0.
+            start_batch: number of batches of the first epoch to skip. Defaults to 0.
+            num_workers: number of dataloader workers examples are assigned to.
+                Defaults to 1, a.k.a., no assignment.
+        """
+        # BatchSampler.__init__ is not called since the batch size is variable
+        self.sampler = sampler
+        self.batch_size = None  # type: ignore
+        self.drop_last = drop_last
+        self.max_tokens = max_tokens
+        self.lengths = np.asarray(lengths)
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+        self.start_batch = start_batch
+        self._batches: Optional[List[List[int]]] = None
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch, changing the random order of the batches.
+        Args:
+            epoch: epoch number.
+        """
+        if epoch != self.epoch:
+            self._batches = None
+        super().set_epoch(epoch)
+        self.epoch = epoch
+
+    def split(self, indices: np.ndarray) -> List[List[int]]:
+        """Split examples in batches within the token budget.
+        Args:
+            indices: example indices, sorted by decreasing length.
+        Returns:
+            list of batches of example indices.
+        """
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        batch_length = 0
+        for index in indices.tolist():
+            length = max(
+                batch_length,
+                round_to_multiple(int(self.lengths[index]), self.pad_to_multiple_of),
+            )
+            if batch and length * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                length = round_to_multiple(
+                    int(self.lengths[index]), self.pad_to_multiple_of
+                )
+            batch.append(index)
+            batch_length = length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self) -> List[List[int]]:
+        """Build the batches of the current process for the current epoch.
+        Returns:
+            list of batches of example indices.
+        """
+        if self._batches is not None:
+            return self._batches
+
+        if isinstance(self.sampler, DistributedSampler):
+            num_replicas, rank = self.sampler.num_replicas, self.sampler.rank
+            indices = np.arange(len(self.sampler.dataset))  # type: ignore
+        else:
+            num_replicas, rank = 1, 0
+            indices = np.fromiter(self.sampler, dtype=np.int64)
+
+        generator = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            indices = generator.permutation(indices)
+
+        average_length = (
+            max(1, int(self.lengths[indices].mean())) if len(indices) else 1
+        )
+        bucket_size = self.bucket_size_multiplier * max(
+            1, self.max_tokens // average_length
+        )
+        # batches of each worker distributed to the processes, then interleaved
+        workers = example_workers(indices, self.num_workers)
+        worker_batches: List[List[List[int]]] = []
+        for worker in range(max(1, self.num_workers)):
+            batches: List[List[int]] = []
+            for bucket in sorted_buckets(
+                indices[workers == worker], self.lengths, bucket_size
+            ):
+                batches.extend(self.split(bucket))
+
+            if self.shuffle:
+                batches = [
+                    batches[index] for index in generator.permutation(len(batches))
+                ]
+
+            if num_replicas > 1:
+                if self.drop_last:
+                    batches = batches[: len(batches) - len(batches) % num_replicas]
+                elif batches:
+                    padding = -len(batches) % num_replicas
+                    batches += [
+                        batches[index % len(batches)] for index in range(padding)
+                    ]
+                batches = batches[rank::num_replicas]
+            worker_batches.append(batches)
+
+        self._batches = interleave(worker_batches)
+        return self._batches
+
+    def epoch_batches(self) -> Iterator[List[int]]:
+        """Iterate over all the batches of the current epoch.
+        Returns:
+            an iterator over batches of example indices.
+        """
+        return iter(self.batches())
+
+    def __len__(self) -> int:
+        """Number of batches of the current epoch.
+        Returns:
+            number of batches.
+        """
+        return len(self.batches())
+
+
+class EvenBatchSampler(ResumableBatchSampler):
+    """Batch sampler yielding a fixed number of batches of another batch sampler.
+
+    Extra batches are dropped and missing ones are repeated from the start, so that
+    DDP processes sampling different shards iterate over the same number of batches.
+    """
+
+    def __init__(
+        self, batch_sampler: BatchSampler, number_of_batches: int, start_batch: int = 0
+    ) -> None:
+        """Initialize the batch sampler.
+        Args:
+            batch_sampler: batch sampler providing the batches.
+            number_of_batches: number of batches per epoch.
+            start_batch: number of batches of the first epoch to skip. Defaults to 0.
+        """
+        # BatchSampler.__init__ is not called since batches come from another sampler
+        self.batch_sampler = batch_sampler
+        self.sampler = batch_sampler.sampler
+        self.batch_size = batch_sampler.batch_size
+        self.drop_last = batch_sampler.drop_last
+        self.number_of_batches = number_of_batches
+        self.start_batch = start_batch
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch of the wrapped samplers.
+        Args:
+            epoch: epoch number.
+        """
+        for sampler in (self.batch_sampler, self.sampler):
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(epoch)  # type: ignore
+
+    def epoch_batches(self) -> Iterator[List[int]]:
+        """Iterate over all the batches of the current epoch.
+        Returns:
+            an iterator over batches of example indices.
+        """
+        number_of_batches = 0
+        while number_of_batches < self.number_of_batches:
+            empty = True
+            for batch in self.batch_sampler:
+                if number_of_batches == self.number_of_batches:
+                    return
+                empty = False
+                number_of_batches += 1
+                yield batch
+            if empty:
+                return
+
+    def __len__(self) -> int:
+        """Number of batches per epoch.
+        Returns:
+            number of batches.
+        """
+        return self.number_of_batches
+
+
+class WorkerRoutedSampler(Sampler):
+    """Sampler reordering the indices of another sampler, see worker_order, so that
+    dataloader workers load their own examples whatever the shuffling of the epoch.
+    """
+
+    def __init__(self, sampler: Sampler, batch_size: int, num_workers: int) -> None:
+        """Initialize the sampler.
+        Args:
+            sampler: sampler providing example indices.
+            batch_size: number of examples per batch.
+            num_workers: number of dataloader workers.
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch of the wrapped sampler.
+        Args:
+            epoch: epoch number.
+        """
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)  # type: ignore
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the indices of the wrapped sampler, routed to the workers.
+        Returns:
+            an iterator over example indices.
+        """
+        indices = np.fromiter(self.sampler, dtype=np.int64)
+        yield from indices[
+            worker_order(indices, self.batch_size, self.num_workers)
+        ].tolist()
+
+    def __len__(self) -> int:
+        """Number of indices per epoch.
+        Returns:
+            number of indices.
+        """
+        return len(self.sampler)  # type: ignore
+
+
+class BlockShuffleSampler(DistributedSampler):
+    """Sampler shuffling blocks of contiguous examples, for mostly sequential reads.
+
+    The order of blocks of `block_size` contiguous examples, never crossing the files
+    of a ConcatDataset, is randomized and the examples of `window_blocks` consecutive
+    blocks are shuffled together. Under DDP blocks are distributed round-robin, so that
+    each process reads whole blocks, and the indices of each process are repeated or
+    truncated to the same number of samples. The order is deterministic given seed
+    and epoch.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        block_size: int,
+        window_blocks: int = 16,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+        start_index: int = 0,
+        batch_size: int = 1,
+        num_workers: int = 1,
+    ) -> None:
+        """Initialize the sampler.
+        Args:
+            dataset: dataset to sample, a ConcatDataset to keep blocks within its datasets.
+            block_size: number of contiguous examples per block.
+            window_blocks: number of consecutive blocks whose examples are shuffled
+                together. Defaults to 16.
+            num_replicas: number of DDP processes. Defaults to None, a.k.a., from
+                torch.distributed or 1.
+            rank: rank of the current process. Defaults to None, a.k.a., from
+                torch.distributed or 0.
+            shuffle: whether to shuffle, otherwise examples are read sequentially.
+                Defaults to True.
+            seed: random seed, combined with the epoch. Defaults to 0.
+            drop_last: whether to truncate, rather than pad, the samples of the processes
+                to the same number. Defaults to False.
+            start_index: number of samples of the first epoch to skip, when resuming
+                an epoch. Defaults to 0.
+            batch_size: number of examples per batch, to route batches to workers.
+                Defaults to 1.
+            num_workers: number of dataloader workers examples are assigned to, see
+                worker_order. Defaults to 1, a.k.a., no assignment.
+        """
+        if num_replicas is None or rank is None:
+            num_replicas, rank = distributed_world()
+        super().__init__(
+            dataset,
+            num_replicas=num_replicas,
+            rank=rank,
+            shuffle=shuffle,
+            seed=seed,
+            drop_last=drop_last,
+        )
+        self.block_size = block_size
+        self.window_blocks = window_blocks
+        self.start_index = start_index
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self._blocks: Optional[np.ndarray] = None
+
+    def blocks(self) -> np.ndarray:
+        """Boundaries of the blocks, cut at the boundaries of concatenated datasets.
+        Returns:
+            array of shape (number_of_blocks, 2) with the start and end of each block.
+        """
+        if self._blocks is not None:
+            return self._blocks
+
+        if isinstance(self.dataset, ConcatDataset):
+            ends = self.dataset.cumulative_sizes
+        else:
+            ends = [len(self.dataset)]  # type: ignore
+        blocks = [
+            (block_start, min(block_start + self.block_size, end))
+            for start, end in zip([0] + list(ends[:-1]), ends)
+            for block_start in range(start, end, self.block_size)
+        ]
+        self._blocks = np.array(blocks, dtype=np.int64).reshape(-1, 2)
+        return self._blocks
+
+    def process_indices(self, order: np.ndarray, rank: int) -> np.ndarray:
+        """Indices of the blocks of a process, shuffled within windows.
+        Args:
+            order: order of the blocks in the current epoch.
+            rank: rank of the process.
+        Returns:
+            the example indices of the process.
+        """
+        blocks = self.blocks()
+        # distinct generators for the windows of each process
+        generator = np.random.default_rng([self.seed + self.epoch, rank])
+        process_blocks = order[rank :: self.num_replicas]
+        windows = [np.zeros(0, dtype=np.int64)]
+        for window_start in range(0, len(process_blocks), self.window_blocks):
+            window = np.concatenate(
+                [
+                    np.arange(start, end)
+                    for start, end in blocks[
+                        process_blocks[window_start : window_start + self.window_blocks]
+                    ]
+                ]
+            )
+            if self.shuffle:
+                generator.shuffle(window)
+            windows.append(window)
+        return np.concatenate(windows)
+
+    def indices(self) -> np.ndarray:
+        """Indices sampled by the current process in the current epoch.
+
+        Processes with more than `num_samples` indices hand their surplus over to the
+        ones with fewer, which then repeat their indices only if needed.
+
+        Returns:
+            the example indices.
+        """
+        order = np.arange(len(self.blocks()))
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(order)
+        if self.num_replicas == 1:
+            return self.process_indices(order, 0)[: self.num_samples]
+
+        # every process computes the same assignment
+        processes = [
+            self.process_indices(order, rank) for rank in range(self.num_replicas)
+        ]
+        indices = processes[self.rank][: self.num_samples]
+        missing = self.num_samples - len(indices)
+        if missing > 0:
+            surplus = np.concatenate(
+                [np.zeros(0, dtype=np.int64)]
+                + [process[self.num_samples :] for process in processes]
+            )
+            offset = sum(
+                max(self.num_samples - len(process), 0)
+                for process in processes[: self.rank]
+            )
+            indices = np.concatenate([indices, surplus[offset : offset + missing]])
+            if len(indices) == 0:
+                # more processes than examples
+                indices = np.arange(len(self.dataset))  # type: ignore
+            indices = np.resize(indices, self.num_samples)
+        return indices
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the indices of the current epoch not consumed yet.
+        Returns:
+            an iterator over example indices.
+        """
+        # consumed on the first index drawn, since dataloaders can discard iterators
+        start_index, self.start_index = self.start_index, 0
+        indices = self.indices()
+        indices = indices[worker_order(indices, self.batch_size, self.num_workers)]
+        yield from indices[start_index:].tolist()
+
+
+class MixtureSampler(DistributedSampler):
+    """Sampler drawing examples from the datasets of a ConcatDataset with given probabilities.
+
+    Each sample picks a source with its probability, then the next example of a random
+    permutation of that source, re-shuffled once exhausted, so that sources are upweighted
+    or downweighted without copying them. An epoch has as many samples as the
+    concatenated dataset. Under DDP every process draws the same global sequence and keeps
+    every `num_replicas`-th sample. The sources of the indices yielded and not consumed
+    yet are kept in `sources`, in order, for per-source accounting.
+    """
+
+    def __init__(
+        self,
+        dataset: ConcatDataset,
+        probabilities: Union[Sequence[float], np.ndarray],
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        seed: int = 0,
+        drop_last: bool = False,
+        start_index: int = 0,
+        batch_size: int = 1,
+        num_workers: int = 1,
+    ) -> None:
+        """Initialize the sampler.
+        Args:
+            dataset: concatenation of the sources.
+            probabilities: sampling probability of each source.
+            num_replicas: number of DDP processes. Defaults to None, a.k.a., from
+                torch.distributed or 1.
+            rank: rank of the current process. Defaults to None, a.k.a., from
+                torch.distributed or 0.
+            seed: random seed, combined with the epoch. Defaults to 0.
+            drop_last: whether to round the samples of each process down, rather than up.
+                Defaults to False.
+            start_index: number of samples of the first epoch to skip, when resuming
+                an epoch. Defaults to 0.
+            batch_size: number of examples per batch, to route batches to workers.
+                Defaults to 1.
+            num_workers: number of dataloader workers examples are assigned to, see
+                worker_order. Defaults to 1, a.k.a., no assignment.
+        Raises:
+            ValueError: in case the probabilities do not match the sources or an empty
+                source has a non-zero probability.
+        """
+        if num_replicas is None or rank is None:
+            num_replicas, rank = distributed_world()
+        super().__init__(
+            dataset,
+            num_replicas=num_replicas,
+            rank=rank,
+            shuffle=True,
+            seed=seed,
+            drop_last=drop_last,
+        )
+        self.offsets = np.array([0] + list(dataset.cumulative_sizes), dtype=np.int64)
+        source_lengths = np.diff(self.offsets)
+        if len(probabilities) != len(source_lengths):
+            raise ValueError(
+                f"{len(probabilities)} probabilities for {len(source_lengths)} sources."
+            )
+        self.probabilities = np.asarray(probabilities, dtype=np.float64)
+        self.probabilities /= self.probabilities.sum()
+        if ((self.probabilities > 0) & (source_lengths == 0)).any():
+            raise ValueError("Empty sources can not be sampled.")
+        self.start_index = start_index
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.sources: Deque[int] = deque()
+
+    def draw(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Draw the samples of all the processes in the current epoch.
+        Returns:
+            the source and the example index of each sample.
+        """
+        generator = np.random.default_rng(self.seed + self.epoch)
+        sources = generator.choice(
+            len(self.probabilities), size=self.total_size, p=self.probabilities
+        )
+        indices = np.empty(self.total_size, dtype=np.int64)
+        for source, count in enumerate(
+            np.bincount(sources, minlength=len(self.probabilities))
+        ):
+            if count == 0:
+                continue
+            length = int(self.offsets[source + 1] - self.offsets[source])
+            # permutations of the source, as many as needed to draw count examples
+            permutations = [
+                generator.permutation(length) for _ in range(-(-count // length))
+            ]
+            indices[sources == source] = (
+                self.offsets[source] + np.concatenate(permutations)[:count]
+            )
+        return sources, indices
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the indices of the current epoch not consumed yet.
+        Returns:
+            an iterator over example indices.
+        """
+        # consumed on the first index drawn, since dataloaders can discard iterators
+        start_index, self.start_index = self.start_index, 0
+        self.sources.clear()
+        sources, indices = self.draw()
+        sources = sources[self.rank :: self.num_replicas]
+        indices = indices[self.rank :: self.num_replicas]
+        order = worker_order(indices, self.batch_size, self.num_workers)
+        for source, index in zip(
+            sources[order][start_index:].tolist(),
+            indices[order][start_index:].tolist(),
+        ):
+            self.sources.append(source)
+            yield index
@@ -0,0 +1,191 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Sharding of dataset files across DDP processes."""
+
+import heapq
+import logging
+import os
+from typing import Any, Callable, List, Sequence, Tuple
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# variables set by the launchers detected by lightning: torchrun, SLURM and LSF
+LOCAL_RANK_VARIABLES = ("LOCAL_RANK", "SLURM_LOCALID", "JSM_NAMESPACE_LOCAL_RANK")
+LOCAL_WORLD_SIZE_VARIABLES = (
+    "LOCAL_WORLD_SIZE",
+    "SLURM_NTASKS_PER_NODE",
+    "JSM_NAMESPACE_LOCAL_SIZE",
+)
+
+
+def distributed_world() -> Tuple[int, int]:
+    """Number of DDP processes and rank of the current one.
+    Returns:
+        number of replicas and rank, 1 and 0 if not distributed.
+    """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size(), dist.get_rank()
+    return 1, 0
+
+
+def environment_value(variables: Sequence[str], default: int) -> int:
+    """Read an integer from the first environment variable set.
+    Args:
+        variables: names of the variables, by priority.
+        default: value if no variable is set.
+    Returns:
+        the value of the first variable set, the default otherwise.
+    """
+    for variable in variables:
+        if variable in os.environ:
+            return int(os.environ[variable])
+    return default
+
+
+def local_rank() -> int:
+    """Rank of the current process among the processes of its node.
+
+    Read from the environment set by the launchers, since datasets can be built before
+    the process group is initialized.
+    Returns:
+        local rank, 0 if not distributed.
+    """
+    return environment_value(LOCAL_RANK_VARIABLES, 0)
+
+
+def local_world_size() -> int:
+    """Number of processes of the node of the current process.
+
+    Read from the environment set by the launchers, see local_rank.
+    Returns:
+        local world size, 1 if not distributed.
+    """
+    return environment_value(LOCAL_WORLD_SIZE_VARIABLES, 1)
+
+
+def balanced_assignment(
+    weights: Sequence[int], number_of_shards: int
+) -> List[List[int]]:
+    """Assign items to shards balancing their total weight, largest items first.
+    Args:
+        weights: weight of each item, e.g., the size of a file.
+        number_of_shards: number of shards.
+    Returns:
+        sorted item indices of each shard.
+    """
+    shards: List[List[int]] = [[] for _ in range(number_of_shards)]
+    # ties are broken by shard index to be deterministic
+    loads = [(0, shard) for shard in range(number_of_shards)]
+    for index in sorted(range(len(weights)), key=lambda index: -weights[index]):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(index)
+        heapq.heappush(loads, (load + weights[index], shard))
+    return [sorted(shard) for shard in shards]
+
+
+def broadcast_from_rank_zero(function: Callable[[], Any]) -> Any:
+    """Compute a value on rank 0 only and broadcast it to the other processes.
+    Args:
+        function: function computing the value.
+    Returns:
+        the value computed on rank 0.
+    """
+    num_replicas, rank = distributed_world()
+    if num_replicas == 1:
+        return function()
+    objects = [function() if rank == 0 else None]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def max_across_ranks(value: int) -> int:
+    """Maximum of a value over the DDP processes.
+    Args:
+        value: value of the current process.
+    Returns:
+        the maximum value.
+    """
+    num_replicas, _ = distributed_world()
+    if num_replicas == 1:
+        return value
+    values: List[Any] = [None] * num_replicas
+    dist.all_gather_object(values, value)
+    return max(values)
+
+
+def all_across_ranks(value: bool) -> bool:
+    """Whether a condition holds on all the DDP processes.
+
+    Reduced as a tensor rather than gathered as objects, since it is cheap enough to
+    be called for every batch.
+    Args:
+        value: condition on the current process.
+    Returns:
+        whether the condition holds on every process.
+    """
+    num_replicas, _ = distributed_world()
+    if num_replicas == 1:
+        return value
+    device = (
+        torch.device("cuda", torch.cuda.current_device())
+        if dist.get_backend() == "nccl"
+        else torch.device("cpu")
+    )
+    flag = torch.tensor([int(value)], device=device)
+    dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+    return bool(flag.item())
+
+
+def sum_across_ranks(values: Sequence[int]) -> List[int]:
+    """Element-wise sum of values over the DDP processes.
+    Args:
+        values: values of the current process.
+    Returns:
+        the summed values.
+    """
+    num_replicas, _ = distributed_world()
+    if num_replicas == 1:
+        return list(values)
+    gathered: List[Any] = [None] * num_replicas
+    dist.all_gather_object(gathered, list(values))
+    return [sum(process_values) for process_values in zip(*gathered)]
+
+
+def gather_across_ranks(value: Any) -> List[Any]:
+    """Gather a value from each DDP process.
+    Args:
+        value: value of the current process, picklable.
+    Returns:
+        the values of the processes, by rank.
+    """
+    num_replicas, _ = distributed_world()
+    if num_replicas == 1:
+        return [value]
+    values: List[Any] = [None] * num_replicas
+    dist.all_gather_object(values, value)
+    return values
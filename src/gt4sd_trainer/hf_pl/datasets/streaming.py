@@ -0,0 +1,313 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Streaming datasets for corpora that do not fit in memory."""
+
+import itertools
+import json
+import logging
+import os
+import random
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from transformers.tokenization_utils_base import BatchEncoding
+
+from .compression import BlockReader, compression_type, open_compressed
+from .echoing import EchoingDataLoader
+from .sharding import all_across_ranks, distributed_world
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class StreamingLMDataset(IterableDataset):
+    """LM dataset streaming examples sequentially from line-delimited files.
+
+    Files, or byte ranges of files when there are fewer files than readers, are
+    sharded without overlap across DDP processes and dataloader workers, so that no
+    up-front scan of the files is needed. Shuffling is approximated with a buffer.
+    Shards hold different numbers of examples, see StreamingDataLoader for evening
+    out the batches of DDP processes and for changing the shuffling order every epoch.
+    """
+
+    def __init__(
+        self,
+        filepaths: List[str],
+        tokenizer: Callable,
+        shuffle_buffer_size: int = 0,
+        seed: int = 0,
+        read_buffer_size: int = 2**22,
+        parser: Optional[Callable[[bytes], Dict[str, Any]]] = None,
+    ) -> None:
+        """Initialize the streaming dataset.
+        Args:
+            filepaths: paths of the files of the dataset.
+            tokenizer: tokenize function to be used in the module.
+            shuffle_buffer_size: number of examples in the shuffle buffer, no shuffling
+                if 0. Defaults to 0.
+            seed: random seed for shuffling. Defaults to 0.
+            read_buffer_size: size in bytes of the buffered reads. Defaults to 4MiB.
+            parser: function parsing a JSON line in an example. Defaults to None,
+                a.k.a., json.loads.
+        """
+        # sorted to have the same sharding on every process
+        self.filepaths = sorted(filepaths)
+        self.tokenizer = tokenizer
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.read_buffer_size = read_buffer_size
+        self.parser = parser if parser is not None else json.loads
+        # in shared memory, so that persistent dataloader workers see epoch changes
+        self._epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.num_replicas: Optional[int] = None
+        self.rank: Optional[int] = None
+
+    @property
+    def epoch(self) -> int:
+        """Epoch, shared with the dataloader workers.
+        Returns:
+            epoch number.
+        """
+        return int(self._epoch.item())
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch, changing the shuffling order, also in the dataloader workers.
+        Args:
+            epoch: epoch number.
+        """
+        self._epoch.fill_(epoch)
+
+    def distributed_shard(self) -> Tuple[int, int]:
+        """Number of DDP processes and rank of the current one.
+        Returns:
+            number of replicas and rank, explicitly set or from torch.distributed.
+        """
+        if self.num_replicas is not None and self.rank is not None:
+            return self.num_replicas, self.rank
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_world_size(), dist.get_rank()
+        return 1, 0
+
+    def shard_ranges(
+        self, shard: int, number_of_shards: int
+    ) -> List[Tuple[str, int, Optional[int]]]:
+        """Byte ranges of the files read by a shard.
+        Args:
+            shard: index of the shard.
+            number_of_shards: number of shards.
+        Returns:
+            list of file paths with start and end, None for the end of file, byte offsets.
+        """
+        if len(self.filepaths) >= number_of_shards:
+            return [
+                (filepath, 0, None)
+                for filepath in self.filepaths[shard::number_of_shards]
+            ]
+        ranges: List[Tuple[str, int, Optional[int]]] = []
+        for filepath in self.filepaths:
+            size = os.path.getsize(filepath)
+            ranges.append(
+                (
+                    filepath,
+                    size * shard // number_of_shards,
+                    size * (shard + 1) // number_of_shards,
+                )
+            )
+        return ranges
+
+    def read_shard(self, shard: int, number_of_shards: int) -> Iterator[Dict[str, Any]]:
+        """Read the examples of a shard.
+
+        Compressed files with fewer blocks than shards, e.g., compressed in one go, can
+        not be split in byte ranges: every shard decompresses them and keeps its lines.
+        Args:
+            shard: index of the shard.
+            number_of_shards: number of shards.
+        Returns:
+            an iterator over the examples.
+        """
+        for filepath, start, end in self.shard_ranges(shard, number_of_shards):
+            if (
+                end is not None
+                and compression_type(filepath) is not None
+                and BlockReader(filepath).number_of_blocks < number_of_shards
+            ):
+                with open_compressed(filepath) as fp:
+                    for line in itertools.islice(fp, shard, None, number_of_shards):
+                        if line.strip():
+                            yield self.parser(line)
+            else:
+                yield from self.read_range(filepath, start, end)
+
+    def read_range(
+        self, filepath: str, start: int, end: Optional[int]
+    ) -> Iterator[Dict[str, Any]]:
+        """Read the examples whose line starts in a byte range of a file.
+        Args:
+            filepath: path of the file.
+            start: start of the range.
+            end: end of the range, None for the end of file.
+        Returns:
+            an iterator over the examples.
+        """
+        if compression_type(filepath) is not None:
+            yield from self.read_compressed_range(filepath, start, end)
+            return
+
+        with open(filepath, "rb", buffering=self.read_buffer_size) as fp:
+            if start > 0:
+                # skip the line started in the previous range
+                fp.seek(start - 1)
+                fp.readline()
+            position = fp.tell()
+            while end is None or position < end:
+                line = fp.readline()
+                if not line:
+                    break
+                position += len(line)
+                if line.strip():
+                    yield self.parser(line)
+
+    def read_compressed_range(
+        self, filepath: str, start: int, end: Optional[int]
+    ) -> Iterator[Dict[str, Any]]:
+        """Read the examples of the blocks starting in a byte range of a compressed file.
+        Args:
+            filepath: path of the file.
+            start: start of the range.
+            end: end of the range, None for the end of file.
+        Returns:
+            an iterator over the examples.
+        """
+        if start == 0 and end is None:
+            # whole files are decompressed sequentially without a block index
+            with open_compressed(filepath) as fp:
+                for line in fp:
+                    if line.strip():
+                        yield self.parser(line)
+            return
+
+        for line in BlockReader(filepath).read_blocks(start, end):
+            if line.strip():
+                yield self.parser(line)
+
+    def shuffle(
+        self, examples: Iterator[Dict[str, Any]], generator: random.Random
+    ) -> Iterator[Dict[str, Any]]:
+        """Approximately shuffle examples using a buffer.
+        Args:
+            examples: iterator over examples.
+            generator: random generator.
+        Returns:
+            an iterator over the shuffled examples.
+        """
+        buffer: List[Dict[str, Any]] = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(example)
+                continue
+            index = generator.randrange(len(buffer))
+            yield buffer[index]
+            buffer[index] = example
+        generator.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Iterator[BatchEncoding]:
+        """Iterate over the tokenized examples of the current process and worker.
+        Returns:
+            an iterator over tokenized examples.
+        """
+        num_replicas, rank = self.distributed_shard()
+        worker_info = get_worker_info()
+        if worker_info is None:
+            num_workers, worker_id = 1, 0
+        else:
+            num_workers, worker_id = worker_info.num_workers, worker_info.id
+
+        shard = rank * num_workers + worker_id
+        examples = self.read_shard(shard, num_replicas * num_workers)
+        if self.shuffle_buffer_size > 0:
+            # a different order every epoch, see StreamingDataLoader
+            seed = self.seed + self.epoch
+            examples = self.shuffle(examples, random.Random(seed + shard))
+
+        for example in examples:
+            yield self.tokenizer(example)
+
+
+def even_batches(batches: Iterator[Any]) -> Iterator[Any]:
+    """Yield batches as long as every DDP process has one.
+
+    Stops all the processes with the first exhausted one, so that they run the same
+    number of steps, at the cost of a reduction per batch. The extra batches of the
+    other processes are dropped for the epoch.
+    Args:
+        batches: iterator over the batches of the current process.
+    Returns:
+        an iterator over the batches.
+    """
+    exhausted = object()
+    while True:
+        batch = next(batches, exhausted)
+        if not all_across_ranks(batch is not exhausted):
+            if batch is not exhausted:
+                logger.debug("Batches dropped, another process ran out of examples")
+            return
+        yield batch
+
+
+class StreamingDataLoader(DataLoader):
+    """DataLoader of streaming datasets yielding the same number of batches on every
+    DDP process, see even_batches.
+
+    Each iteration is a new epoch of the dataset, changing its shuffling order. The
+    epoch is set before the workers, persistent or not, start iterating.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the dataloader.
+        Args:
+            args: positional arguments of the DataLoader.
+            kwargs: keyword arguments of the DataLoader.
+        """
+        super().__init__(*args, **kwargs)
+        self.epoch = 0
+
+    def __iter__(self) -> Iterator[Any]:  # type: ignore
+        """Iterate over the batches of the next epoch.
+        Returns:
+            an iterator over the batches, stopped with the first exhausted process.
+        """
+        if isinstance(self.dataset, StreamingLMDataset):
+            self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        num_replicas, _ = distributed_world()
+        batches = super().__iter__()
+        return batches if num_replicas == 1 else even_batches(batches)
+
+
+class EchoingStreamingDataLoader(EchoingDataLoader, StreamingDataLoader):
+    """EchoingDataLoader of streaming datasets, echoing the evened out batches."""
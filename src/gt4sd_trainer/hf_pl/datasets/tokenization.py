@@ -0,0 +1,166 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tokenize functions shipped to dataloader workers."""
+
+import logging
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+from transformers import AutoTokenizer
+from transformers.tokenization_utils_base import BatchEncoding
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class TokenizeFunction:
+    """Function tokenizing the text of examples.
+
+    Datasets hold a tokenize function rather than a bound method of their data module,
+    so that only the tokenizer and the tokenization settings are pickled into dataloader
+    workers and preprocessing processes, not the data module with its datasets, collator
+    and, for conditional generation, model.
+    """
+
+    def __init__(
+        self,
+        tokenizer: AutoTokenizer,
+        truncation: bool = True,
+        padding: Union[bool, str] = "max_length",
+        max_length: int = 512,
+    ) -> None:
+        """Initialize the tokenize function.
+        Args:
+            tokenizer: tokenizer to be used.
+            truncation: whether to truncate sequences to max_length. Defaults to True.
+            padding: padding strategy. Defaults to max_length.
+            max_length: maximum length of the sequences. Defaults to 512.
+        """
+        self.tokenizer = tokenizer
+        self.truncation = truncation
+        self.padding = padding
+        self.max_length = max_length
+
+    def tokenize(self, texts: Union[str, List[str]]) -> BatchEncoding:
+        """Tokenize texts with the tokenization settings.
+        Args:
+            texts: a text or a list of texts.
+        Returns:
+            tokenized texts.
+        """
+        return self.tokenizer(  # type: ignore
+            texts,
+            truncation=self.truncation,
+            padding=self.padding,
+            max_length=self.max_length,
+        )
+
+    def __call__(self, examples: Dict[str, Any]) -> BatchEncoding:
+        """Tokenize the given examples.
+        Args:
+            examples: an example or the columns of several examples.
+        Returns:
+            tokenized examples.
+        """
+        return self.tokenize(examples["text"])
+
+
+class CausalLanguageModelingTokenizeFunction(TokenizeFunction):
+    """Function tokenizing the text of examples, labelled with their input ids."""
+
+    def __call__(self, examples: Dict[str, Any]) -> BatchEncoding:
+        """Tokenize the given examples.
+        Args:
+            examples: an example or the columns of several examples.
+        Returns:
+            tokenized examples, including labels.
+        """
+        tokenized_data = super().__call__(examples)
+
+        tokenized_data["labels"] = tokenized_data["input_ids"].copy()
+
+        return tokenized_data
+
+
+class ConditionalGenerationTokenizeFunction(TokenizeFunction):
+    """Function tokenizing the source and target of examples, with separate lengths."""
+
+    def __init__(
+        self,
+        tokenizer: AutoTokenizer,
+        truncation: bool = True,
+        padding: Union[bool, str] = "max_length",
+        max_length: int = 512,
+        max_target_length: Optional[int] = None,
+    ) -> None:
+        """Initialize the tokenize function.
+        Args:
+            tokenizer: tokenizer to be used.
+            truncation: whether to truncate sequences to their maximum length. Defaults to True.
+            padding: padding strategy. Defaults to max_length.
+            max_length: maximum length of the sources. Defaults to 512.
+            max_target_length: maximum length of the targets. Defaults to None, a.k.a.,
+                max_length.
+        """
+        super().__init__(
+            tokenizer, truncation=truncation, padding=padding, max_length=max_length
+        )
+        self.max_target_length = max_target_length or max_length
+
+    def tokenize_targets(self, texts: Union[str, List[str]]) -> BatchEncoding:
+        """Tokenize target texts with the tokenization settings of the targets.
+        Args:
+            texts: a text or a list of texts.
+        Returns:
+            tokenized texts.
+        """
+        return self.tokenizer(  # type: ignore
+            text_target=texts,
+            truncation=self.truncation,
+            padding=self.padding,
+            max_length=self.max_target_length,
+        )
+
+    def __call__(self, examples: Dict[str, Any]) -> BatchEncoding:
+        """Tokenize the given examples.
+        Args:
+            examples: an example or the columns of several examples.
+        Returns:
+            tokenized sources, with the tokenized targets as labels, -100 for padding.
+        """
+        data_inputs = self.tokenize(examples["source"])
+
+        targets = self.tokenize_targets(examples["target"])
+
+        labels = targets["input_ids"]
+        if self.padding == "max_length":
+            # padded to the same length, hence masked at once
+            labels = np.asarray(labels)
+            labels = np.where(
+                labels == self.tokenizer.pad_token_id, -100, labels  # type: ignore
+            ).tolist()
+
+        data_inputs["labels"] = labels
+
+        return BatchEncoding(data=data_inputs)
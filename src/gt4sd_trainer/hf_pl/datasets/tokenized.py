@@ -0,0 +1,453 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Pre-tokenized dataset cache stored as memory-mapped shards."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from torch.utils.data import Dataset
+from transformers.tokenization_utils_base import BatchEncoding
+
+from .cache import CacheManager
+from .compression import compression_type, load_block_index, open_dataset_file
+from .indexing import load_offset_index
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+TOKENIZED_CACHE_METADATA = "metadata.json"
+TOKENS_DTYPE = np.int32
+OFFSETS_DTYPE = np.uint64
+# RAM-backed file system shared by the processes of a node
+NODE_SHARED_MEMORY_DIR = "/dev/shm"
+# bytes hashed at the start and at the end of files to detect changes
+FINGERPRINT_SAMPLE_SIZE = 2**20
+
+# tokenize and parse functions set once per preprocessing worker process
+_worker_tokenize_function: Optional[Callable] = None
+_worker_parse_function: Callable = json.loads
+
+
+def compute_fingerprint(parameters: Dict[str, Any]) -> str:
+    """Compute a stable fingerprint for a set of parameters.
+    Args:
+        parameters: JSON-serializable parameters.
+    Returns:
+        hexadecimal fingerprint.
+    """
+    serialized = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:32]
+
+
+def sampled_content_hash(
+    filepath: str, sample_size: int = FINGERPRINT_SAMPLE_SIZE
+) -> str:
+    """Hash the start and the end of a file.
+    Args:
+        filepath: path of the file.
+        sample_size: number of bytes hashed at each end. Defaults to 1 MiB.
+    Returns:
+        hexadecimal hash of the sampled content.
+    """
+    content_hash = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        content_hash.update(fp.read(sample_size))
+        size = fp.seek(0, os.SEEK_END)
+        if size > sample_size:
+            fp.seek(max(sample_size, size - sample_size))
+            content_hash.update(fp.read())
+    return content_hash.hexdigest()
+
+
+def file_fingerprint(filepath: str) -> Dict[str, Any]:
+    """Describe a file with the properties used to detect changes.
+
+    Besides path, size and modification time, the first and last MiB of the file are
+    hashed, detecting files replaced with their metadata preserved, e.g., by rsync -t
+    or tar, at a constant cost. In-place edits keeping size and modification time
+    that leave both ends untouched go unnoticed, hashing whole corpora being too slow.
+    Args:
+        filepath: path of the file.
+    Returns:
+        absolute path, size, modification time and sampled content hash of the file.
+    """
+    stat = os.stat(filepath)
+    return {
+        "path": os.path.abspath(filepath),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "content": sampled_content_hash(filepath),
+    }
+
+
+def tokenizer_fingerprint(tokenizer: Any) -> Dict[str, Any]:
+    """Describe a tokenizer with the properties affecting its outputs.
+    Args:
+        tokenizer: a HF tokenizer.
+    Returns:
+        class, name, vocabulary hash and special tokens of the tokenizer.
+    """
+    vocabulary = json.dumps(sorted(tokenizer.get_vocab().items()))
+    return {
+        "class": type(tokenizer).__name__,
+        "name_or_path": getattr(tokenizer, "name_or_path", None),
+        "vocabulary": hashlib.sha256(vocabulary.encode("utf-8")).hexdigest(),
+        "special_tokens": tokenizer.special_tokens_map,
+    }
+
+
+def _set_worker_tokenize_function(
+    tokenize_function: Callable, parser: Callable = json.loads
+) -> None:
+    """Set the tokenize and parse functions used by the current process.
+    Args:
+        tokenize_function: function mapping an example to a BatchEncoding.
+        parser: function parsing a JSON line in an example. Defaults to json.loads.
+    """
+    global _worker_tokenize_function, _worker_parse_function
+    _worker_tokenize_function = tokenize_function
+    _worker_parse_function = parser
+
+
+def _tokenize_shard(
+    filepath: str, start: int, length: int, shard_path: str
+) -> Tuple[int, List[str]]:
+    """Tokenize a contiguous range of lines and store it as a shard.
+    Args:
+        filepath: path of the dataset.
+        start: byte offset of the first line of the shard, for compressed files
+            the offset of its first block.
+        length: number of lines in the shard.
+        shard_path: directory where the shard is stored.
+    Returns:
+        number of examples and keys of the tokenized examples.
+    """
+    if _worker_tokenize_function is None:
+        raise RuntimeError("Tokenize function not set in the preprocessing worker.")
+
+    os.makedirs(shard_path)
+    handles: Dict[str, Any] = {}
+    lengths: Dict[str, List[int]] = {}
+    try:
+        with open_dataset_file(filepath, start) as fp:
+            for _ in range(length):
+                example = _worker_tokenize_function(
+                    _worker_parse_function(fp.readline())
+                )
+                for key, values in example.items():
+                    if key not in handles:
+                        handles[key] = open(
+                            os.path.join(shard_path, f"{key}.bin"), "wb"
+                        )
+                        lengths[key] = []
+                    tokens = np.asarray(values, dtype=TOKENS_DTYPE)
+                    handles[key].write(tokens.tobytes())
+                    lengths[key].append(len(tokens))
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    for key, key_lengths in lengths.items():
+        offsets = np.zeros(len(key_lengths) + 1, dtype=OFFSETS_DTYPE)
+        np.cumsum(key_lengths, out=offsets[1:])
+        offsets.tofile(os.path.join(shard_path, f"{key}.offsets"))
+
+    return length, sorted(lengths)
+
+
+def build_tokenized_cache(
+    filepath: str,
+    tokenize_function: Callable,
+    directory: str,
+    num_workers: int = 1,
+    num_shards: Optional[int] = None,
+    parameters: Optional[Dict[str, Any]] = None,
+    parser: Callable = json.loads,
+) -> None:
+    """Tokenize a file once and store the results as memory-mapped shards.
+    Args:
+        filepath: path of the dataset.
+        tokenize_function: function mapping an example to a BatchEncoding.
+        directory: directory where the cache is stored.
+        num_workers: number of processes used for tokenization. Defaults to 1.
+        num_shards: number of shards. Defaults to four shards per worker.
+        parameters: parameters stored in the cache metadata. Defaults to None.
+        parser: function parsing a JSON line in an example. Defaults to json.loads.
+    """
+    # shards start at line boundaries, or block boundaries for compressed files
+    if compression_type(filepath) is not None:
+        line_starts, offsets = load_block_index(filepath)
+    else:
+        offsets = load_offset_index(filepath)
+        line_starts = np.arange(len(offsets))
+    if num_shards is None:
+        num_shards = 4 * max(1, num_workers)
+    num_shards = max(1, min(num_shards, len(offsets) - 1))
+    boundaries = np.unique(np.linspace(0, len(offsets) - 1, num_shards + 1).astype(int))
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temporary_directory = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        shard_names = [f"shard-{index:05d}" for index in range(len(boundaries) - 1)]
+        tasks = [
+            (
+                filepath,
+                int(offsets[start]),
+                int(line_starts[end] - line_starts[start]),
+                os.path.join(temporary_directory, shard_name),
+            )
+            for shard_name, start, end in zip(
+                shard_names, boundaries[:-1], boundaries[1:]
+            )
+        ]
+        if num_workers > 1:
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=_set_worker_tokenize_function,
+                initargs=(tokenize_function, parser),
+            ) as executor:
+                results = list(executor.map(_tokenize_shard, *zip(*tasks)))
+        else:
+            _set_worker_tokenize_function(tokenize_function, parser)
+            results = [_tokenize_shard(*task) for task in tasks]
+
+        keys = sorted({key for _, shard_keys in results for key in shard_keys})
+        metadata = {
+            "keys": keys,
+            "shards": [
+                {"name": shard_name, "length": shard_length}
+                for shard_name, (shard_length, _) in zip(shard_names, results)
+            ],
+            "parameters": parameters,
+        }
+        with open(
+            os.path.join(temporary_directory, TOKENIZED_CACHE_METADATA), "wt"
+        ) as fp:
+            json.dump(metadata, fp, default=str)
+
+        try:
+            os.rename(temporary_directory, directory)
+        except OSError:
+            # another process completed the same cache first
+            if not os.path.isfile(os.path.join(directory, TOKENIZED_CACHE_METADATA)):
+                raise
+    finally:
+        if os.path.isdir(temporary_directory):
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+def node_cache_dir() -> str:
+    """Default directory of tokenized caches shared by the processes of a node.
+    Returns:
+        a directory in shared memory, in the temporary directory if not available.
+    """
+    parent = (
+        NODE_SHARED_MEMORY_DIR
+        if os.path.isdir(NODE_SHARED_MEMORY_DIR)
+        else tempfile.gettempdir()
+    )
+    return os.path.join(parent, "gt4sd-tokenized-cache")
+
+
+def wait_for_tokenized_cache(
+    directory: str, timeout: float = 3600.0, poll_interval: float = 1.0
+) -> None:
+    """Wait until another process completed a tokenized cache.
+
+    Caches are renamed in place once complete, so their metadata appearing acts as a
+    readiness barrier not requiring the process group to be initialized.
+    Args:
+        directory: directory where the cache is stored.
+        timeout: maximum waiting time in seconds. Defaults to one hour.
+        poll_interval: time in seconds between checks. Defaults to 1 second.
+    Raises:
+        TimeoutError: if the cache is not ready within the timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while not os.path.isfile(os.path.join(directory, TOKENIZED_CACHE_METADATA)):
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f"Tokenized cache {directory} not ready after {timeout} seconds."
+            )
+        time.sleep(poll_interval)
+
+
+class TokenizedDataset(Dataset):
+    """Dataset of pre-tokenized examples stored in memory-mapped shards."""
+
+    def __init__(self, directory: str, lease: Optional[IO] = None) -> None:
+        """Initialize the tokenized dataset.
+        Args:
+            directory: directory where the tokenized cache is stored.
+            lease: lease of the cache entry, see CacheManager.lease, held as long as
+                the dataset is used. Defaults to None.
+        """
+        self.directory = directory
+        self.lease = lease
+
+        with open(os.path.join(directory, TOKENIZED_CACHE_METADATA)) as fp:
+            self.metadata = json.load(fp)
+
+        self.keys: List[str] = self.metadata["keys"]
+        self.shard_names: List[str] = [
+            shard["name"] for shard in self.metadata["shards"]
+        ]
+        self.cumulative_lengths = np.cumsum(
+            [shard["length"] for shard in self.metadata["shards"]]
+        )
+        self.length = int(self.cumulative_lengths[-1]) if self.shard_names else 0
+
+        self._arrays: Dict[Tuple[int, str], Tuple[np.ndarray, np.ndarray]] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state to pickle, e.g., when spawning dataloader workers.
+        Returns:
+           state of the dataset without memory maps, the lease being held by the
+           main process.
+        """
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        state["lease"] = None
+        return state
+
+    def shard_arrays(self, shard_index: int, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the memory-mapped tokens and offsets of a shard.
+        Args:
+            shard_index: index of the shard.
+            key: key of the tokenized examples, e.g., input_ids.
+        Returns:
+            tokens and offsets of the shard.
+        """
+        if (shard_index, key) not in self._arrays:
+            shard_path = os.path.join(self.directory, self.shard_names[shard_index])
+            tokens_path = os.path.join(shard_path, f"{key}.bin")
+            tokens = (
+                np.memmap(tokens_path, dtype=TOKENS_DTYPE, mode="r")
+                if os.path.getsize(tokens_path)
+                else np.empty(0, dtype=TOKENS_DTYPE)
+            )
+            offsets = np.fromfile(
+                os.path.join(shard_path, f"{key}.offsets"), dtype=OFFSETS_DTYPE
+            )
+            self._arrays[(shard_index, key)] = (tokens, offsets)
+        return self._arrays[(shard_index, key)]
+
+    def lengths(self) -> np.ndarray:
+        """Token length of each example, read from the offsets of the input ids.
+        Returns:
+            the number of input tokens of each example.
+        """
+        return np.concatenate(
+            [np.zeros(0, dtype=np.int64)]
+            + [
+                np.diff(self.shard_arrays(shard_index, "input_ids")[1]).astype(np.int64)
+                for shard_index in range(len(self.shard_names))
+            ]
+        )
+
+    def __len__(self) -> int:
+        """Number of instances of the dataset.
+        Returns:
+           number of instances
+        """
+        return self.length
+
+    def __getitem__(self, index) -> BatchEncoding:
+        """Get an item of the dataset.
+        Args:
+            index: index of the item.
+        Returns:
+            tokenized item.
+        """
+        if index < 0:
+            index += self.length
+        shard_index = int(np.searchsorted(self.cumulative_lengths, index, side="right"))
+        if shard_index > 0:
+            index -= int(self.cumulative_lengths[shard_index - 1])
+
+        data = {}
+        for key in self.keys:
+            tokens, offsets = self.shard_arrays(shard_index, key)
+            data[key] = tokens[int(offsets[index]) : int(offsets[index + 1])].tolist()
+
+        return BatchEncoding(data=data)
+
+
+def load_tokenized_dataset(
+    filepath: str,
+    tokenize_function: Callable,
+    cache_dir: str,
+    parameters: Dict[str, Any],
+    num_workers: int = 1,
+    parser: Callable = json.loads,
+    build: bool = True,
+    timeout: float = 3600.0,
+) -> TokenizedDataset:
+    """Load a pre-tokenized dataset, tokenizing the file when not cached yet.
+    Args:
+        filepath: path of the dataset.
+        tokenize_function: function mapping an example to a BatchEncoding.
+        cache_dir: directory containing the tokenized caches.
+        parameters: parameters affecting tokenization, e.g., tokenizer and max_length.
+        num_workers: number of processes used for tokenization. Defaults to 1.
+        parser: function parsing a JSON line in an example. Defaults to json.loads.
+        build: whether to tokenize the file when not cached yet, otherwise waiting for
+            another process to build the cache, e.g., the first process of the node.
+            Defaults to True.
+        timeout: maximum time in seconds waiting for another process. Defaults to one hour.
+    Returns:
+        the tokenized dataset.
+    """
+    parameters = {"file": file_fingerprint(filepath), **parameters}
+    fingerprint = compute_fingerprint(parameters)
+    directory = os.path.join(cache_dir, f"{os.path.basename(filepath)}.{fingerprint}")
+    # leased before being read or built, so that no process evicts it meanwhile
+    lease = CacheManager(cache_dir).lease(os.path.basename(directory))
+
+    if os.path.isfile(os.path.join(directory, TOKENIZED_CACHE_METADATA)):
+        logger.info(f"Reusing tokenized cache {directory} for {filepath}")
+    elif not build:
+        logger.info(f"Waiting for tokenized cache {directory} of {filepath}")
+        wait_for_tokenized_cache(directory, timeout=timeout)
+    else:
+        logger.info(f"Tokenizing {filepath} into {directory}")
+        build_tokenized_cache(
+            filepath,
+            tokenize_function,
+            directory,
+            num_workers=num_workers,
+            parameters=parameters,
+            parser=parser,
+        )
+
+    return TokenizedDataset(directory, lease=lease)
@@ -24,7 +24,7 @@
 """Model for Language Modeling."""
 
 import logging
-from typing import Any, Dict, Type, Union
+from typing import Any, Dict, Iterable, Type, Union
 
 import sentencepiece as _sentencepiece
 import pytorch_lightning as pl
@@ -48,6 +48,27 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+def check_tokenizers_consistency(
+    tokenizer: AutoTokenizer, reference_tokenizer: AutoTokenizer, texts: Iterable[str]
+) -> None:
+    """Check that a tokenizer produces the same ids as a reference one, e.g., fast and slow.
+    Args:
+        tokenizer: tokenizer to check.
+        reference_tokenizer: reference tokenizer.
+        texts: sample of texts to tokenize.
+    Raises:
+        ValueError: in case the tokenizers produce different ids for a text.
+    """
+    for text in texts:
+        input_ids = tokenizer(text)["input_ids"]  # type: ignore
+        reference_input_ids = reference_tokenizer(text)["input_ids"]  # type: ignore
+        if input_ids != reference_input_ids:
+            raise ValueError(
+                f"{type(tokenizer).__name__} and {type(reference_tokenizer).__name__} "
+                f"produce different ids for {text!r}: {input_ids} != {reference_input_ids}"
+            )
+
+
 class BaseLightningModule(pl.LightningModule):
     """Pytorch lightning base model."""
 
@@ -117,8 +138,29 @@ class BaseLightningModule(pl.LightningModule):
         """
         loss = self.model(**batch).loss  # type:ignore
         self.log("train_loss", loss)
+        self.log_padding_efficiency(batch)
         return loss
 
+    def log_padding_efficiency(self, batch: Dict[str, Tensor]) -> None:
+        """
+        Log the ratio of real tokens over padded ones.
+        Args:
+            batch: dictionary containing the input_ids and optionally the attention_mask.
+        """
+        attention_mask = batch.get("attention_mask", None)
+        if attention_mask is not None and attention_mask.dim() == 2:
+            self.log("padding_efficiency", attention_mask.float().mean())
+            return
+        # block-diagonal masks of packed rows are not per token, pads are counted instead
+        pad_token_id = getattr(self.model.config, "pad_token_id", None)  # type:ignore
+        if (
+            attention_mask is not None
+            and "input_ids" in batch
+            and pad_token_id is not None
+        ):
+            tokens = batch["input_ids"] != pad_token_id
+            self.log("padding_efficiency", tokens.float().mean())
+
     def validation_step(self, batch: Dict[str, Tensor], batch_idx: int) -> Tensor:  # type: ignore
         """
         Validation step which encompasses the forward pass and the computation of the loss value.
@@ -172,6 +214,19 @@ class LMModule(BaseLightningModule):
 
             logger.info("Training from scratch")
 
+    @classmethod
+    def load_tokenizer(cls, model_args: Dict[str, Any]) -> AutoTokenizer:
+        """Load the tokenizer used by the module.
+        Args:
+            model_args: model's arguments.
+        Returns:
+            the tokenizer.
+        """
+        return AutoTokenizer.from_pretrained(
+            model_args["tokenizer"],
+            use_fast=model_args.get("use_fast_tokenizer", False),
+        )
+
 
 class MLMModule(LMModule):
     """Pytorch lightning model for MLM training."""
@@ -192,9 +247,7 @@ class MLMModule(LMModule):
 
             logger.info("Training from scratch")
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_args["tokenizer"], use_fast=False
-        )
+        self.tokenizer = self.load_tokenizer(self.model_args)
 
         self.model.resize_token_embeddings(len(self.tokenizer))  # type: ignore
 
@@ -219,9 +272,7 @@ class CGMModule(LMModule):
 
             logger.info("Training from scratch")
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_args["tokenizer"], use_fast=False
-        )
+        self.tokenizer = self.load_tokenizer(self.model_args)
 
         self.model.resize_token_embeddings(len(self.tokenizer))  # type: ignore
 
@@ -229,6 +280,21 @@ class CGMModule(LMModule):
 class CLMModule(LMModule):
     """Pytorch lightning model for CLM training."""
 
+    @classmethod
+    def load_tokenizer(cls, model_args: Dict[str, Any]) -> AutoTokenizer:
+        """Load the tokenizer used by the module, adding separator and padding tokens.
+        Args:
+            model_args: model's arguments.
+        Returns:
+            the tokenizer.
+        """
+        return AutoTokenizer.from_pretrained(
+            model_args["tokenizer"],
+            sep_token="<|sep|>",
+            pad_token="<|pad|>",
+            use_fast=model_args.get("use_fast_tokenizer", False),
+        )
+
     def init_model(self) -> None:
         """Initialize a CLM model."""
 
@@ -245,12 +311,7 @@ class CLMModule(LMModule):
 
             logger.info("Training from scratch")
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_args["tokenizer"],
-            sep_token="<|sep|>",
-            pad_token="<|pad|>",
-            use_fast=False,
-        )
+        self.tokenizer = self.load_tokenizer(self.model_args)
 
         self.model.resize_token_embeddings(len(self.tokenizer))  # type: ignore
 
@@ -275,9 +336,7 @@ class PLMModule(LMModule):
 
             logger.info("Training from scratch")
 
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_args["tokenizer"], use_fast=False
-        )
+        self.tokenizer = self.load_tokenizer(self.model_args)
 
         self.model.resize_token_embeddings(len(self.tokenizer))  # type: ignore
 
@@ -0,0 +1,1247 @@
+#
+# MIT License
+#
+# Copyright (c) 2023 GT4SD team
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Datasets unit tests."""
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+from types import SimpleNamespace
+from typing import List
+
+import sentencepiece as _sentencepiece
+import datasets
+import importlib_resources
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from torch.utils.data import (
+    BatchSampler,
+    ConcatDataset,
+    DistributedSampler,
+    SequentialSampler,
+)
+from transformers import PreTrainedTokenizerFast, T5Config, T5ForConditionalGeneration
+
+from gt4sd_trainer.hf_pl.cli_cache import manage_cache  # type: ignore
+from gt4sd_trainer.hf_pl.core import TokenizedCacheArguments  # type: ignore
+from gt4sd_trainer.hf_pl.datasets import echoing, loading, streaming  # type: ignore
+from gt4sd_trainer.hf_pl.datasets.cache import CacheManager, parse_size  # type: ignore
+from gt4sd_trainer.hf_pl.datasets.collators import (  # type: ignore
+    DecoderInputsFromLabels,
+    MaskedLanguageModelingCollator,
+    PermutationLanguageModelingCollator,
+    TensorCollator,
+)
+from gt4sd_trainer.hf_pl.datasets.columnar import (  # type: ignore
+    ColumnarDataset,
+    is_columnar_dataset,
+    load_columnar_dataset,
+)
+from gt4sd_trainer.hf_pl.datasets.compression import (  # type: ignore
+    BlockReader,
+    write_block_compressed,
+)
+from gt4sd_trainer.hf_pl.datasets.core import (  # type: ignore
+    CGMDataModule,
+    CLMDataModule,
+    LazyConcatDataset,
+    LMDataset,
+    MLMDataModule,
+)
+from gt4sd_trainer.hf_pl.datasets.echoing import (  # type: ignore
+    PROBE_INTERVAL,
+    SYNC_INTERVAL,
+    EchoFactorController,
+    EchoingDataLoader,
+)
+from gt4sd_trainer.hf_pl.datasets.indexing import (  # type: ignore
+    MANIFEST_FILENAME,
+    build_offset_index,
+    load_offset_index,
+)
+from gt4sd_trainer.hf_pl.datasets.loading import (  # type: ignore
+    auto_num_workers,
+    dataloader_settings,
+    resolve_num_workers,
+    worker_payload_size,
+)
+from gt4sd_trainer.hf_pl.datasets.memory import (  # type: ignore
+    ENTRY_OVERHEAD,
+    ExampleCache,
+    total_statistics,
+)
+from gt4sd_trainer.hf_pl.datasets.mixture import (  # type: ignore
+    mixture_probabilities,
+    parse_mixture,
+)
+from gt4sd_trainer.hf_pl.datasets.packing import PackedDataset  # type: ignore
+from gt4sd_trainer.hf_pl.datasets.parsing import (  # type: ignore
+    JSON_BACKENDS,
+    ExampleParser,
+)
+from gt4sd_trainer.hf_pl.datasets.samplers import (  # type: ignore
+    BlockShuffleSampler,
+    EvenBatchSampler,
+    LengthGroupedBatchSampler,
+    MixtureSampler,
+    TokenBudgetBatchSampler,
+    example_workers,
+    padding_efficiency,
+)
+from gt4sd_trainer.hf_pl.datasets.sharding import balanced_assignment  # type: ignore
+from gt4sd_trainer.hf_pl.datasets.streaming import StreamingLMDataset  # type: ignore
+from gt4sd_trainer.hf_pl.datasets.tokenization import (  # type: ignore
+    ConditionalGenerationTokenizeFunction,
+)
+from gt4sd_trainer.hf_pl.datasets.tokenized import (  # type: ignore
+    TokenizedDataset,
+    compute_fingerprint,
+    file_fingerprint,
+    wait_for_tokenized_cache,
+)
+
+# sentencepiece has to be loaded before lightning to avoid segfaults
+_sentencepiece
+
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+@pytest.fixture
+def example_file(tmp_path):
+    filepath = tmp_path / "lm_example.jsonl"
+    with importlib_resources.as_file(
+        importlib_resources.files("gt4sd_trainer") / "hf_pl/tests/lm_example.jsonl"
+    ) as file_path:
+        shutil.copy(file_path, filepath)
+    return str(filepath)
+
+
+@pytest.fixture
+def variable_length_file(example_file, tmp_path):
+    filepath = tmp_path / "variable_length.jsonl"
+    with open(example_file) as fp:
+        words = json.loads(fp.readline())["text"].split()
+    with open(filepath, "wt") as fp:
+        for index in range(64):
+            fp.write(json.dumps({"text": " ".join(words[: 1 + (index * 7) % 40])}))
+            fp.write("\n")
+    return str(filepath)
+
+
+@pytest.fixture
+def tokenizer(example_file):
+    with open(example_file) as fp:
+        texts = [json.loads(line)["text"] for line in fp]
+    word_level = Tokenizer(models.WordLevel(unk_token="[UNK]"))
+    word_level.pre_tokenizer = pre_tokenizers.Whitespace()
+    word_level.train_from_iterator(
+        texts, trainers.WordLevelTrainer(special_tokens=SPECIAL_TOKENS)
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=word_level,
+        pad_token="[PAD]",
+        unk_token="[UNK]",
+        cls_token="[CLS]",
+        sep_token="[SEP]",
+        mask_token="[MASK]",
+    )
+
+
+def test_build_offset_index(tmp_path):
+    filepath = str(tmp_path / "lines.jsonl")
+    with open(filepath, "wb") as fp:
+        fp.write(b'{"text": "a"}\n{"text": "bb"}\n{"text": "ccc"}')
+
+    offsets = build_offset_index(filepath, chunk_size=4)
+
+    assert offsets.tolist() == [0, 14, 29, 44]
+
+
+def test_load_offset_index(example_file):
+    offsets = load_offset_index(example_file)
+
+    assert os.path.isfile(f"{example_file}.idx")
+    assert len(offsets) - 1 == LMDataset.count_examples(example_file)
+    assert offsets.tolist() == load_offset_index(example_file).tolist()
+
+
+def test_lm_dataset_offset_index(example_file):
+    dataset = LMDataset(example_file, lambda example: example)
+    indexed_dataset = LMDataset(
+        example_file, lambda example: example, use_offset_index=True
+    )
+
+    assert len(dataset) == len(indexed_dataset)
+    for index in range(len(dataset)):
+        assert dataset[index] == indexed_dataset[index]
+
+
+def test_tokenized_cache(example_file, tokenizer, tmp_path):
+    dataset_args = {
+        "train_file": example_file,
+        "validation_file": example_file,
+        "max_length": 32,
+        "mlm_probability": 0.15,
+        "batch_size": 4,
+    }
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+
+    cached_dataset_args = {
+        **dataset_args,
+        "tokenized_cache_dir": str(tmp_path / "cache"),
+        "preprocessing_num_workers": 2,
+    }
+    cached_data_module = MLMDataModule(cached_dataset_args, tokenizer=tokenizer)
+    dataset = data_module.datasets["train"]
+    cached_dataset = cached_data_module.datasets["train"]
+
+    assert isinstance(cached_dataset, TokenizedDataset)
+    assert len(CacheManager(str(tmp_path / "cache")).entries()) == 1
+    assert len(dataset) == len(cached_dataset)
+    for index in range(len(dataset)):
+        assert dict(dataset[index]) == dict(cached_dataset[index])
+
+
+def test_node_shared_cache(example_file, tokenizer, tmp_path, monkeypatch):
+    dataset_args = {
+        "train_file": example_file,
+        "validation_file": example_file,
+        "max_length": 32,
+        "mlm_probability": 0.15,
+        "batch_size": 4,
+        "tokenized_cache_dir": str(tmp_path / "cache"),
+        "node_shared_cache": True,
+    }
+    with pytest.raises(TimeoutError):
+        wait_for_tokenized_cache(str(tmp_path / "cache" / "missing"), timeout=0.0)
+
+    # the first process of the node tokenizes, the others wait for its cache
+    monkeypatch.setenv("LOCAL_RANK", "0")
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    assert data_module.builds_tokenized_cache()
+    monkeypatch.setenv("LOCAL_RANK", "1")
+    local_data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    assert not local_data_module.builds_tokenized_cache()
+    assert len(CacheManager(str(tmp_path / "cache")).entries()) == 1
+
+    dataset = data_module.datasets["train"]
+    local_dataset = local_data_module.datasets["train"]
+    assert isinstance(local_dataset, TokenizedDataset)
+    assert local_dataset.directory == dataset.directory
+    assert len(dataset) == len(local_dataset)
+    for index in range(len(dataset)):
+        assert dict(dataset[index]) == dict(local_dataset[index])
+
+    # local ranks set by SLURM, waiting for caches within the configured timeout
+    monkeypatch.delenv("LOCAL_RANK")
+    monkeypatch.setenv("SLURM_LOCALID", "1")
+    with pytest.raises(TimeoutError):
+        MLMDataModule(
+            {**dataset_args, "max_length": 16, "tokenized_cache_timeout": 0.0},
+            tokenizer=tokenizer,
+        )
+
+
+def test_cache_manager(variable_length_file, tokenizer, tmp_path):
+    assert parse_size("500M") == 500 * 2**20
+    assert parse_size("1.5GiB") == int(1.5 * 2**30)
+    assert parse_size("1024") == 1024
+    with pytest.raises(ValueError):
+        parse_size("many")
+
+    cache_dir = str(tmp_path / "cache")
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 4,
+        "num_dataloader_workers": 0,
+        "tokenized_cache_dir": cache_dir,
+    }
+    names = {}
+    for age, max_length in zip((300, 200, 100), (16, 32, 64)):
+        data_module = CLMDataModule(
+            {**dataset_args, "max_length": max_length}, tokenizer=tokenizer
+        )
+        (names[max_length],) = data_module._tokenized_cache_entries
+        timestamp = time.time() - age
+        os.utime(os.path.join(cache_dir, names[max_length]), (timestamp, timestamp))
+    manager = CacheManager(cache_dir)
+    entries = manager.entries()
+    assert [entry.name for entry in entries] == [names[16], names[32], names[64]]
+    sizes = {max_length: entry.size for max_length, entry in zip(names, entries)}
+
+    # reused caches are marked as used, the least recently used are evicted
+    CLMDataModule(
+        {
+            **dataset_args,
+            "max_length": 16,
+            "tokenized_cache_max_size": str(sizes[16] + sizes[64]),
+        },
+        tokenizer=tokenizer,
+    )
+    assert [entry.name for entry in manager.entries()] == [names[64], names[16]]
+
+    # entries not used recently and stale temporaries are pruned, unless leased
+    timestamp = time.time() - 7200
+    os.utime(os.path.join(cache_dir, names[64]), (timestamp, timestamp))
+    os.makedirs(os.path.join(cache_dir, ".tmp-interrupted"))
+    os.utime(os.path.join(cache_dir, ".tmp-interrupted"), (0, 0))
+    assert manager.prune(older_than=3600) == []
+    assert not os.path.exists(os.path.join(cache_dir, ".tmp-interrupted"))
+    for split in ["train", "validation"]:
+        data_module.datasets[split].lease.close()
+    assert [entry.name for entry in manager.prune(older_than=3600)] == [names[64]]
+    assert sorted(os.listdir(cache_dir)) == [".leases", names[16]]
+    entries = manage_cache(TokenizedCacheArguments(tokenized_cache_dir=cache_dir))
+    assert [entry.name for entry in entries] == [names[16]]
+
+    # files replaced with the same size and modification time are detected
+    filepath = str(tmp_path / "replaced.jsonl")
+    fingerprints = []
+    for content in [b"a" * 2**21, b"b" + b"a" * (2**21 - 1)]:
+        with open(filepath, "wb") as fp:
+            fp.write(content)
+        os.utime(filepath, ns=(0, 0))
+        fingerprints.append(compute_fingerprint(file_fingerprint(filepath)))
+    assert fingerprints[0] != fingerprints[1]
+
+    # entries of files named like temporaries are entries, leased while in use
+    filepath = str(tmp_path / "tmp_train.jsonl")
+    shutil.copy(variable_length_file, filepath)
+    cache_dir = str(tmp_path / "tmp_cache")
+    data_module = CLMDataModule(
+        {
+            **dataset_args,
+            "train_file": filepath,
+            "validation_file": filepath,
+            "max_length": 16,
+            "tokenized_cache_dir": cache_dir,
+        },
+        tokenizer=tokenizer,
+    )
+    (name,) = data_module._tokenized_cache_entries
+    assert name.startswith("tmp_train.jsonl.")
+    manager = CacheManager(cache_dir)
+    assert [entry.name for entry in manager.entries()] == [name]
+    timestamp = time.time() - 3 * 24 * 3600
+    os.utime(os.path.join(cache_dir, name), (timestamp, timestamp))
+    assert manager.prune() == []
+    assert manager.remove(manager.entries()[0]) is False
+    assert os.path.isdir(os.path.join(cache_dir, name))
+
+
+def test_example_cache(variable_length_file, tokenizer):
+    example = {"input_ids": list(range(100)), "attention_mask": [1] * 100}
+    # room for three entries of 800 bytes of int32 arrays, plus overhead
+    cache = ExampleCache(max_bytes=3 * (800 + ENTRY_OVERHEAD))
+    for key in range(3):
+        cache.put(key, example)
+    assert cache.get(0) == example
+    # entries not referenced since the last sweep are evicted first
+    cache.put(3, example)
+    assert len(cache) == 3
+    assert cache.get(0) is not None and cache.get(1) is None
+    assert cache.size <= cache.max_bytes
+    assert total_statistics(cache.statistics) == (2, 1)
+
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 4,
+        "max_length": 64,
+        "dynamic_padding": True,
+        "num_dataloader_workers": 2,
+        "example_cache_size": "1M",
+    }
+    data_module = CLMDataModule(dataset_args, tokenizer=tokenizer)
+    dataset = data_module.datasets["train"]
+    assert dataset.random_access
+    dataloader = data_module.train_dataloader()
+    # split among the workers of the training and validation dataloaders
+    assert dataset.example_cache.max_bytes == 2**18
+    epochs = [list(dataloader) for _ in range(2)]
+    # the second epoch is read from the caches of the persistent workers
+    hits, misses = total_statistics(data_module.example_cache.statistics)
+    assert misses == len(dataset) and hits == len(dataset)
+    for first, second in zip(*epochs):
+        assert torch.equal(first["input_ids"], second["input_ids"])
+    # validation reads are counted by the cache of the validation split
+    list(data_module.val_dataloader())
+    assert total_statistics(data_module.example_cache.statistics) == (hits, misses)
+    validation_statistics = data_module.example_caches["validation"].statistics
+    assert total_statistics(validation_statistics) == (0, len(dataset))
+
+    # shuffled examples are routed to the worker caching them
+    data_module = CLMDataModule(
+        {**dataset_args, "group_by_length": True}, tokenizer=tokenizer
+    )
+    dataloader = data_module.train_dataloader()
+    # counted from here, since the main process reads the examples for their lengths
+    data_module.example_cache.statistics.zero_()
+    for epoch in range(2):
+        dataloader.batch_sampler.set_epoch(epoch)
+        list(dataloader)
+    hits, misses = total_statistics(data_module.example_cache.statistics)
+    assert misses == len(dataset) and hits == len(dataset)
+    uncached = CLMDataModule(
+        {**dataset_args, "example_cache_size": None}, tokenizer=tokenizer
+    ).datasets["train"]
+    assert dataset[3] == uncached[3] and dataset[3] == dataset[3]
+
+
+def test_length_grouped_batch_sampler():
+    lengths = np.random.default_rng(42).integers(1, 512, size=1000)
+    batch_sampler = LengthGroupedBatchSampler(
+        SequentialSampler(range(1000)),
+        batch_size=16,
+        drop_last=False,
+        lengths=lengths,
+        bucket_size_multiplier=10,
+    )
+    batches = list(batch_sampler)
+
+    assert len(batches) == len(batch_sampler)
+    assert sorted(index for batch in batches for index in batch) == list(range(1000))
+    assert padding_efficiency(batches, lengths) > 0.9
+    assert padding_efficiency(list(BatchSampler(range(1000), 16, False)), lengths) < 0.6
+
+    batch_sampler.set_epoch(1)
+    assert list(batch_sampler) != batches
+
+    # the epoch reaches the distributed sampler, reshuffling the shards
+    sampler = DistributedSampler(
+        list(range(1000)), num_replicas=2, rank=0  # type: ignore
+    )
+    batch_sampler = LengthGroupedBatchSampler(
+        sampler, batch_size=16, drop_last=False, lengths=lengths
+    )
+    batch_sampler.set_epoch(1)
+    assert sampler.epoch == 1
+
+
+def test_token_budget_batch_sampler():
+    lengths = np.random.default_rng(42).integers(1, 512, size=1000)
+    dataset = list(range(1000))
+
+    rank_batches = []
+    for rank in range(3):
+        batch_sampler = TokenBudgetBatchSampler(
+            DistributedSampler(dataset, num_replicas=3, rank=rank),  # type: ignore
+            max_tokens=2048,
+            lengths=lengths,
+            pad_to_multiple_of=8,
+        )
+        batches = list(batch_sampler)
+        assert len(batches) == len(batch_sampler)
+        for batch in batches:
+            assert len(batch) * (-(-lengths[batch].max() // 8) * 8) <= 2048
+        rank_batches.append(batches)
+
+    assert len({len(batches) for batches in rank_batches}) == 1
+    indices = {
+        index for batches in rank_batches for batch in batches for index in batch
+    }
+    assert indices == set(dataset)
+
+
+def test_dynamic_padding(variable_length_file, tokenizer):
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "dynamic_padding": True,
+        "pad_to_multiple_of": 8,
+        "group_by_length": True,
+    }
+    data_module = CLMDataModule(dataset_args, tokenizer=tokenizer)
+
+    number_of_examples = 0
+    for batch in data_module.train_dataloader():
+        assert batch["input_ids"].shape[1] % 8 == 0
+        assert (batch["labels"][batch["attention_mask"] == 0] == -100).all()
+        number_of_examples += len(batch["input_ids"])
+    assert number_of_examples == 64
+
+
+def test_packing(variable_length_file, tokenizer):
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 4,
+        "max_length": 64,
+        "packing": True,
+        "packing_position_ids": True,
+        "packing_block_attention": True,
+    }
+    tokenizer.eos_token = "[SEP]"
+    data_module = CLMDataModule(dataset_args, tokenizer=tokenizer)
+    dataset = data_module.datasets["train"]
+
+    assert isinstance(dataset, PackedDataset)
+    assert len(dataset) < 64
+
+    row = dataset[0]
+    separators = [
+        index
+        for index, token in enumerate(row["input_ids"])
+        if token == tokenizer.eos_token_id
+    ]
+    assert len(separators) > 1
+    for separator in separators[:-1]:
+        assert row["labels"][separator] == tokenizer.eos_token_id
+        assert row["labels"][separator + 1] == -100
+        assert row["position_ids"][separator + 1] == 0
+
+    batch = next(iter(data_module.train_dataloader()))
+    assert batch["input_ids"].shape == (4, 64)
+    assert batch["attention_mask"].shape == (4, 64, 64)
+    assert batch["attention_mask"][0, separators[0] + 1, separators[0]] == 0
+
+
+@pytest.mark.parametrize("number_of_files", [1, 5])
+def test_streaming_sharding(variable_length_file, tmp_path, number_of_files):
+    with open(variable_length_file) as fp:
+        lines = fp.readlines()
+    filepaths = []
+    for index in range(number_of_files):
+        filepath = str(tmp_path / f"shard_{index}.jsonl")
+        with open(filepath, "wt") as fp:
+            fp.writelines(lines[index::number_of_files])
+        filepaths.append(filepath)
+    dataset = StreamingLMDataset(filepaths, lambda example: example)
+
+    examples = []
+    for shard in range(4):
+        for filepath, start, end in dataset.shard_ranges(shard, 4):
+            examples.extend(dataset.read_range(filepath, start, end))
+
+    assert sorted(json.dumps(example) for example in examples) == sorted(
+        json.dumps(json.loads(line)) for line in lines
+    )
+
+
+def test_streaming_data_module(variable_length_file, tokenizer, monkeypatch):
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "mlm_probability": 0.15,
+        "dynamic_padding": True,
+        "streaming": True,
+        "shuffle_buffer_size": 16,
+        "num_dataloader_workers": 2,
+    }
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+
+    assert isinstance(data_module.datasets["train"], StreamingLMDataset)
+    number_of_examples = sum(
+        len(batch["input_ids"]) for batch in data_module.train_dataloader()
+    )
+    assert number_of_examples == 64
+
+    # persistent workers shuffle in a different order every epoch
+    dataloader = data_module.train_dataloader()
+    assert dataloader.persistent_workers
+    # lengths of the examples, unlike their tokens not changed by masking
+    epochs = [
+        [
+            length
+            for batch in dataloader
+            for length in batch["attention_mask"].sum(1).tolist()
+        ]
+        for _ in range(2)
+    ]
+    assert epochs[0] != epochs[1] and sorted(epochs[0]) == sorted(epochs[1])
+
+    # another DDP process runs out of examples after 3 batches
+    other_batches = iter(range(3))
+    monkeypatch.setattr(streaming, "distributed_world", lambda: (2, 0))
+    monkeypatch.setattr(
+        streaming,
+        "all_across_ranks",
+        lambda value: value and next(other_batches, None) is not None,
+    )
+    assert len(list(data_module.train_dataloader())) == 3
+
+
+def test_dataloader_settings(variable_length_file, tokenizer, monkeypatch):
+    assert resolve_num_workers("auto") >= 0
+    # cores are shared by the processes of the node, e.g., SLURM tasks
+    monkeypatch.setattr(loading, "available_cpus", lambda: 32)
+    monkeypatch.delenv("LOCAL_WORLD_SIZE", raising=False)
+    assert auto_num_workers() == 8
+    monkeypatch.setenv("SLURM_NTASKS_PER_NODE", "8")
+    assert auto_num_workers() == 3
+    monkeypatch.undo()
+    assert resolve_num_workers("3") == 3
+    with pytest.raises(ValueError):
+        resolve_num_workers("many")
+    assert dataloader_settings(0, pin_memory=False) == {
+        "num_workers": 0,
+        "pin_memory": False,
+    }
+
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "mlm_probability": 0.15,
+        "num_dataloader_workers": "auto",
+        "dataloader_probe_batches": 2,
+    }
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    settings = data_module.dataloader_settings()
+    assert 0 <= settings["num_workers"] <= resolve_num_workers("auto")
+    if settings["num_workers"] > 0:
+        assert settings["persistent_workers"]
+        assert settings["prefetch_factor"] in (2, 4)
+    number_of_examples = sum(
+        len(batch["input_ids"]) for batch in data_module.train_dataloader()
+    )
+    assert number_of_examples == 64
+
+
+def test_lazy_directory_dataset(variable_length_file, tokenizer, tmp_path):
+    with open(variable_length_file) as fp:
+        lines = fp.readlines()
+    directory = tmp_path / "dataset"
+    for index in range(4):
+        os.makedirs(directory / f"part_{index}")
+        with open(directory / f"part_{index}" / "examples.jsonl", "wt") as fp:
+            fp.writelines(lines[index * 16 : (index + 1) * 16])
+    dataset_args = {
+        "train_file": str(directory / "**" / "*.jsonl"),
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "mlm_probability": 0.15,
+    }
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+
+    dataset = data_module.datasets["train"]
+    assert isinstance(dataset, LazyConcatDataset)
+    assert len(dataset) == 64
+    assert os.path.isfile(directory / MANIFEST_FILENAME)
+    assert not dataset._datasets
+    assert (
+        dataset[20]["input_ids"] == data_module.datasets["validation"][20]["input_ids"]
+    )
+    assert list(dataset._datasets) == [1]
+
+    # changed files are counted again, unchanged ones are read from the manifest
+    with open(directory / "part_3" / "examples.jsonl", "at") as fp:
+        fp.write(lines[0])
+    assert len(data_module.build_dataset(dataset_args["train_file"])) == 65
+    assert data_module.dataset_filepaths(str(directory / "part_3")) == [
+        str(directory / "part_3" / "examples.jsonl")
+    ]
+
+
+def test_rank_sharding(variable_length_file, tokenizer, tmp_path):
+    assert balanced_assignment([5, 1, 4, 2, 3], 2) == [[0, 1, 3], [2, 4]]
+
+    with open(variable_length_file) as fp:
+        lines = fp.readlines()
+    directory = tmp_path / "dataset"
+    os.makedirs(directory)
+    # files of different sizes
+    for index, (start, end) in enumerate([(0, 8), (8, 16), (16, 40), (40, 64)]):
+        with open(directory / f"part_{index}.jsonl", "wt") as fp:
+            fp.writelines(lines[start:end])
+    dataset_args = {
+        "train_file": str(directory),
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "mlm_probability": 0.15,
+        "num_dataloader_workers": 0,
+        "shard_by_rank": True,
+    }
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    assert not data_module.datasets
+
+    input_ids: List[List[int]] = []
+    for rank in range(2):
+        data_module.load_datasets(num_replicas=2, rank=rank)
+        dataset = data_module.datasets["train"]
+        assert len(dataset) == 32
+        input_ids.extend(dataset[index]["input_ids"] for index in range(len(dataset)))
+        # fewer files than processes, examples are split in ranges
+        assert len(data_module.datasets["validation"]) == 32
+        dataloader = data_module.train_dataloader()
+        assert isinstance(dataloader.batch_sampler, EvenBatchSampler)
+        assert len(list(dataloader)) == 4
+    dataset = data_module.build_dataset(variable_length_file)
+    assert sorted(input_ids) == sorted(
+        dataset[index]["input_ids"] for index in range(len(dataset))
+    )
+
+    batch_sampler = EvenBatchSampler(
+        BatchSampler(SequentialSampler(range(10)), batch_size=4, drop_last=False), 5
+    )
+    assert list(batch_sampler) == [
+        [0, 1, 2, 3],
+        [4, 5, 6, 7],
+        [8, 9],
+        [0, 1, 2, 3],
+        [4, 5, 6, 7],
+    ]
+
+
+def test_worker_routing():
+    lengths = np.random.default_rng(42).integers(1, 512, size=1000)
+    batch_samplers = [
+        LengthGroupedBatchSampler(
+            SequentialSampler(range(1000)),
+            batch_size=16,
+            drop_last=False,
+            lengths=lengths,
+            num_workers=3,
+        ),
+        TokenBudgetBatchSampler(
+            DistributedSampler(list(range(1000)), num_replicas=2, rank=1),  # type: ignore
+            max_tokens=2048,
+            lengths=lengths,
+            num_workers=3,
+        ),
+    ]
+    block_shuffle = BlockShuffleSampler(
+        list(range(1000)), block_size=8, batch_size=16, num_workers=3  # type: ignore
+    )
+    for batches in [
+        *map(list, batch_samplers),
+        list(BatchSampler(block_shuffle, 16, False)),
+    ]:
+        workers = [
+            set(example_workers(np.array(batch), 3).tolist()) for batch in batches
+        ]
+        # the k-th batch is loaded by the worker k modulo 3 and holds its examples
+        routed = 3 * min(
+            sum(worker == {index} for worker in workers) for index in range(3)
+        )
+        assert routed > 0.9 * len(batches)
+        assert all(worker == {k % 3} for k, worker in enumerate(workers[:routed]))
+
+    # batches are the same whatever the number of workers, up to their order
+    batch_samplers[0].set_epoch(1)
+    assert sorted(index for batch in batch_samplers[0] for index in batch) == list(
+        range(1000)
+    )
+    assert sorted(block_shuffle) == list(range(1000))
+    resumed = BlockShuffleSampler(
+        list(range(1000)),  # type: ignore
+        block_size=8,
+        batch_size=16,
+        num_workers=3,
+        start_index=32,
+    )
+    assert list(resumed) == list(block_shuffle)[32:]
+
+
+def test_block_shuffle_sampler():
+    dataset = ConcatDataset([list(range(10)), list(range(10, 17))])  # type: ignore
+    sampler = BlockShuffleSampler(dataset, block_size=4, window_blocks=1)
+    assert sampler.blocks().tolist() == [[0, 4], [4, 8], [8, 10], [10, 14], [14, 17]]
+    indices = list(sampler)
+    assert sorted(indices) == list(range(17))
+    # with a window of one block, the examples of a block are read together
+    for start, end in sampler.blocks().tolist():
+        positions = sorted(indices.index(index) for index in range(start, end))
+        assert positions == list(range(positions[0], positions[0] + end - start))
+    assert list(sampler) == indices
+    sampler.set_epoch(1)
+    assert list(sampler) != indices
+
+    samplers = [
+        BlockShuffleSampler(dataset, block_size=4, num_replicas=2, rank=rank)
+        for rank in range(2)
+    ]
+    assert all(len(list(sampler)) == 9 for sampler in samplers)
+    assert set(list(samplers[0]) + list(samplers[1])) == set(range(17))
+
+    resumed = BlockShuffleSampler(dataset, block_size=4, start_index=5)
+    assert list(resumed) == list(BlockShuffleSampler(dataset, block_size=4))[5:]
+
+
+def test_mixture_sampling(variable_length_file, tokenizer, tmp_path):
+    assert parse_mixture("data/train.jsonl") is None
+    assert parse_mixture("a.jsonl:3, b/:1") == [("a.jsonl", 3.0), ("b/", 1.0)]
+    assert parse_mixture("a.jsonl,b.jsonl") == [("a.jsonl", None), ("b.jsonl", None)]
+    with pytest.raises(ValueError):
+        parse_mixture("a.jsonl:3,b.jsonl")
+    assert mixture_probabilities([30, 10], [None, None]).tolist() == [0.75, 0.25]
+    assert mixture_probabilities([30, 10], [1.0, 3.0]).tolist() == [0.25, 0.75]
+    # high temperatures flatten the mixture
+    assert np.allclose(mixture_probabilities([900, 100], [None, None], 1e6), 0.5)
+
+    dataset = ConcatDataset([list(range(100)), list(range(100, 110))])  # type: ignore
+    sampler = MixtureSampler(dataset, [0.5, 0.5])
+    indices = np.array(list(sampler))
+    assert len(indices) == 110
+    # the small source is repeated, reshuffled once exhausted
+    assert 40 < (indices >= 100).sum() < 70
+    assert np.bincount(indices[indices >= 100] - 100).min() >= 4
+    assert list(sampler.sources) == (indices >= 100).astype(int).tolist()
+    resumed = MixtureSampler(dataset, [0.5, 0.5], start_index=30)
+    assert list(resumed) == indices[30:].tolist()
+    samplers = [
+        MixtureSampler(dataset, [0.5, 0.5], num_replicas=2, rank=rank)
+        for rank in range(2)
+    ]
+    assert sorted(list(samplers[0]) + list(samplers[1])) == sorted(indices.tolist())
+
+    chemistry_file = tmp_path / "chemistry.jsonl"
+    with open(variable_length_file) as fp:
+        chemistry_file.write_text("".join(fp.readlines()[:8]))
+    dataset_args = {
+        "train_file": f"{variable_length_file}:1,{chemistry_file}:1",
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "mlm_probability": 0.15,
+        "num_dataloader_workers": 0,
+        "dynamic_padding": True,
+    }
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    assert len(data_module.datasets["train"]) == 72
+    total_tokens = 0
+    for batch in data_module.train_dataloader():
+        data_module.count_source_tokens(batch)
+        total_tokens += int(batch["attention_mask"].sum())
+    assert data_module.source_tokens.sum() == total_tokens
+    assert not data_module.mixture_sampler.sources
+    # about as many examples from both sources, the second one being much shorter
+    assert 0 < data_module.source_tokens[1] < data_module.source_tokens[0]
+    with pytest.raises(ValueError):
+        MLMDataModule({**dataset_args, "packing": True}, tokenizer=tokenizer)
+
+
+def test_cached_validation(variable_length_file, tokenizer):
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 4,
+        "eval_batch_size": 16,
+        "max_length": 64,
+        "num_dataloader_workers": 0,
+        "cache_validation_batches": True,
+    }
+    data_module = CLMDataModule(dataset_args, tokenizer=tokenizer)
+    dataset = data_module.datasets["validation"]
+    batches = list(data_module.val_dataloader())
+    assert len(batches) == 4
+    # sorted by length and padded to the longest example of each batch
+    lengths = [batch["attention_mask"].sum(dim=1) for batch in batches]
+    assert torch.equal(torch.cat(lengths), torch.cat(lengths).sort().values)
+    assert all(
+        batch["input_ids"].shape[1] == int(length.max())
+        for batch, length in zip(batches, lengths)
+    )
+    assert sum(int(length.sum()) for length in lengths) == sum(
+        sum(dataset[index]["attention_mask"]) for index in range(len(dataset))
+    )
+    assert (batches[0]["labels"][batches[0]["attention_mask"] == 0] == -100).all()
+    # tokenized once for all the validation rounds
+    examples = data_module._validation_examples
+    assert len(data_module.val_dataloader()) == 4
+    assert data_module._validation_examples is examples
+
+    # only the examples of the validated batches are read
+    limited = CLMDataModule(dataset_args, tokenizer=tokenizer)
+    limited.trainer = SimpleNamespace(limit_val_batches=2)
+    batches = list(limited.val_dataloader())
+    assert len(batches) == 2 and len(limited._validation_examples) == 32
+
+    uncached = CLMDataModule(
+        {**dataset_args, "cache_validation_batches": False}, tokenizer=tokenizer
+    )
+    batches = list(uncached.val_dataloader())
+    assert len(batches) == 4
+    assert batches[0]["input_ids"].shape == (16, 64)
+
+
+@pytest.mark.parametrize("storage", ["parquet", "arrow", "saved"])
+def test_columnar_dataset(variable_length_file, tokenizer, tmp_path, storage):
+    with open(variable_length_file) as fp:
+        texts = [json.loads(line)["text"] for line in fp]
+    table = pa.table({"text": texts, "identifier": list(range(len(texts)))})
+    path = str(tmp_path / "corpus")
+    if storage == "parquet":
+        os.makedirs(path)
+        pq.write_table(table.slice(0, 10), os.path.join(path, "a.parquet"))
+        pq.write_table(table.slice(10), os.path.join(path, "b.parquet"))
+    elif storage == "arrow":
+        path += ".arrow"
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_stream(
+            sink, table.schema
+        ) as writer:
+            writer.write_table(table)
+    else:
+        datasets.Dataset(table).save_to_disk(path)
+    assert is_columnar_dataset(path)
+    assert not is_columnar_dataset(variable_length_file)
+    # only the fields used by the tokenize function are read
+    assert load_columnar_dataset(path, ["text"]).column_names == ["text"]
+
+    dataset_args = {
+        "train_file": path,
+        "validation_file": path,
+        "batch_size": 4,
+        "max_length": 64,
+        "dynamic_padding": True,
+        "num_dataloader_workers": 0,
+        "tokenized_cache_dir": str(tmp_path / "cache"),
+    }
+    data_module = CLMDataModule(dataset_args, tokenizer=tokenizer)
+    dataset = data_module.datasets["train"]
+    assert isinstance(dataset, ColumnarDataset)
+    assert len(dataset) == len(texts)
+    assert "labels" in dataset.dataset.column_names
+    for index in (0, len(texts) - 1):
+        assert dataset[index]["input_ids"] == tokenizer(texts[index])["input_ids"]
+    np.testing.assert_array_equal(
+        dataset.lengths(),
+        [len(tokenizer(text)["input_ids"]) for text in texts],
+    )
+    assert [item["input_ids"] for item in dataset.__getitems__([2, 0])] == [
+        dataset[2]["input_ids"],
+        dataset[0]["input_ids"],
+    ]
+    assert os.listdir(tmp_path / "cache")
+    assert data_module.sample_texts(2) == texts[:2]
+    batch = next(iter(data_module.train_dataloader()))
+    assert batch["input_ids"].shape[0] == 4
+
+    with pytest.raises(ValueError):
+        CLMDataModule({**dataset_args, "streaming": True}, tokenizer=tokenizer)
+
+
+def test_worker_payload(example_file, tokenizer, caplog):
+    model = T5ForConditionalGeneration(
+        T5Config(
+            vocab_size=len(tokenizer),
+            d_model=64,
+            d_ff=128,
+            num_layers=2,
+            num_heads=2,
+            decoder_start_token_id=tokenizer.pad_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    )
+    with open(example_file) as fp:
+        texts = [json.loads(line)["text"] for line in fp]
+    seq2seq_file = f"{example_file}.seq2seq.jsonl"
+    with open(seq2seq_file, "wt") as fp:
+        for text in texts:
+            fp.write(json.dumps({"source": text, "target": text[:20]}) + "\n")
+    dataset_args = {
+        "train_file": seq2seq_file,
+        "validation_file": seq2seq_file,
+        "batch_size": 4,
+        "max_length": 32,
+        "dynamic_padding": True,
+        "num_dataloader_workers": 2,
+    }
+    data_module = CGMDataModule(dataset_args, model=model, tokenizer=tokenizer)
+    dataloader = data_module.train_dataloader()
+    # neither the model nor the data module are pickled into the workers
+    assert worker_payload_size(dataloader) < len(pickle.dumps(tokenizer)) + 2**14
+    # measured only when debugging
+    assert not data_module._logged_payloads
+    with caplog.at_level(logging.DEBUG, logger="gt4sd_trainer.hf_pl.datasets.core"):
+        data_module.train_dataloader()
+    assert "Payload pickled into each train dataloader worker" in caplog.text
+    batch = next(iter(dataloader))
+    assert torch.equal(
+        batch["decoder_input_ids"],
+        model.prepare_decoder_input_ids_from_labels(labels=batch["labels"]),
+    )
+
+
+def test_seq2seq_collation(variable_length_file, tokenizer, tmp_path):
+    with open(variable_length_file) as fp:
+        texts = [json.loads(line)["text"] for line in fp]
+    seq2seq_file = str(tmp_path / "seq2seq.jsonl")
+    with open(seq2seq_file, "wt") as fp:
+        for text in texts:
+            fp.write(
+                json.dumps({"source": text, "target": text[: len(text) // 3]}) + "\n"
+            )
+    dataset_args = {
+        "train_file": seq2seq_file,
+        "validation_file": seq2seq_file,
+        "batch_size": 8,
+        "max_length": 64,
+        "max_target_length": 16,
+        "num_dataloader_workers": 0,
+    }
+    data_module = CGMDataModule(
+        dataset_args,
+        model=DecoderInputsFromLabels(
+            decoder_start_token_id=tokenizer.pad_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+        ),
+        tokenizer=tokenizer,
+    )
+    for batch in data_module.train_dataloader():
+        # sources and targets padded independently, each to its longest sequence
+        lengths = batch["attention_mask"].sum(dim=1)
+        assert batch["input_ids"].shape[1] == int(lengths.max())
+        label_lengths = (batch["labels"] != -100).sum(dim=1)
+        assert batch["labels"].shape[1] == int(label_lengths.max()) <= 16
+        assert (batch["labels"] != tokenizer.pad_token_id).all()
+        assert torch.equal(
+            batch["decoder_input_ids"][:, 1:],
+            (
+                batch["labels"][:, :-1].masked_fill(
+                    batch["labels"][:, :-1] == -100, tokenizer.pad_token_id
+                )
+            ),
+        )
+
+    # pad tokens of targets padded at tokenization time are ignored by the loss
+    tokenize = ConditionalGenerationTokenizeFunction(
+        tokenizer, padding="max_length", max_length=64, max_target_length=16
+    )
+    examples = tokenize({"source": texts[:2], "target": ["a b", "c"]})
+    assert np.asarray(examples["input_ids"]).shape == (2, 64)
+    labels = np.asarray(examples["labels"])
+    assert labels.shape == (2, 16)
+    assert (labels == -100).sum() > 0
+    assert not (labels == tokenizer.pad_token_id).any()
+
+
+def test_resumable_data_loading(variable_length_file, tokenizer):
+    lengths = list(range(20))
+    full = LengthGroupedBatchSampler(
+        SequentialSampler(lengths), 4, drop_last=False, lengths=lengths
+    )
+    resumed = LengthGroupedBatchSampler(
+        SequentialSampler(lengths), 4, drop_last=False, lengths=lengths, start_batch=2
+    )
+    # iterators discarded before drawing a batch do not consume the skipped batches
+    iter(resumed)
+    assert list(resumed) == list(full)[2:]
+    assert list(resumed) == list(full)
+    assert len(resumed) == len(full)
+
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "mlm_probability": 0.15,
+        "num_dataloader_workers": 0,
+    }
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    state = data_module.state_dict()
+    assert state["consumed_batches"] == 0
+    data_module.load_state_dict({**state, "consumed_batches": 3})
+    assert len(list(data_module.train_dataloader())) == 5
+    # the restored state only applies to the resumed epoch
+    assert len(list(data_module.train_dataloader())) == 8
+
+
+def test_batched_fetching(variable_length_file, tokenizer, tmp_path):
+    directory = tmp_path / "dataset"
+    os.makedirs(directory)
+    shutil.copy(variable_length_file, directory / "first.jsonl")
+    shutil.copy(variable_length_file, directory / "second.jsonl")
+    dataset_args = {
+        "train_file": str(directory),
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "dynamic_padding": True,
+    }
+    data_module = CLMDataModule(dataset_args, tokenizer=tokenizer)
+
+    indices = [70, 3, 127, 3, 64]
+    for dataset in data_module.datasets.values():
+        indices = [index % len(dataset) for index in indices]
+        items = dataset.__getitems__(indices)
+        assert [dict(item) for item in items] == [
+            dict(dataset[index]) for index in indices
+        ]
+
+
+def test_masking_collators(variable_length_file, tokenizer):
+    with open(variable_length_file) as fp:
+        texts = [json.loads(line)["text"] for line in fp]
+    encodings = tokenizer(texts, padding="max_length", max_length=48)
+    examples = [
+        {key: values[index] for key, values in encodings.items()}
+        for index in range(len(texts))
+    ]
+    special_ids = torch.tensor(tokenizer.all_special_ids)
+    torch.manual_seed(0)
+
+    batch = MaskedLanguageModelingCollator(tokenizer, mlm_probability=0.5)(examples)
+    masked = batch["labels"] != -100
+    assert not torch.isin(batch["labels"][masked], special_ids).any()
+    input_ids = torch.tensor(encodings["input_ids"])
+    assert (batch["input_ids"][~masked] == input_ids[~masked]).all()
+    assert 0.3 < masked.sum() / batch["attention_mask"].sum() < 0.7
+
+    batch = PermutationLanguageModelingCollator(tokenizer)(examples)
+    masked = batch["labels"] != -100
+    assert masked.any()
+    assert (batch["input_ids"][masked] == tokenizer.mask_token_id).all()
+    assert batch["perm_mask"].shape == (len(examples), 48, 48)
+    # only masked tokens are hidden
+    assert (batch["perm_mask"].sum(dim=1)[~masked] == 0).all()
+
+
+def test_data_echoing(variable_length_file, tokenizer, monkeypatch):
+    controller = EchoFactorController(max_echo_factor=3)
+    # waiting twice the step time for each batch requires three steps per batch
+    assert controller.update(wait_time=0.2, step_time=0.1) == 3
+    controller.apply(3)
+    for _ in range(PROBE_INTERVAL - 1):
+        assert controller.update(wait_time=0.0, step_time=0.1) == 3
+    # a lower factor is tried once the pipeline keeps up, until applied
+    assert controller.update(wait_time=0.0, step_time=0.1) == 2
+    assert controller.update(wait_time=0.0, step_time=0.1) == 2
+
+    dataset_args = {
+        "train_file": variable_length_file,
+        "validation_file": variable_length_file,
+        "batch_size": 8,
+        "max_length": 48,
+        "mlm_probability": 0.5,
+        "num_dataloader_workers": 0,
+        "echo_factor": "2",
+    }
+    torch.manual_seed(0)
+    data_module = MLMDataModule(dataset_args, tokenizer=tokenizer)
+    dataloader = data_module.train_dataloader()
+    assert isinstance(dataloader, EchoingDataLoader)
+    batches = list(dataloader)
+    assert len(batches) == len(dataloader) == 2 * 8
+    assert list(data_module.echoes) == [(True, 2), (False, 2)] * 8
+    for batch, echo in zip(batches[::2], batches[1::2]):
+        # same examples, masked anew
+        assert not torch.equal(batch["input_ids"], echo["input_ids"])
+        for masked in (batch, echo):
+            tokens = torch.where(
+                masked["labels"] != -100, masked["labels"], masked["input_ids"]
+            )
+            assert torch.equal(
+                tokens,
+                torch.where(
+                    batch["labels"] != -100, batch["labels"], batch["input_ids"]
+                ),
+            )
+
+    auto = MLMDataModule(
+        {**dataset_args, "echo_factor": "auto"}, tokenizer=tokenizer
+    ).train_dataloader()
+    # an upper bound of the number of echoes
+    assert len(auto) == 4 * 8
+    assert 8 <= len(list(auto)) <= len(auto)
+
+    # DDP processes change factors together, to the largest one proposed
+    monkeypatch.setattr(echoing, "distributed_world", lambda: (2, 0))
+    monkeypatch.setattr(echoing, "max_across_ranks", lambda value: 3)
+    data_module = MLMDataModule(
+        {**dataset_args, "echo_factor": "auto", "batch_size": 2}, tokenizer=tokenizer
+    )
+    list(data_module.train_dataloader())
+    factors = [factor for fresh, factor in data_module.echoes if fresh]
+    assert factors == [1] * SYNC_INTERVAL + [3] * (32 - SYNC_INTERVAL)
+    with pytest.raises(ValueError):
+        MLMDataModule(
+            {**dataset_args, "echo_factor": "0"}, tokenizer=tokenizer
+        ).train_dataloader()
+
+
+def test_padding_collator(variable_length_file, tokenizer):
+    with open(variable_length_file) as fp:
+        texts = [json.loads(line)["text"] for line in fp]
+    encodings = tokenizer(texts)
+    examples = [
+        {key: values[index] for key, values in encodings.items()}
+        for index in range(len(texts))
+    ]
+    padded = tokenizer(texts, padding="longest", pad_to_multiple_of=8)
+
+    batch = TensorCollator().with_padding(tokenizer, pad_to_multiple_of=8)(examples)
+    for key, values in padded.items():
+        assert torch.equal(batch[key], torch.tensor(values))
+    with pytest.raises(ValueError):
+        TensorCollator()(examples)
+
+
+@pytest.mark.parametrize("backend", JSON_BACKENDS)
+def test_example_parser(example_file, backend):
+    with open(example_file, "rb") as fp:
+        lines = fp.readlines()
+
+    for line in lines:
+        example = json.loads(line)
+        assert ExampleParser(backend)(line) == example
+        assert ExampleParser(backend, fields=["text", "missing"])(line) == {
+            "text": example["text"]
+        }
+
+
+@pytest.mark.parametrize(
+    "suffix, lines_per_block", [(".gz", 5), (".gz", 1000), (".zst", 5)]
+)
+def test_compressed_dataset(variable_length_file, suffix, lines_per_block):
+    if suffix == ".zst":
+        pytest.importorskip("zstandard")
+    filepath = f"{variable_length_file}{suffix}"
+    write_block_compressed(variable_length_file, filepath, lines_per_block)
+
+    reader = BlockReader(filepath)
+    assert reader.number_of_blocks == -(-64 // lines_per_block)
+
+    dataset = LMDataset(variable_length_file, lambda example: example)
+    compressed_dataset = LMDataset(filepath, lambda example: example)
+    assert len(compressed_dataset) == LMDataset.count_examples(filepath) == 64
+    for index in [0, 63, 5, 4, 30]:
+        assert compressed_dataset[index] == dataset[index]
+
+    streaming_dataset = StreamingLMDataset([filepath], lambda example: example)
+    examples = [
+        example
+        for shard in range(3)
+        for filepath, start, end in streaming_dataset.shard_ranges(shard, 3)
+        for example in streaming_dataset.read_range(filepath, start, end)
+    ]
+    assert examples == [dataset[index] for index in range(64)]
+    examples = [
+        example
+        for shard in range(3)
+        for example in streaming_dataset.read_shard(shard, 3)
+    ]
+    assert sorted(map(json.dumps, examples)) == sorted(
+        json.dumps(dataset[index]) for index in range(64)
+    )
+
+    # blocks too large are only read sequentially
+    with pytest.raises(ValueError):
+        BlockReader(filepath, max_block_size=16).check_random_access()
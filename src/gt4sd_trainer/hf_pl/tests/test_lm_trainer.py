@@ -25,9 +25,21 @@
 
 import sentencepiece as _sentencepiece
 import importlib_resources
+import pytest
 from pytorch_lightning.callbacks.model_checkpoint import ModelCheckpoint
 
-from gt4sd_trainer.hf_pl.core import LanguageModelingTrainingPipeline  # type: ignore
+from gt4sd_trainer.hf_pl.argument_parser import ArgumentParser  # type: ignore
+from gt4sd_trainer.hf_pl.cli_preprocess import preprocess  # type: ignore
+from gt4sd_trainer.hf_pl.cli_trainer import (  # type: ignore
+    TrainerArgumentParser,
+    TrainerArguments,
+)
+from gt4sd_trainer.hf_pl.core import (  # type: ignore
+    LanguageModelingDataArguments,
+    LanguageModelingModelArguments,
+    LanguageModelingTrainingPipeline,
+    TokenizedCacheArguments,
+)
 from gt4sd_trainer.hf_pl.datasets.core import (  # type: ignore
     CGMDataModule,
     CLMDataModule,
@@ -40,6 +52,9 @@ from gt4sd_trainer.hf_pl.models.core import (  # type: ignore
     MLMModule,
     PLMModule,
 )
+from gt4sd_trainer.hf_pl.pytorch_lightning_trainer import (  # type: ignore
+    PytorchLightningTrainingArguments,
+)
 
 # sentencepiece has to be loaded before lightning to avoid segfaults
 _sentencepiece
@@ -203,6 +218,56 @@ def test_add_callbacks():
     assert isinstance(callbacks[0], ModelCheckpoint)
 
 
+def test_argument_parsers():
+    parser = TrainerArgumentParser(
+        (
+            TrainerArguments,
+            PytorchLightningTrainingArguments,
+            LanguageModelingDataArguments,
+            LanguageModelingModelArguments,
+        )
+    )
+    arguments = parser.parse_args_into_dataclasses(
+        args=[
+            "--type",
+            "cgm",
+            "--train_file",
+            "train.jsonl",
+            "--validation_file",
+            "valid.jsonl",
+            "--json_fields",
+            "source,target",
+        ],
+        return_remaining_strings=True,
+    )
+    data_arguments = next(
+        argument
+        for argument in arguments
+        if isinstance(argument, LanguageModelingDataArguments)
+    )
+    assert data_arguments.json_fields == "source,target"
+
+    for dataclass_types in [
+        (LanguageModelingDataArguments, LanguageModelingModelArguments),
+        (TokenizedCacheArguments,),
+    ]:
+        assert ArgumentParser(dataclass_types).format_help()
+
+
+@pytest.mark.parametrize("option", ["streaming", "shard_by_rank"])
+def test_preprocess_unsupported_options(option, tmp_path):
+    model_args = dict(template_config["model_args"])
+    dataset_args = {
+        **template_config["dataset_args"],
+        "tokenized_cache_dir": str(tmp_path / "cache"),
+        option: True,
+    }
+    # rejected before loading the tokenizer or building any dataset
+    with pytest.raises(ValueError, match=option):
+        preprocess(model_args, dataset_args)
+    assert not (tmp_path / "cache").exists()
+
+
 def check_model_config(module, config):
     for entry in module.model_args:
         assert entry in config